@@ -6,41 +6,198 @@
 
 from src.communicate.mq import *
 from src.communicate.stub import *
+from src.actors.model import QueryBatch, RandomModel, BACKENDS
+from src.actors.cache import PredictionCache
+from time import monotonic_ns
+import argparse
 
-agent = AsyncClient('localhost',7777)
+agent = ShardedClient('localhost',7777, max_batch_size=64) # solves written in one burst go out together
+model = RandomModel() # can be switched out for any Model, or simply weighted for probabilities
 
-async def main():
-    origin_topic = 'query'
-    answer_topic = 'solve'
+MAX_BATCH = 64 # query lines scored per predict_batch call
+MAX_WAIT = 0.002 # seconds a partial batch waits for more lines
+PREFETCH = MAX_BATCH * 4 # unacked lines held without a group, the broker sends the rest to freer agents
+CACHE_STATS_INTERVAL = 10.0 # seconds between prediction cache reports while running, 0 for none
 
-    await agent.subscribe(origin_topic)
-    # messages = 
-    # print(messages)
+async def read_messages(client:AsyncClient, inbox:asyncio.Queue):
+    # Keeps reading while a batch is being scored, None marks the end of the stream
+    try:
+        async for message in client.receive():
+            if message.get('trace') is not None: # a sampled query line, see metrics.STAGES
+                message['trace']['agent_in'] = monotonic_ns()
+            await inbox.put(message)
+    finally:
+        await inbox.put(None)
 
-    async for message in agent.receive():
-        origin_topic = message.get('topic','')
-        query_message = message.get('message')
-        query_message = query_message.strip('\n')
-        query_id, target_line, choice_type, choices = query_message.split('\t')
+async def next_batch(inbox:asyncio.Queue, max_size:int, max_wait:float) -> list:
+    # Waits for one message, then takes whatever else arrives within max_wait
+    loop = asyncio.get_running_loop()
+    batch = [await inbox.get()]
+    deadline = loop.time() + max_wait
+    while len(batch) < max_size and batch[-1] is not None:
+        if inbox.empty():
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(inbox.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        else:
+            batch.append(inbox.get_nowait())
+    return batch
 
-        target  = target_line.split(';')
-        choices = choices.split(';')
+async def batch_messages(inbox:asyncio.Queue, work:asyncio.Queue, workers:int):
+    # Numbers the batches so the writer can put them back in order, one None per worker ends them
+    seq = 0
+    done = False
+    while not done:
+        messages = await next_batch(inbox, MAX_BATCH, MAX_WAIT)
+        if messages[-1] is None:
+            messages.pop()
+            done = True
+        if messages:
+            await work.put((seq, messages))
+            seq += 1
+    for _ in range(workers):
+        await work.put(None)
 
-        model = random.choice # can be switched out, or simply weighted for probabilities
-        prediction, uncertainty = model(choices), 0
-        # prediction, uncertainty = 'A', 0
+async def solve_batches(predictor, cache:PredictionCache, work:asyncio.Queue, outbox:asyncio.Queue,
+                        answer_topic:str):
+    # Worker: scores batches (cache first, model for the misses) into Solves
+    while (item := await work.get()) is not None:
+        seq, messages = item
+        started = monotonic_ns()
+        query_messages = [message.get('message').strip('\n') for message in messages]
+        keys = [PredictionCache.key(query_message) for query_message in query_messages]
+        cache.use_model(predictor.model.signature)
+        predictions = [cache.get(key) for key in keys]
 
-        solution = Solve(
-            topic=answer_topic,
-            id=query_id,
-            origin_topic=origin_topic,
-            origin_string=query_message,
-            choice=prediction,
-            uncertainty=uncertainty
-        )
+        misses = [i for i, prediction in enumerate(predictions) if prediction is None]
+        if misses:
+            batch = QueryBatch([query_messages[i] for i in misses])
+            indices, uncertainty = await predictor.predict_batch(batch)
+            for i, choice, choice_uncertainty in zip(misses, batch.chosen(indices), uncertainty.tolist()):
+                predictions[i] = choice, choice_uncertainty
+                cache.put(keys[i], choice, choice_uncertainty)
+        finished = monotonic_ns()
+        for message in messages:
+            if message.get('trace') is not None:
+                message['trace'].update(model_start=started, model_end=finished)
+
+        solutions = [
+            Solve(
+                topic=answer_topic,
+                id=query_message.split('\t', 1)[0],
+                origin_topic=message.get('topic',''),
+                origin_string=query_message,
+                choice=prediction,
+                uncertainty=prediction_uncertainty
+            )
+            for message, query_message, (prediction, prediction_uncertainty) in zip(
+                messages, query_messages, predictions
+            )
+        ]
+        await outbox.put((seq, messages, solutions))
+    await outbox.put(None)
+
+async def write_solutions(client:AsyncClient, outbox:asyncio.Queue, workers:int, group:str):
+    # Single writer: batches leave in the order they were read, so commits only move forward,
+    # everything finished meanwhile goes out with one flush
+    ready = dict() # seq -> (messages, solutions), finished ahead of an earlier batch
+    expected = 0
+    running = workers
+    while running:
+        item = await outbox.get()
+        while True:
+            if item is None:
+                running -= 1
+            else:
+                ready[item[0]] = item[1:]
+            if outbox.empty():
+                break
+            item = outbox.get_nowait()
+
+        while expected in ready:
+            messages, solutions = ready.pop(expected)
+            expected += 1
+            for message, solution in zip(messages, solutions):
+                trace = message.get('trace')
+                if trace is not None:
+                    trace['agent_out'] = monotonic_ns()
+                await client.solve(solution, correlation_id=message.get('id',''), trace=trace)
+                if group:
+                    await client.commit(message, group)
+                else:
+                    await client.ack(message)
+        await client.flush() # all solves and commits coalesced since the last write
+
+async def report_cache(cache:PredictionCache, interval:float):
+    # Hit rates while the agent runs, only when there were lookups since the last report
+    reported = 0
+    while True:
+        await asyncio.sleep(interval)
+        stats = cache.stats()
+        if stats['hits'] + stats['misses'] > reported:
+            reported = stats['hits'] + stats['misses']
+            print(f'Prediction cache: {stats}')
+
+async def main(backend='local', origin_topic='query', client=None, answer_topic='solve', group='',
+               workers=1, prefetch=PREFETCH, cache=None, cache_stats_interval=CACHE_STATS_INTERVAL):
+    # client defaults to the module's agent, several agents can run in one process.
+    # By default each line is acked and redelivered to another agent if this one dies,
+    # and at most prefetch lines are held unacked, the broker keeps the rest for the freest agent.
+    # With a group, agents share the topic's partitions (server.py --partitions query=N, one
+    # partition is one agent's) and resume from committed offsets.
+    # Reading, scoring and writing overlap: reader -> batcher -> workers -> writer,
+    # workers > 1 keeps several batches scoring at once (thread / process backends).
+    # Every agent has its own prediction cache unless one is passed in
+    client = client or agent
+    cache = cache or PredictionCache() # repeated target / choices skip the model entirely
+
+    await client.subscribe(origin_topic, group=group, prefetch=0 if group else prefetch)
+    predictor = BACKENDS[backend](model)
+    inbox = asyncio.Queue(maxsize=MAX_BATCH * 4)
+    work = asyncio.Queue(maxsize=workers * 2) # bounded, a slow model holds the reader back
+    outbox = asyncio.Queue()
+    reader = asyncio.create_task(read_messages(client, inbox))
+    reporter = asyncio.create_task(report_cache(cache, cache_stats_interval)) if cache_stats_interval else None
+    stages = [
+        asyncio.create_task(batch_messages(inbox, work, workers)),
+        *(asyncio.create_task(solve_batches(predictor, cache, work, outbox, answer_topic)) for _ in range(workers))
+    ]
+    try:
+        # a failing stage ends the agent instead of leaving the others waiting
+        await asyncio.gather(write_solutions(client, outbox, workers, group), *stages)
+    finally:
+        reader.cancel()
+        if reporter is not None:
+            reporter.cancel()
+        for stage in stages:
+            stage.cancel()
+        predictor.close()
+        print(f'Prediction cache: {cache.stats()}')
 
-        await agent.solve(solution)
 
-    
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=7777)
+    parser.add_argument('--topic', default='query')
+    parser.add_argument('--answer-topic', default='solve', help="'replay_solve' when scoring a replay")
+    parser.add_argument('--framing', choices=('json', 'binary'), default='json')
+    parser.add_argument('--transport', choices=('tcp', 'unix', 'shm'), default='tcp',
+                        help="'unix' needs server.py --unix, 'shm' a broker on this host")
+    parser.add_argument('--group', default='',
+                        help="consumer group sharing the topic's partitions, e.g. 'agents' with server.py --partitions")
+    parser.add_argument('--prefetch', type=int, default=PREFETCH, help='unacked lines held without a group')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='local',
+                        help="'thread' / 'process' score in a pool for blocking / CPU-heavy models")
+    parser.add_argument('--workers', type=int, default=1, help='batches scored concurrently')
+    parser.add_argument('--cache-stats-interval', type=float, default=CACHE_STATS_INTERVAL,
+                        help='seconds between prediction cache reports, 0 for only at exit')
+    args = parser.parse_args()
+    agent.host, agent.port, agent.framing = args.host, args.port, args.framing
+    agent.transport = agent.kwargs['transport'] = args.transport # shard connections are made with kwargs
+    asyncio.run(main(args.backend, args.topic, answer_topic=args.answer_topic, group=args.group,
+                     workers=args.workers, prefetch=args.prefetch, cache_stats_interval=args.cache_stats_interval))
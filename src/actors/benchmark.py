@@ -0,0 +1,253 @@
+# Benchmark for the broker and agents, replaces the timing in client.py:main
+# - Starts a broker and agents on a scratch data folder, in this process or as subprocesses
+# - Closed loop: `clients` workers each wait for a reply before sending their next query
+# - Open loop: queries are started at a fixed rate whether or not replies keep up,
+#   latency counts from the scheduled start so a stalled broker is not hidden
+# - Reports throughput and latency percentiles as JSON on stdout, with --trace-sample
+#   also where the time goes: per-stage histograms of the sampled queries (metrics.STAGES)
+#
+#   python -m src.actors.benchmark --mode open --rate 2000 --requests 20000
+#   python -m src.actors.benchmark --mode closed --clients 64 --spawn subprocess
+#   python -m src.actors.benchmark --trace-sample 0.01
+#   python -m src.actors.benchmark --agents 4 --group agents --partitions query=8
+
+import sys, json, time, random, shutil, asyncio, argparse, tempfile, subprocess
+from contextlib import redirect_stdout
+import numpy as np
+from src.communicate.mq import MessageQueue, AsyncClient, ShardedClient, ClientPool
+from src.communicate.transport import TRANSPORTS, default_unix_path
+from src.communicate.stub import Query
+from src.actors.server import parse_partitions
+import src.actors.agent as agent_module
+
+
+def make_queries(args) -> list:
+    # Same seed, same queries: runs of different versions see identical traffic
+    rng = random.Random(args.seed)
+    def value(size):
+        return ''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=size))
+    distinct = [
+        (
+            {f'target_{i}': value(args.payload_bytes) for i in range(args.target_fields)},
+            {f'choice_{i}': [value(8) for _ in range(args.choices)] for i in range(args.choice_types)}
+        )
+        for _ in range(args.distinct or args.requests)
+    ]
+    return [
+        Query(topic=args.topic, id=f'bench_{i}', target=target, choices=choices)
+        for i, (target, choices) in ((i, distinct[i % len(distinct)]) for i in range(args.requests))
+    ]
+
+
+async def port_open(host, port) -> bool:
+    try:
+        _, writer = await asyncio.open_connection(host, port)
+    except OSError:
+        return False
+    writer.close()
+    return True
+
+
+async def wait_for_port(host, port, process, timeout=10.0):
+    # Fails as soon as the broker process exits, a listener alone could be another broker
+    deadline = time.monotonic() + timeout
+    while not await port_open(host, port):
+        if process.poll() is not None:
+            raise RuntimeError(f'Broker exited with code {process.returncode} before listening on {host}:{port}')
+        if time.monotonic() > deadline:
+            raise TimeoutError(f'Broker not listening on {host}:{port} after {timeout}s')
+        await asyncio.sleep(0.05)
+
+
+def check_broker(started) -> None:
+    # The broker comes first in started, it must still be running after the load
+    broker = started[0]
+    if isinstance(broker, subprocess.Popen):
+        if broker.poll() is not None:
+            raise RuntimeError(f'Broker exited with code {broker.returncode} during the run')
+    elif broker.done():
+        broker.result() # raises what stopped it
+        raise RuntimeError('Broker stopped during the run')
+
+
+async def start_in_process(args, folder) -> tuple:
+    # Returns the broker, for closing its connections at the end, and the tasks to cancel
+    broker = MessageQueue(args.host, args.port, folder, partitions=parse_partitions(args.partitions),
+                          unix_path=default_unix_path(args.port) if args.transport == 'unix' else None)
+    tasks = [asyncio.create_task(broker._run())]
+    # Bound before serving: a taken port fails the broker task instead of reaching another broker
+    listening = asyncio.create_task(broker.listening.wait())
+    await asyncio.wait([tasks[0], listening], return_when=asyncio.FIRST_COMPLETED)
+    if not listening.done():
+        listening.cancel()
+        check_broker(tasks)
+    for _ in range(args.agents):
+        client = ShardedClient(args.host, args.port, framing=args.framing, max_batch_size=64,
+                               transport=args.transport)
+        tasks.append(asyncio.create_task(agent_module.main(args.backend, args.topic, client, group=args.group,
+                                                           workers=args.agent_workers)))
+    return broker, tasks
+
+
+async def start_subprocesses(args, folder) -> list:
+    if await port_open(args.host, args.port):
+        raise RuntimeError(f'{args.host}:{args.port} is already in use, pick another --port')
+    quiet = dict(stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    processes = [subprocess.Popen(
+        [sys.executable, '-m', 'src.actors.server', '--host', args.host,
+         '--port', str(args.port), '--data', folder] + (['--unix'] if args.transport == 'unix' else []) +
+        [option for value in args.partitions for option in ('--partitions', value)], **quiet
+    )]
+    await wait_for_port(args.host, args.port, processes[0])
+    for _ in range(args.agents):
+        processes.append(subprocess.Popen(
+            [sys.executable, '-m', 'src.actors.agent', '--host', args.host, '--port', str(args.port),
+             '--topic', args.topic, '--framing', args.framing, '--backend', args.backend,
+             '--workers', str(args.agent_workers), '--transport', args.transport, '--group', args.group], **quiet
+        ))
+    return processes
+
+
+async def run_load(args, queries) -> tuple:
+    # Returns per request latencies (s), the number of failed requests, the elapsed time
+    # and the stage histograms of traced queries
+    latencies = list()
+    failures = 0
+
+    async def one(pool, query, started):
+        nonlocal failures
+        try:
+            await pool.request(query, args.timeout, args.delivery)
+            latencies.append(time.perf_counter() - started)
+        except (asyncio.TimeoutError, ConnectionError):
+            failures += 1
+
+    async with ClientPool(args.host, args.port, size=args.connections, framing=args.framing,
+                          max_batch_size=args.max_batch_size, transport=args.transport,
+                          trace_sample=args.trace_sample) as pool:
+        await asyncio.sleep(args.warmup) # let agents join their group
+        started = time.perf_counter()
+        if args.mode == 'closed':
+            pending = iter(queries)
+            async def worker():
+                for query in pending:
+                    await one(pool, query, time.perf_counter())
+            await asyncio.gather(*(worker() for _ in range(args.clients)))
+        else: # if mode == 'open'
+            interval = 1.0 / args.rate
+            tasks = list()
+            for i, query in enumerate(queries):
+                scheduled = started + i * interval
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(one(pool, query, scheduled)))
+            await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+    stages = pool.traces.snapshot()
+    if stages:
+        # the logging stages are only seen by the broker
+        async with AsyncClient(args.host, args.port) as client:
+            stages = {**(await client.stats()).get('traces', {}), **stages}
+    return latencies, failures, elapsed, stages
+
+
+def report(args, latencies, failures, elapsed, stages) -> dict:
+    ms = np.array(latencies) * 1000
+    latency = dict()
+    if len(ms):
+        p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+        latency = {'mean': ms.mean(), 'p50': p50, 'p95': p95, 'p99': p99, 'max': ms.max()}
+    return {
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'requests': args.requests,
+        'completed': len(latencies),
+        'failed': failures,
+        'elapsed_s': elapsed,
+        'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+        'latency_ms': {key: float(value) for key, value in latency.items()},
+        'stages_us': stages
+    }
+
+
+async def main(args) -> dict:
+    queries = make_queries(args)
+    folder = tempfile.mkdtemp(prefix='mq_bench_') + '/' # never touches src/data/logs
+    broker, started = None, list()
+    try:
+        if args.spawn == 'subprocess':
+            started = await start_subprocesses(args, folder)
+        else:
+            broker, started = await start_in_process(args, folder)
+        results = await run_load(args, queries)
+        check_broker(started)
+    finally:
+        tasks = list()
+        for item in started:
+            if isinstance(item, subprocess.Popen):
+                item.terminate()
+                item.wait()
+            else:
+                item.cancel()
+                tasks.append(item)
+        # the broker flushes its logs and closes the bookkeeper as it stops, before the folder goes
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if broker is not None:
+            await broker._close()
+            await asyncio.sleep(0.1) # connection handlers see their sockets (or rings) closed and return
+        shutil.rmtree(folder, ignore_errors=True)
+    return report(args, *results)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Broker and agent load test')
+    parser.add_argument('--mode', choices=('closed', 'open'), default='closed')
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--clients', type=int, default=10, help='closed loop: concurrent requesters')
+    parser.add_argument('--rate', type=float, default=1000.0, help='open loop: queries per second')
+    parser.add_argument('--connections', type=int, default=2, help='pooled client connections')
+    parser.add_argument('--agents', type=int, default=1)
+    parser.add_argument('--backend', choices=sorted(agent_module.BACKENDS), default='local')
+    parser.add_argument('--group', default='', help="agents' consumer group, '' for acked plain subscriptions")
+    parser.add_argument('--partitions', action='append', default=[], metavar='TOPIC=COUNT',
+                        help='partitions of a topic as server.py --partitions, repeatable')
+    parser.add_argument('--agent-workers', type=int, default=1, help='batches each agent scores concurrently')
+    parser.add_argument('--spawn', choices=('inprocess', 'subprocess'), default='inprocess')
+    parser.add_argument('--framing', choices=('json', 'binary'), default='json')
+    parser.add_argument('--transport', choices=TRANSPORTS, default='tcp', help="'local' runs in process only")
+    parser.add_argument('--delivery', choices=('one', 'all'), default='one')
+    parser.add_argument('--topic', default='query')
+    parser.add_argument('--target-fields', type=int, default=2)
+    parser.add_argument('--payload-bytes', type=int, default=8, help='length of each target value')
+    parser.add_argument('--choice-types', type=int, default=2, help='lines (and Solves) per query')
+    parser.add_argument('--choices', type=int, default=3, help='options per choice type')
+    parser.add_argument('--distinct', type=int, default=0, help='distinct queries cycled through, 0 for all')
+    parser.add_argument('--max-batch-size', type=int, default=16)
+    parser.add_argument('--timeout', type=float, default=10.0)
+    parser.add_argument('--trace-sample', type=float, default=0.0, help='share of queries traced hop by hop')
+    parser.add_argument('--warmup', type=float, help='seconds for agents to join, default 0.3 (2 as subprocesses)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=7790)
+    parser.add_argument('--output', help='also write the JSON report to this file')
+    args = parser.parse_args(argv)
+    if args.transport == 'local' and args.spawn == 'subprocess':
+        parser.error("--transport local needs --spawn inprocess")
+    try:
+        parse_partitions(args.partitions)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.warmup is None:
+        args.warmup = 2.0 if args.spawn == 'subprocess' else 0.3
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with redirect_stdout(sys.stderr): # connection chatter stays off the JSON
+        result = asyncio.run(main(args))
+    line = json.dumps(result, indent=2)
+    print(line)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(line + '\n')
@@ -0,0 +1,67 @@
+# Prediction cache for the agent
+# - Keyed on the query line without its id: (target_line, choice_type, choice_line)
+# - Entries belong to one model signature, seeing another one clears the cache
+# - Bounded by max_entries (least recently used goes first) and by ttl seconds
+
+import time
+from collections import OrderedDict
+
+
+class PredictionCache:
+    MAX_ENTRIES = 100000
+    TTL = 300.0
+
+    def __init__(self, max_entries=None, ttl=None):
+        self.max_entries = max_entries or self.MAX_ENTRIES
+        self.ttl = ttl or self.TTL
+        self.signature = None # model the cached predictions came from
+        self.entries = OrderedDict() # key -> (expires, choice, uncertainty)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def key(query_line:str) -> tuple:
+        _, target_line, choice_type, choice_line = query_line.strip('\n').split('\t')
+        return target_line, choice_type, choice_line
+
+    def use_model(self, signature) -> None:
+        if signature != self.signature:
+            self.invalidate()
+            self.signature = signature
+
+    def invalidate(self) -> None:
+        self.entries.clear()
+
+    def get(self, key:tuple):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[0] < time.monotonic():
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1], entry[2]
+
+    def put(self, key:tuple, choice:str, uncertainty:float) -> None:
+        self.entries[key] = (time.monotonic() + self.ttl, choice, uncertainty)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
@@ -4,40 +4,33 @@
 
 from src.communicate.mq import *
 from src.communicate.stub import *
+from src.data.columnar import ColumnarLog
 from timeit import timeit
 import os
 
-async def test_server(num_iterations, time_per_iteration):
+async def test_server(pool, num_iterations, time_per_iteration):
     solutions=0
-    async with AsyncClient('localhost',7777) as agent:
-        for i in range(num_iterations):
-            await asyncio.sleep(time_per_iteration)
-            origin_topic = 'query'
-            origin_id = f'query_{i}'
-            answer_topic = 'solve'
-            characteristics = {'target_a':'a', 'target_b':'b'}
-            choices =  {'choice_a':['a','b','c'], 'choice_b':['1','2','3']}
-
-            query = Query(
-                topic=origin_topic,
-                id=origin_id,
-                target=characteristics,
-                choices=choices
-            )
-            
-            await agent.subscribe(answer_topic)
-            await agent.query(query)
-
-            expected_solutions = query.count()
-
-            async for message in agent.receive():
-                expected_solutions -= 1
-                if expected_solutions == 0:
-                    solutions+=1
-                    break
-                # solution = json.loads(message.get('message','{}'))
-                # solution = Solve(**solution)
-                # print(solution)
+    for i in range(num_iterations):
+        await asyncio.sleep(time_per_iteration)
+        origin_topic = 'query'
+        origin_id = f'query_{i}'
+        characteristics = {'target_a':'a', 'target_b':'b'}
+        choices =  {'choice_a':['a','b','c'], 'choice_b':['1','2','3']}
+
+        query = Query(
+            topic=origin_topic,
+            id=origin_id,
+            target=characteristics,
+            choices=choices
+        )
+
+        try:
+            answers = await pool.request(query) # one Solve per choice
+        except asyncio.TimeoutError:
+            continue
+        if len(answers) == query.count():
+            solutions+=1
+        # print(answers)
     # print(solutions)
 
     print(solutions/num_iterations)
@@ -64,11 +57,22 @@ async def count_file_lines(reset=False):
         else:
             print(f"{solve_path} does not exist")
 
+        # closed logs are compacted into columns, their row counts come from metadata
+        query_rows = ColumnarLog('src/data/logs/columns', 'query').count()
+        solve_rows = ColumnarLog('src/data/logs/columns', 'solve').count()
+        if query_rows or solve_rows:
+            query_lines += query_rows
+            solve_lines += solve_rows
+            print(f"Compacted rows: {query_rows} queries, {solve_rows} solutions")
+
         if reset:
-            # Clear contents of both files if reset is True
+            # Clear contents of both files if reset is True, with their indexes,
+            # the bookkeeper re-reads the sizes on its next commit
             try:
-                open(query_path, 'w').close()  # Clear query file
-                open(solve_path, 'w').close()  # Clear solve file
+                for path in (query_path, solve_path):
+                    open(path, 'w').close()
+                    if os.path.exists(path + '.idx'):
+                        open(path + '.idx', 'w').close()
                 print("Files cleared")
             except Exception as e:
                 print(f"Error clearing files: {e}")
@@ -88,10 +92,10 @@ async def main():
     time_per_query = 0.004
     iterations = 5 
 
-    async def run_workers():
+    async def run_workers(pool):
         tasks = []
         for _ in range(workers):
-            tasks.append(asyncio.create_task(test_server(queries, time_per_query)))
+            tasks.append(asyncio.create_task(test_server(pool, queries, time_per_query)))
         await asyncio.gather(*tasks)
     
     # Count lines before starting
@@ -100,8 +104,9 @@ async def main():
     # Time the execution
     start_time = asyncio.get_event_loop().time()
 
-    for _ in range(iterations):
-        await run_workers()
+    async with ClientPool('localhost', 7777, size=2, max_batch_size=16) as pool: # workers share connections
+        for _ in range(iterations):
+            await run_workers(pool)
     
     end_time = asyncio.get_event_loop().time()
     total_time = end_time - start_time
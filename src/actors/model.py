@@ -0,0 +1,141 @@
+# Models the agent predicts with
+# - A model scores a whole micro-batch of query lines in one predict_batch call
+# - Lines are parsed once into a QueryBatch, choice counts and masks are NumPy arrays
+# - Backends run predict_batch inline, in a thread pool (blocking models that release
+#   the GIL: NumPy, I/O) or in a process pool, so a CPU-heavy model never blocks the
+#   event loop that keeps reading messages
+#
+# A model returns, per line, the index of the chosen option and its uncertainty:
+#   predict_batch(batch) -> (choices: int array (n,), uncertainty: float array (n,))
+
+import asyncio
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class QueryBatch:
+    # Query lines 'id \t target \t choice_type \t choices' split into columns
+    def __init__(self, lines:list):
+        self.ids = list()
+        self.targets = list()
+        self.choice_types = list()
+        self.choices = list()
+        for line in lines:
+            query_id, target_line, choice_type, choice_line = line.strip('\n').split('\t')
+            self.ids.append(query_id)
+            self.targets.append(target_line.split(';'))
+            self.choice_types.append(choice_type)
+            self.choices.append(choice_line.split(';'))
+
+        self.counts = np.fromiter((len(c) for c in self.choices), dtype=np.int64, count=len(self.choices))
+        width = int(self.counts.max()) if len(self.counts) else 0
+        self.mask = np.arange(width) < self.counts[:, None] # (n, width), True where an option exists
+
+    def __len__(self):
+        return len(self.ids)
+
+    def chosen(self, indices:np.ndarray) -> list:
+        return [choices[i] for choices, i in zip(self.choices, indices.tolist())]
+
+
+class Model:
+    version = 0 # bumped whenever the model's predictions may change
+
+    @property
+    def signature(self) -> tuple:
+        # cached predictions are only reused while this stays the same
+        return type(self).__name__, id(self), self.version
+
+    def predict_batch(self, batch:QueryBatch):
+        raise NotImplementedError
+
+
+class RandomModel(Model):
+    # Uniform over the options of each line, what random.choice did one line at a time
+    def __init__(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+
+    def predict_batch(self, batch:QueryBatch):
+        indices = (self.rng.random(len(batch)) * batch.counts).astype(np.int64)
+        return indices, np.zeros(len(batch))
+
+
+class ScoredModel(Model):
+    # Base for models that score every option, picks the masked argmax.
+    # Subclasses implement scores(batch) -> (n, width) array
+    def scores(self, batch:QueryBatch) -> np.ndarray:
+        raise NotImplementedError
+
+    def predict_batch(self, batch:QueryBatch):
+        scores = np.where(batch.mask, self.scores(batch), -np.inf)
+        indices = scores.argmax(axis=1)
+        # softmax over the options, uncertainty is 1 - probability of the pick
+        exp = np.exp(scores - scores.max(axis=1, keepdims=True))
+        probability = exp.max(axis=1) / exp.sum(axis=1)
+        return indices, 1.0 - probability
+
+
+class LocalBackend:
+    # Runs the model on the event loop, fine for cheap models like RandomModel
+    def __init__(self, model:Model):
+        self.model = model
+
+    def swap(self, model:Model):
+        self.model = model
+
+    async def predict_batch(self, batch:QueryBatch):
+        return self.model.predict_batch(batch)
+
+    def close(self):
+        pass
+
+
+class ThreadPoolBackend:
+    # Runs the model in threads sharing it, for models that block without holding the GIL
+    def __init__(self, model:Model, workers:int=None):
+        self.model = model
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='predict')
+
+    def swap(self, model:Model):
+        self.model = model # batches already running finish with the old one
+
+    async def predict_batch(self, batch:QueryBatch):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, self.model.predict_batch, batch)
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+
+_worker_model = None # the model inside a pool process, sent once at startup
+
+def _init_worker(model:Model):
+    global _worker_model
+    _worker_model = model
+
+def _predict_in_worker(batch:QueryBatch):
+    return _worker_model.predict_batch(batch)
+
+
+class ProcessPoolBackend:
+    # Runs the model in worker processes, the loop keeps reading while they score
+    def __init__(self, model:Model, workers:int=None):
+        self.model = model
+        self.workers = workers
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(model,))
+
+    def swap(self, model:Model):
+        # Workers hold their own copy, so a new model needs new workers
+        self.pool.shutdown(wait=False)
+        self.model = model
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=(model,))
+
+    async def predict_batch(self, batch:QueryBatch):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, _predict_in_worker, batch)
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+
+BACKENDS = {'local': LocalBackend, 'thread': ThreadPoolBackend, 'process': ProcessPoolBackend}
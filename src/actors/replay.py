@@ -0,0 +1,163 @@
+# Replays logged queries through the agents, e.g. to re-score history with a new model
+# - Query lines stream from the compacted columns, the closed logs and the active log
+# - They go to replay_query, answered by agents started with
+#     python -m src.actors.agent --topic replay_query --answer-topic replay_solve
+#   so the new solves land in logs/replay_solve.txt, next to and not inside the originals
+#   (LogJoin(..., solve_kind='replay_solve') pairs them with their queries, a replayed
+#   line is sent with its original correlation id and its solve carries it back)
+# - At most `window` queries are in flight, the agents set the pace
+# - speed=1 keeps the original gaps between queries, N is N times faster, 0 is no pacing
+#
+#   python -m src.actors.replay --speed 0 --window 2048
+
+import os, time, asyncio, argparse
+from functools import partial
+from datetime import datetime
+from src.communicate.mq import ShardedClient
+from src.communicate.stub import Query
+from src.data.columnar import ColumnarLog, CLOSED_LOG, DATETIME_FORMAT
+
+
+def _seconds_ns(dt:str) -> int:
+    # Logs without an index only have the datetime string, at second resolution
+    return int(datetime.strptime(dt, DATETIME_FORMAT).timestamp()) * 10**9 if dt else 0
+
+
+def _text_rows(path):
+    # Lines with the arrival ns from the log's index when it has one, read side by side
+    index = open(path + '.idx', 'r', encoding='utf-8') if os.path.exists(path + '.idx') else None
+    entry = None
+    position = 0
+    try:
+        with open(path, 'rb') as f:
+            for raw in f:
+                offset, position = position, position + len(raw)
+                items = raw.decode('utf-8').rstrip('\n').split('\t')
+                if len(items) != 6:
+                    continue
+                dt, _, query_id, target_line, choice_type, choice_line = items
+                received_ns, correlation_id = None, None
+                while index is not None and (entry is None or entry[1] < offset):
+                    line = index.readline()
+                    if not line:
+                        index.close()
+                        index = None
+                        break
+                    fields = line.rstrip('\n').split('\t')
+                    entry = (int(fields[3]), int(fields[4]), fields[0]) if len(fields) == 5 else None
+                if entry is not None and entry[1] == offset:
+                    received_ns, correlation_id = entry[0], entry[2]
+                yield received_ns or _seconds_ns(dt), correlation_id, query_id, target_line, choice_type, choice_line
+    finally:
+        if index is not None:
+            index.close()
+
+
+def read_queries(protected_directory):
+    # (received_ns, correlation id, id, target_line, choice_type, choice_line) oldest first,
+    # the correlation id is None for lines logged without an index
+    log_directory = os.path.join(protected_directory, 'logs')
+    columns = ColumnarLog(os.path.join(log_directory, 'columns'), 'query')
+    for received_ns, correlation_id, dt, query_id, target_line, choice_type, choice_line in columns.rows(
+        'received_ns', 'correlation_id', 'datetime', 'id', 'target', 'choice_type', 'choices'
+    ):
+        yield received_ns or dt * 10**9, correlation_id or None, query_id, target_line, choice_type, choice_line
+
+    if not os.path.isdir(log_directory):
+        return
+    closed = sorted(
+        name for name in os.listdir(log_directory)
+        if (match := CLOSED_LOG.match(name)) and match.group(1) == 'query'
+    )
+    for name in closed + ['query.txt']:
+        path = os.path.join(log_directory, name)
+        if os.path.exists(path):
+            yield from _text_rows(path)
+
+
+def to_query(topic, query_id, target_line, choice_type, choice_line) -> Query:
+    # One logged line is one choice type, it encodes back to the same line
+    return Query(
+        topic=topic,
+        id=query_id,
+        target=dict(enumerate(target_line.split(';'))),
+        choices={choice_type: choice_line.split(';')}
+    )
+
+
+async def paced(rows, speed:float):
+    # Keeps the original gaps divided by speed, never sleeps with speed=0
+    start = time.monotonic()
+    first_ns = None
+    for row in rows:
+        if speed > 0:
+            if first_ns is None:
+                first_ns = row[0]
+            delay = start + (row[0] - first_ns) / speed / 1e9 - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        yield row
+
+
+async def replay(client, rows, topic='replay_query', speed=0.0, window=1024, timeout=None, limit=None) -> dict:
+    counters = {'sent': 0, 'solved': 0, 'timed_out': 0}
+    slots = asyncio.Semaphore(window)
+    in_flight = set()
+    by_id = dict() # correlation id -> its request in flight, the lines of one query share it
+
+    async def one(query, correlation_id, previous):
+        if previous is not None:
+            await asyncio.wait([previous]) # replies are routed by correlation id, one request at a time
+        try:
+            await client.request(query, timeout, correlation_id=correlation_id)
+            counters['solved'] += 1
+        except (asyncio.TimeoutError, ConnectionError):
+            counters['timed_out'] += 1
+        finally:
+            slots.release()
+
+    def forget(correlation_id, task):
+        if by_id.get(correlation_id) is task:
+            del by_id[correlation_id]
+
+    started = time.monotonic()
+    async for received_ns, correlation_id, *line in paced(rows, speed):
+        if limit is not None and counters['sent'] >= limit:
+            break
+        await slots.acquire() # backpressure: wait for the agents to answer
+        previous = by_id.get(correlation_id) if correlation_id else None
+        task = asyncio.create_task(one(to_query(topic, *line), correlation_id, previous))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+        if correlation_id:
+            by_id[correlation_id] = task
+            task.add_done_callback(partial(forget, correlation_id))
+        counters['sent'] += 1
+    await asyncio.gather(*in_flight)
+    elapsed = time.monotonic() - started
+    counters['elapsed_s'] = elapsed
+    counters['rate'] = counters['solved'] / elapsed if elapsed else 0.0
+    return counters
+
+
+async def main(args):
+    # sends are batched, a window of queries leaves in a few send_batch writes
+    async with ShardedClient(args.host, args.port, framing=args.framing,
+                             max_batch_size=256, linger=0.001) as client:
+        counters = await replay(client, read_queries(args.data), args.topic,
+                                args.speed, args.window, args.timeout, args.limit)
+    print(counters)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay logged queries through the agents')
+    parser.add_argument('--data', default='src/data/')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=7777)
+    parser.add_argument('--framing', choices=('json', 'binary'), default='binary')
+    parser.add_argument('--topic', default='replay_query')
+    parser.add_argument('--speed', type=float, default=0.0, help='1 = original pace, N = N times faster, 0 = max')
+    parser.add_argument('--window', type=int, default=1024, help='queries in flight')
+    parser.add_argument('--timeout', type=float, help='seconds to wait for one query\'s solves')
+    parser.add_argument('--limit', type=int, help='stop after this many queries')
+    asyncio.run(main(parser.parse_args()))
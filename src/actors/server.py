@@ -4,13 +4,37 @@
 # - Book-keeping of experiments and feedback
 # - Communication Protocols
 # For data and models
+#
+# With --shards N the broker runs as N processes, shard i listens on port + i
+# and keeps its own logs under src/data/shard_<i>/. Every shard answers the
+# 'shards' command, ShardedClient uses it to spread topics and ids over them.
+#
+# With --coalesce query, identical query lines in flight at the same time are
+# scored once, the broker copies the Solve to every query waiting on it.
+#
+# With --unix every shard also listens on a Unix socket, default_unix_path(port),
+# for actors on the same host (agent.py --transport unix).
+#
+# --log-flush-interval, --log-fsync and --log-overflow set the Bookkeeper's group
+# commit (src/data/store.py), --segment-bytes, --retention-bytes and --retention-seconds
+# the topic segment logs (src/data/segment.py). Every shard gets the same settings.
+#
+# --partitions query=4 splits a topic into partitions, consumer groups (agent.py
+# --group agents) spread them over their members. Topics default to 1 partition.
 
 from src.communicate.mq import MessageQueue
+from src.communicate.transport import default_unix_path
+from multiprocessing import Process
+import argparse
 import asyncio
 
-async def run_message_queue():
+async def run_message_queue(host='localhost', port=7777, cache_folder='src/data/', shard_ports=None, stats_file=None,
+                            coalesce_topics=(), unix=False, **options):
+    # options are passed on to MessageQueue as they are
     try:
-        async with MessageQueue('localhost', 7777, 'src/data/') as mq:
+        async with MessageQueue(host, port, cache_folder, shard_ports=shard_ports, stats_file=stats_file,
+                                coalesce_topics=coalesce_topics,
+                                unix_path=default_unix_path(port) if unix else None, **options) as mq:
             while True:
                 try:
                     await asyncio.sleep(1)  # Keep server running
@@ -21,5 +45,78 @@ async def run_message_queue():
         print(f"Server error: {e}")
 
 
+def parse_partitions(values) -> dict:
+    # ['query=4', ...] -> {'query': 4}
+    partitions = dict()
+    for value in values or ():
+        topic, _, count = value.rpartition('=')
+        if not topic or not count.isdigit() or int(count) < 1:
+            raise ValueError(f'Expected TOPIC=COUNT with COUNT >= 1, got {value!r}')
+        partitions[topic] = int(count)
+    return partitions
+
+
+def run_shard(host, port, cache_folder, shard_ports, stats_file, coalesce_topics=(), unix=False, **options):
+    try:
+        asyncio.run(run_message_queue(host, port, cache_folder, shard_ports, stats_file, coalesce_topics, unix,
+                                      **options))
+    except KeyboardInterrupt:
+        pass
+
+
+def run_sharded(host, port, cache_folder, shards, stats_file=None, coalesce_topics=(), unix=False, **options):
+    shard_ports = [port + i for i in range(shards)]
+    processes = [
+        Process(target=run_shard, args=(
+            host, shard_port, f'{cache_folder}shard_{i}/', shard_ports,
+            stats_file and f'{stats_file}.{i}', # one stats file per shard
+            coalesce_topics, unix
+        ), kwargs=options)
+        for i, shard_port in enumerate(shard_ports)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        print("\nShutting down shards...")
+        for process in processes:
+            process.terminate()
+
+
 if __name__ == '__main__':
-    asyncio.run(run_message_queue())
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=7777)
+    parser.add_argument('--data', default='src/data/')
+    parser.add_argument('--shards', type=int, default=1, help='broker processes, one per core')
+    parser.add_argument('--stats-file', help='periodically write broker stats here as JSON')
+    parser.add_argument('--coalesce', action='append', default=[], metavar='TOPIC',
+                        help='score identical in-flight queries on this topic once, repeatable')
+    parser.add_argument('--unix', action='store_true', help='also listen on a Unix socket per shard')
+    parser.add_argument('--log-flush-interval', type=float, help='seconds a log group commit waits for more lines')
+    parser.add_argument('--log-fsync', choices=('never', 'commit', 'interval'), default='never')
+    parser.add_argument('--log-overflow', choices=('block', 'drop'), default='block',
+                        help='when the log queue is full, wait for room or drop the line')
+    parser.add_argument('--partitions', action='append', default=[], metavar='TOPIC=COUNT',
+                        help='partitions of a topic, repeatable, consumer groups share them')
+    parser.add_argument('--segment-bytes', type=int, help='topic log segment size before it rolls')
+    parser.add_argument('--retention-bytes', type=int, help='bytes kept per topic partition')
+    parser.add_argument('--retention-seconds', type=float, help='age after which closed segments are deleted')
+    args = parser.parse_args()
+    try:
+        partitions = parse_partitions(args.partitions)
+    except ValueError as e:
+        parser.error(str(e))
+    options = dict(partitions=partitions,
+                   log_flush_interval=args.log_flush_interval, log_fsync=args.log_fsync,
+                   log_overflow=args.log_overflow, segment_bytes=args.segment_bytes,
+                   retention_bytes=args.retention_bytes, retention_seconds=args.retention_seconds)
+
+    if args.shards > 1:
+        run_sharded(args.host, args.port, args.data, args.shards, args.stats_file, args.coalesce, args.unix,
+                    **options)
+    else:
+        asyncio.run(run_message_queue(args.host, args.port, args.data, stats_file=args.stats_file,
+                                      coalesce_topics=args.coalesce, unix=args.unix, **options))
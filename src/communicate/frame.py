@@ -0,0 +1,279 @@
+# Binary framing for the message queue, negotiated per connection
+#
+# A client opts in by sending {"command": "hello", "framing": "binary"} as a
+# newline-JSON line, the broker answers with the same line and both sides
+# switch to frames. Without a hello the connection stays newline-JSON, which
+# keeps telnet / nc debugging working.
+#
+# Frame layout, network byte order:
+#   command   u8   SEND, DELIVER, DECLARE, CONTROL, QUIT, BATCH or TRACE
+#   delivery  u8   0 = 'all', 1 = 'one', plus JSON_PAYLOAD when the payload is a JSON document
+#   topic     u16  alias declared earlier on this connection
+#   partition u16  partition of the topic, PARTITION_ANY on SEND lets the broker pick
+#   offset    u64  index within the partition assigned by the broker, 0 on SEND
+#   key_len   u16  length of the correlation id following the header
+#   length    u32  length of the payload following the key
+#
+# SEND / DELIVER payloads are the message itself, the broker never decodes them.
+# Structured messages (a Solve, an Observe) travel as their JSON document with the
+# JSON_PAYLOAD bit set, the receiver decodes it once into a dict.
+# CONTROL payloads are a JSON command (subscribe, ...), so new commands need no
+# new frame type. DECLARE binds a topic alias to the topic name in its payload,
+# each side declares its own aliases the first time it uses a topic.
+# Frames without a topic (CONTROL, QUIT, BATCH) carry NO_TOPIC and declare nothing.
+# BATCH payloads are a run of SEND or DELIVER frames (and their DECLAREs).
+# Frames and newline-JSON lines are at most MAX_FRAME bytes, batches are split
+# around BATCH_BYTES so they stay far below it.
+# TRACE carries the trace marks of a sampled message as a JSON object, it goes
+# right before that message's SEND or DELIVER frame (see metrics.STAGES).
+
+import json, time, struct, asyncio
+
+HEADER = struct.Struct('>BBHHQHI')
+PARTITION_ANY = 0xFFFF
+NO_TOPIC = 0xFFFF # alias of frames without a topic, never declared
+MAX_FRAME = 16 * 1024 * 1024 # longest frame or line a reader accepts, also the StreamReader limit
+BATCH_BYTES = 256 * 1024 # send_batch lines and fetch_batch replies are split around this size
+
+SEND, DELIVER, DECLARE, CONTROL, QUIT, BATCH, TRACE = range(1, 8)
+DELIVERY_CODES = {'all': 0, 'one': 1}
+DELIVERY_NAMES = {code: name for name, code in DELIVERY_CODES.items()}
+JSON_PAYLOAD = 0x80 # delivery bit, the payload is a JSON document rather than text
+
+HELLO = {'command': 'hello', 'framing': 'binary'}
+
+# Envelope as stored in the segment log: delivery (with JSON_PAYLOAD), key, datetime and payload lengths
+RECORD = struct.Struct('>BHHI')
+
+
+def split_by_size(items, size, limit:int=BATCH_BYTES):
+    # Consecutive runs of items of about limit bytes, an item larger than limit goes alone
+    run, run_bytes = list(), 0
+    for item in items:
+        n = size(item)
+        if run and run_bytes + n > limit:
+            yield run
+            run, run_bytes = list(), 0
+        run.append(item)
+        run_bytes += n
+    if run:
+        yield run
+
+
+class Frame:
+    __slots__ = ('command', 'delivery', 'structured', 'topic', 'partition', 'offset', 'key', 'payload', 'trace')
+
+    def __init__(self, command, delivery, topic, partition, offset, key, payload, structured=False, trace=None):
+        self.command = command
+        self.delivery = delivery
+        self.structured = structured # payload is a JSON document
+        self.topic = topic
+        self.partition = None if partition == PARTITION_ANY else partition
+        self.offset = offset
+        self.key = key
+        self.payload = payload
+        self.trace = trace # marks of a sampled message, from the TRACE frame before it
+
+
+class Envelope:
+    # A message inside the broker, whichever framing it arrived with.
+    # Encoded forms are built lazily and shared by every subscriber.
+    # A structured message keeps whichever form it arrived in, the decoded body
+    # (newline-JSON) or its JSON bytes (binary), and derives the other at most once
+    __slots__ = ('topic', 'delivery', 'id', 'datetime', '_payload', '_body', 'structured',
+                 'partition', 'index', 'received_ns', 'trace', '_json')
+
+    def __init__(self, topic:str, delivery:str, payload:bytes=None, id:str='', datetime:str='',
+                 partition:int=None, index:int=0, body=None, structured:bool=False, trace:dict=None):
+        self.topic = topic
+        self.delivery = delivery
+        self._payload = payload
+        self._body = body
+        self.structured = structured or body is not None
+        self.id = id
+        self.datetime = datetime
+        self.partition = partition # None until the broker assigns one
+        self.index = index
+        self.received_ns = time.time_ns() # arrival at the broker, indexed by the bookkeeper
+        self.trace = trace # mark -> monotonic ns, sampled messages only, not kept in the segment log
+        self._json = None
+
+    @property
+    def payload(self) -> bytes:
+        if self._payload is None:
+            self._payload = json.dumps(self._body).encode('utf-8')
+        return self._payload
+
+    @property
+    def body(self):
+        # The message as the receiving client sees it: a dict (or list) when structured, else text
+        if not self.structured:
+            return self._payload.decode('utf-8')
+        if self._body is None:
+            self._body = json.loads(self._payload)
+        return self._body
+
+    @classmethod
+    def from_command(cls, cmd:dict):
+        message = cmd.get('message','')
+        structured = isinstance(message, (dict, list))
+        return cls(
+            topic=cmd['topic'],
+            delivery=cmd['delivery'],
+            payload=None if structured else str(message).encode('utf-8'),
+            body=message if structured else None,
+            id=cmd.get('id',''),
+            datetime=cmd.get('datetime',''),
+            partition=cmd.get('partition'),
+            trace=cmd.get('trace')
+        )
+
+    def _header(self) -> dict:
+        header = {
+            'datetime': self.datetime,
+            'topic': self.topic,
+            'command': 'send',
+            'id': self.id,
+            'delivery': self.delivery,
+            'partition': self.partition,
+            'index': self.index
+        }
+        if self.trace is not None:
+            header['trace'] = self.trace
+        return header
+
+    def as_dict(self) -> dict:
+        line = self._header()
+        line['message'] = self.body
+        return line
+
+    def json_line(self) -> bytes:
+        # A structured payload is spliced in as it is, already being JSON
+        if self._json is None:
+            if self.structured:
+                header = json.dumps(self._header()).encode('utf-8')
+                self._json = b''.join((header[:-1], b', "message": ', self.payload, b'}\n'))
+            else:
+                self._json = (json.dumps(self.as_dict()) + '\n').encode('utf-8')
+        return self._json
+
+    def to_record(self) -> bytes:
+        key = self.id.encode('utf-8')
+        dt = self.datetime.encode('utf-8')
+        payload = self.payload
+        delivery = DELIVERY_CODES[self.delivery] | (JSON_PAYLOAD if self.structured else 0)
+        header = RECORD.pack(delivery, len(key), len(dt), len(payload))
+        return b''.join((header, key, dt, payload))
+
+    @classmethod
+    def from_record(cls, topic:str, partition:int, offset:int, value:bytes):
+        delivery, key_len, dt_len, length = RECORD.unpack_from(value)
+        position = RECORD.size
+        key = bytes(value[position:position+key_len]).decode('utf-8')
+        position += key_len
+        dt = bytes(value[position:position+dt_len]).decode('utf-8')
+        position += dt_len
+        payload = bytes(value[position:position+length])
+        return cls(topic, DELIVERY_NAMES[delivery & ~JSON_PAYLOAD], payload, id=key, datetime=dt,
+                   partition=partition, index=offset, structured=bool(delivery & JSON_PAYLOAD))
+
+
+class FrameCodec:
+    # Per connection state: topic aliases in both directions
+
+    def __init__(self):
+        self.out_topics = dict() # topic name -> alias we declared
+        self.in_topics = dict() # alias the peer declared -> topic name
+        self.in_trace = None # from a TRACE frame, for the next frame
+
+    def encode(self, command:int, topic:str='', payload:bytes=b'', delivery:str='all',
+               offset:int=0, key:str='', partition:int=None, structured:bool=False, trace:dict=None) -> bytes:
+        parts = list()
+        if trace is not None:
+            marks = json.dumps(trace).encode('utf-8')
+            parts.append(HEADER.pack(TRACE, 0, 0, 0, 0, 0, len(marks)))
+            parts.append(marks)
+        alias = self.out_topics.get(topic) if topic else NO_TOPIC
+        if alias is None:
+            alias = self.out_topics[topic] = len(self.out_topics)
+            name = topic.encode('utf-8')
+            parts.append(HEADER.pack(DECLARE, 0, alias, 0, 0, 0, len(name)))
+            parts.append(name)
+        key = key.encode('utf-8')
+        partition = PARTITION_ANY if partition is None else partition
+        delivery = DELIVERY_CODES[delivery] | (JSON_PAYLOAD if structured else 0)
+        parts.append(HEADER.pack(command, delivery, alias, partition,
+                                 offset, len(key), len(payload)))
+        parts.append(key)
+        parts.append(payload)
+        return b''.join(parts)
+
+    def encode_envelope(self, envelope:Envelope) -> bytes:
+        return self.encode(DELIVER, envelope.topic, envelope.payload, envelope.delivery,
+                           envelope.index, envelope.id, envelope.partition, envelope.structured, envelope.trace)
+
+    def encode_send(self, topic:str, payload:bytes, delivery:str, key:str='', partition:int=None,
+                    structured:bool=False, trace:dict=None) -> bytes:
+        return self.encode(SEND, topic, payload, delivery, 0, key, partition, structured, trace)
+
+    def encode_control(self, cmd:dict) -> bytes:
+        return self.encode(CONTROL, payload=json.dumps(cmd).encode('utf-8'))
+
+    def encode_quit(self) -> bytes:
+        return self.encode(QUIT)
+
+    def encode_batch(self, frames:list) -> bytes:
+        # frames are already encoded with this codec, so their aliases are declared inline
+        return self.encode(BATCH, payload=b''.join(frames))
+
+    def _frame(self, command, delivery, alias, partition, offset, key:bytes, payload:bytes):
+        if command == DECLARE:
+            self.in_topics[alias] = payload.decode('utf-8')
+            return None
+        if command == TRACE:
+            self.in_trace = json.loads(payload)
+            return None
+        trace, self.in_trace = self.in_trace, None
+        return Frame(
+            command,
+            DELIVERY_NAMES.get(delivery & ~JSON_PAYLOAD, 'all'),
+            self.in_topics.get(alias, ''),
+            partition,
+            offset,
+            key.decode('utf-8'),
+            payload,
+            bool(delivery & JSON_PAYLOAD),
+            trace
+        )
+
+    def decode(self, data:bytes) -> list:
+        # Frames packed back to back, e.g. the payload of a BATCH frame
+        frames = list()
+        position = 0
+        while position + HEADER.size <= len(data):
+            command, delivery, alias, partition, offset, key_len, length = HEADER.unpack_from(data, position)
+            position += HEADER.size
+            key = data[position:position+key_len]
+            position += key_len
+            payload = data[position:position+length]
+            position += length
+            frame = self._frame(command, delivery, alias, partition, offset, key, payload)
+            if frame is not None:
+                frames.append(frame)
+        return frames
+
+    async def read(self, reader:asyncio.StreamReader):
+        # Returns the next frame other than DECLARE / TRACE, or None once the peer is gone
+        while True:
+            try:
+                header = await reader.readexactly(HEADER.size)
+                command, delivery, alias, partition, offset, key_len, length = HEADER.unpack(header)
+                if length > MAX_FRAME:
+                    raise ValueError(f'Frame of {length} bytes exceeds the {MAX_FRAME} byte limit')
+                key = await reader.readexactly(key_len) if key_len else b''
+                payload = await reader.readexactly(length) if length else b''
+            except asyncio.IncompleteReadError:
+                return None
+            frame = self._frame(command, delivery, alias, partition, offset, key, payload)
+            if frame is not None:
+                return frame
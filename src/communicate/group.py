@@ -0,0 +1,76 @@
+# Partitions and consumer groups
+# - A message's partition is picked by hashing its key (the query id), so every
+#   line of one query lands on the same partition and therefore the same agent
+# - Messages without a key are spread round robin
+# - A consumer group spreads the partitions of a topic over its members,
+#   every message is handled by exactly one member of each group
+# - Members joining or leaving trigger a sticky rebalance: only the partitions of
+#   members that left, or over a member's fair share, move. Those are handed over
+#   starting at the group's committed offset
+
+from zlib import crc32
+from itertools import count
+
+
+def partition_for(key:str, partitions:int, counter:count) -> int:
+    if partitions == 1:
+        return 0
+    if key:
+        return crc32(key.encode('utf-8')) % partitions
+    return next(counter) % partitions
+
+
+class ConsumerGroup:
+    def __init__(self, name:str, topic:str, partitions:int, start_offset:int):
+        self.name = name
+        self.topic = topic
+        self.partitions = partitions
+        self.start_offset = start_offset # where partitions without a committed offset begin
+        self.members = list() # writers, in join order
+        self.assignment = dict() # partition -> writer
+
+    def owner(self, partition:int):
+        return self.assignment.get(partition)
+
+    def join(self, writer) -> dict:
+        if writer not in self.members:
+            self.members.append(writer)
+        return self._rebalance()
+
+    def leave(self, writer) -> dict:
+        if writer in self.members:
+            self.members.remove(writer)
+        return self._rebalance()
+
+    def _rebalance(self) -> dict:
+        # Sticky: every member ends up with partitions // members partitions (the first
+        # partitions % members of them, by current load, with one more), members keep what
+        # they own up to that share and only the partitions of members that left and those
+        # over a share move. Returns the partitions that changed hands
+        previous = self.assignment
+        if not self.members:
+            self.assignment = dict()
+            return dict()
+        owned = {member: list() for member in self.members}
+        for partition in range(self.partitions):
+            owner = previous.get(partition)
+            if owner in owned:
+                owned[owner].append(partition)
+
+        share, extra = divmod(self.partitions, len(self.members))
+        by_load = sorted(self.members, key=lambda member: -len(owned[member])) # stable, join order breaks ties
+        quota = {member: share + (i < extra) for i, member in enumerate(by_load)}
+        free = [partition for partition in range(self.partitions) if previous.get(partition) not in owned]
+        for member in self.members:
+            free.extend(owned[member][quota[member]:])
+            del owned[member][quota[member]:]
+        free.sort(reverse=True)
+        for member in self.members:
+            while len(owned[member]) < quota[member]:
+                owned[member].append(free.pop())
+
+        self.assignment = {partition: member for member, partitions in owned.items() for partition in partitions}
+        return {
+            partition: writer for partition, writer in self.assignment.items()
+            if previous.get(partition) is not writer
+        }
@@ -0,0 +1,134 @@
+# Broker metrics
+# - Counters are plain ints in dicts, histograms are power-of-two buckets,
+#   so recording costs a few integer operations on the hot path
+# - snapshot() gives plain dicts, answered to the 'stats' command and dumped to file
+# - TraceCollector turns the hop timestamps of sampled messages into per-stage histograms
+
+from time import perf_counter_ns, monotonic_ns
+from collections import defaultdict
+
+
+class Histogram:
+    # Microsecond values, bucket i holds values below 2**i (and at least 2**(i-1))
+    BUCKETS = 40
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value:int) -> None:
+        self.buckets[min(value.bit_length(), self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def record_since(self, start_ns:int) -> None:
+        self.record((perf_counter_ns() - start_ns) // 1000)
+
+    def percentile(self, q:float) -> int:
+        # Upper bound of the bucket holding the q-th value, at most max
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(1 << i, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'mean_us': self.total / self.count if self.count else 0.0,
+            'p50_us': self.percentile(0.50),
+            'p95_us': self.percentile(0.95),
+            'p99_us': self.percentile(0.99),
+            'max_us': self.max
+        }
+
+
+# Marks stamped on a sampled query line and carried on to its Solve, monotonic ns.
+# The monotonic clock is shared by the processes of one host only, stages between
+# actors on different hosts are meaningless (negative ones are counted as 0)
+#   sent          client, query() on the line
+#   broker_in     broker, line received                reply_in    broker, Solve received
+#   broker_out    broker, handed to an agent's queue   reply_out   broker, handed to the requester's queue
+#   agent_in      agent, read off its connection       received    client, Solve read by request()
+#   model_start / model_end   agent, scoring of the batch holding the line
+#   agent_out     agent, Solve handed to the client
+STAGES = (
+    ('client_to_broker', 'sent', 'broker_in'), # client batching and the network
+    ('broker_queue', 'broker_in', 'broker_out'), # dispatch, segment log, backlog waiting for credits
+    ('broker_to_agent', 'broker_out', 'agent_in'), # outbound queue and the network
+    ('agent_batching', 'agent_in', 'model_start'), # waiting for a batch and a worker
+    ('model', 'model_start', 'model_end'), # prediction cache and model
+    ('agent_writer', 'model_end', 'agent_out'), # in order behind earlier batches
+    ('agent_to_broker', 'agent_out', 'reply_in'),
+    ('solve_fan_out', 'reply_in', 'reply_out'),
+    ('broker_to_client', 'reply_out', 'received'),
+    ('end_to_end', 'sent', 'received'),
+)
+# Recorded by the bookkeeper when the line is written, not carried on
+LOGGED = {'broker_in': 'query_logging', 'reply_in': 'solve_logging'}
+
+
+class TraceCollector:
+    # Per-stage histograms of sampled messages, each side records the stages it has both marks of:
+    # the broker up to agent_to_broker and the logging, the requesting client all but the logging
+    def __init__(self):
+        self.stages = {name: Histogram() for name, _, _ in STAGES}
+        self.stages.update((name, Histogram()) for name in LOGGED.values())
+
+    def record(self, trace:dict) -> None:
+        for name, start, end in STAGES:
+            if start in trace and end in trace:
+                self.stages[name].record(max(0, trace[end] - trace[start]) // 1000)
+
+    def record_logged(self, trace:dict) -> None:
+        # The reply's stage when it has one, the trace of a Solve holds its query's marks too
+        mark = 'reply_in' if 'reply_in' in trace else 'broker_in'
+        if mark in trace:
+            self.stages[LOGGED[mark]].record(max(0, monotonic_ns() - trace[mark]) // 1000)
+
+    def snapshot(self) -> dict:
+        return {name: histogram.snapshot() for name, histogram in self.stages.items() if histogram.count}
+
+
+class BrokerMetrics:
+    def __init__(self):
+        self.topics = defaultdict(lambda: defaultdict(int)) # topic -> messages/bytes in/out
+        self.replay = defaultdict(int) # records scanned, delivered and skipped by replays
+        self.deliveries = defaultdict(int) # delivery='one' messages acked, redelivered, made pending, dropped, expired
+        self.coalesced = defaultdict(int) # query lines that joined one in flight, answered, expired
+        self.send_latency = Histogram() # handle_send, from arrival to stored
+        self.send_batch_latency = Histogram()
+        self.traces = TraceCollector() # sampled messages, also fed by the bookkeeper's thread
+
+    def received(self, topic:str, size:int) -> None:
+        counters = self.topics[topic]
+        counters['messages_in'] += 1
+        counters['bytes_in'] += size
+
+    def sent(self, topic:str, size:int, receivers:int) -> None:
+        counters = self.topics[topic]
+        counters['messages_out'] += receivers
+        counters['bytes_out'] += size * receivers
+
+    def snapshot(self) -> dict:
+        replay = dict(self.replay)
+        scanned = replay.get('scanned', 0)
+        replay['hit_rate'] = replay.get('delivered', 0) / scanned if scanned else 0.0
+        return {
+            'topics': {topic: dict(counters) for topic, counters in self.topics.items()},
+            'replay': replay,
+            'deliveries': dict(self.deliveries),
+            'coalesced': dict(self.coalesced),
+            'send_latency': self.send_latency.snapshot(),
+            'send_batch_latency': self.send_batch_latency.snapshot(),
+            'traces': self.traces.snapshot()
+        }
@@ -12,28 +12,143 @@
 # Run Server
 # Handle Client
 
-import sys, asyncio, random, ast, re, json
+import os, sys, time, asyncio, random, ast, re, json
+from time import perf_counter_ns, monotonic_ns
+from zlib import crc32
+from uuid import uuid4
 from socket import socket
 from collections import defaultdict, deque
 from datetime import datetime
-from src.communicate.stub import BaseModel, Subscribe, Send, Query, Solve, Observe
+from itertools import count
+from urllib.parse import quote, unquote
+from src.communicate.stub import BaseModel, Subscribe, Unsubscribe, FetchBatch, Commit, Ack, Shards, Stats, Query, Solve, Observe
 from src.data.store import Bookkeeper
+from src.data.segment import SegmentLog
+from src.communicate.outbound import Outbound
+from src.communicate.frame import Envelope, FrameCodec, HELLO, SEND, CONTROL, QUIT, BATCH, MAX_FRAME, split_by_size
+from src.communicate.group import ConsumerGroup, partition_for
+from src.communicate.subscribers import Subscribers
+from src.communicate.metrics import BrokerMetrics, TraceCollector
+from src.communicate.transport import LOCAL_BROKERS, LocalConnection, LocalOutbound, default_unix_path
+from src.communicate.shm import ShmOffer, accept as accept_shm, is_local
 
 class MessageQueue:
-    CACHE_LENGTH = 100
+    SEGMENT_BYTES = 16 * 1024 * 1024
+    RETENTION_BYTES = 1024 * 1024 * 1024 # per topic
+    RETENTION_SECONDS = 7 * 24 * 60 * 60
+    FLUSH_INTERVAL = 0.1 # seconds between segment log flushes
+    HOUSEKEEPING_INTERVAL = 1.0 # seconds between retention checks and delivery checkpoints
+    CHECKPOINT_GROUP = '' # committed offsets of plain subscribers: every delivery='one' record below is handled
+    DELIVERY_ONE = 0x01 # record attribute for delivery='one'
+    ROUTED = 0x02 # record attribute for replies routed to one requester, never replayed
+    COALESCED = 0x04 # record attribute for query lines answered by an identical one in flight, never replayed
+    REPLY_TIMEOUT = 30.0 # seconds a reply route outlives its last request
+    STATS_INTERVAL = 10.0 # seconds between dumps to stats_file
+    VISIBILITY_TIMEOUT = 30.0 # seconds a delivery='one' message waits for its ack before going elsewhere
+    MAX_DELIVERIES = 5 # deliveries of an unacked message before it is dropped
+    REDELIVERY_INTERVAL = 0.1 # seconds between checks for expired deliveries
+    UNLIMITED = 1 << 30 # free credits of a subscriber that set no prefetch window
+    OFFSETS_COMPACT = 10000 # commits appended before the offsets log is rewritten as a snapshot
 
-    def __init__(self, host, port, cache_folder):
+    def __init__(self, host, port, cache_folder,
+                 segment_bytes=None, retention_bytes=None, retention_seconds=None,
+                 high_watermark=None, low_watermark=None, slow_consumer='pause',
+                 reply_topics=('solve', 'replay_solve'), reply_timeout=None,
+                 partitions=None, default_partitions=1, shard_ports=None,
+                 stats_file=None, stats_interval=None, visibility_timeout=None, max_deliveries=None,
+                 coalesce_topics=(), unix_path=None,
+                 log_flush_interval=None, log_fsync='never', log_overflow='block'):
         # lambda function generates a value for missing keys
         self.host = host
         self.port = port
-        self.topics = defaultdict(list)
-        self.caches = defaultdict(lambda: deque(maxlen=self.CACHE_LENGTH)) # cache for each topic
-        self.indexs = defaultdict(int) # defaults to 0
-        self.topics_reverse = defaultdict(list)
-        self.query_subscribers = defaultdict(list) # query_id -> list of writers
-        
+        self.now  = lambda: datetime.now().strftime("%d/%m/%Y, %H:%M:%S")
+        self.topics = defaultdict(Subscribers) # topic -> subscribed writers, O(1) add / remove / pick
+        self.indexs = defaultdict(int) # (topic, partition) -> next offset, defaults to 0
+        self.topics_reverse = defaultdict(set) # writer -> topics it subscribed to
+
+        # Topics are split into partitions, each with its own log and offsets.
+        # Consumer groups share a topic's partitions and commit their progress
+        self.partition_counts = dict(partitions or {}) # topic -> number of partitions
+        self.default_partitions = default_partitions
+        self.round_robin = count() # partitions for messages without a key
+        self.groups = defaultdict(dict) # topic -> group name -> ConsumerGroup
+        self.group_members = defaultdict(list) # writer -> groups it joined
+        self.committed = dict() # (group, topic, partition) -> next offset to read
+        self.offset_commits = 0 # records in the offsets log, compacted once they outgrow committed
+
+        # When running as one shard of a multi-process broker, every shard
+        # answers the 'shards' command with the ports of all shards
+        self.shard_ports = list(shard_ports or [port])
+
+        # Request/reply routing: a send carrying an id registers its sender,
+        # replies with that id on a reply topic go back to that sender only
+        self.reply_topics = set(reply_topics)
+        self.reply_timeout = reply_timeout or self.REPLY_TIMEOUT
+        self.query_subscribers = dict() # query_id -> [writer, replies outstanding, deadline]
+        self.query_expiry = deque() # (deadline, query_id) in registration order
+
+        # At-least-once delivery='one' to plain subscribers: every delivery waits for an ack,
+        # unacked ones go to another subscriber after visibility_timeout. The timeout is the
+        # same for all, so deadlines come in delivery order and a FIFO is the whole timer
+        # structure, checked by one task instead of a timer per message
+        self.visibility_timeout = visibility_timeout or self.VISIBILITY_TIMEOUT
+        self.max_deliveries = max_deliveries or self.MAX_DELIVERIES
+        self.in_flight = dict() # (topic, partition, offset) -> [envelope, writer, deadline, deliveries]
+        self.in_flight_expiry = deque() # (deadline, key) in delivery order
+        self.in_flight_by_writer = defaultdict(set) # writer -> keys, redelivered at once on disconnect
+
+        # Credit-based dispatch of those messages: a subscriber may advertise a prefetch window,
+        # its acks give the credits back. A message goes to the less loaded of two random subscribers
+        # with free credits, and waits in the topic's backlog while none has any
+        self.prefetch = dict() # (topic, writer) -> prefetch window, absent means unlimited
+        self.outstanding = defaultdict(int) # (topic, writer) -> messages delivered and not acked
+        self.ready = defaultdict(Subscribers) # topic -> subscribers with free credits
+        self.backlog = defaultdict(deque) # topic -> envelopes waiting for credits, oldest first
+
+        # Singleflight on coalesce_topics (opt-in): a delivery='one' query line identical to one
+        # in flight (same target, choice type and choices, any id) is not dispatched, it waits
+        # for that line's Solve, which is copied to it with its own id and line
+        self.coalesce_topics = set(coalesce_topics)
+        self.flights = dict() # (topic, line without its id) -> [leader correlation id, followers, deadline]
+        self.flight_keys = defaultdict(list) # leader correlation id -> keys of its lines in flight
+        self.flight_expiry = deque() # (deadline, key) in dispatch order
+
+        # Each topic is backed by an append-only segment log on disk,
+        # so subscribers can replay from any retained offset after a restart
+        self.segment_bytes = segment_bytes or self.SEGMENT_BYTES
+        self.retention_bytes = retention_bytes or self.RETENTION_BYTES
+        self.retention_seconds = retention_seconds or self.RETENTION_SECONDS
+        self.logs = dict() # (topic, partition) -> SegmentLog
+        self.pending = defaultdict(set) # (topic, partition) -> offsets of 'one' messages not yet delivered
+
+        # Every connection gets its own bounded outbound queue and writer task,
+        # so a slow subscriber only ever holds up itself
+        self.connections = dict() # writer -> Outbound
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.slow_consumer = slow_consumer # 'pause', 'disconnect' or 'drop_oldest' (lossy, see outbound.py)
+
+        # Counters and histograms, read with the 'stats' command and
+        # written to stats_file every stats_interval seconds if given
+        self.metrics = BrokerMetrics()
+        self.started = time.time()
+        self.stats_file = stats_file
+        self.stats_interval = stats_interval or self.STATS_INTERVAL
+
+        # Co-located actors may skip TCP: a Unix socket listener next to the TCP port,
+        # and in-process clients (transport='local') that reach the broker by host and port
+        self.unix_path = unix_path
+        self.listening = asyncio.Event() # set once _run has bound its listeners, start_server raises before
+
         self.cache_folder = cache_folder
-        self.bookkeeper = Bookkeeper(cache_folder)
+        self.log_folder = os.path.join(cache_folder, 'segments')
+        self.offsets_log = SegmentLog(os.path.join(cache_folder, 'offsets'))
+        # Text logs for analysis, group committed: see src/data/store.py for the settings
+        self.bookkeeper = Bookkeeper(cache_folder, flush_interval=log_flush_interval, fsync=log_fsync,
+                                     overflow=log_overflow, traces=self.metrics.traces)
+        self._open_logs()
+        self._load_offsets()
+        self._rebuild_pending()
 
     async def __aenter__(self):
         await self._run()
@@ -71,78 +186,775 @@ class MessageQueue:
         except Exception as e:
             print(f'Error in _sanitize_decode: {e}')
 
-    def _send_cached(self, writer:asyncio.StreamWriter, topic:str, last_seen:int) -> None:
-        for cmd in self.caches[topic]:
-            if cmd['index'] > last_seen:
-                writer.write(self._sanitize_encode(cmd))
+    def _open_logs(self) -> None:
+        # segments/<topic>/<partition>/
+        os.makedirs(self.log_folder, exist_ok=True)
+        for name in os.listdir(self.log_folder):
+            topic_folder = os.path.join(self.log_folder, name)
+            if not os.path.isdir(topic_folder):
+                continue
+            topic = unquote(name)
+            partitions = [int(p) for p in os.listdir(topic_folder) if p.isdigit()]
+            if partitions:
+                self.partition_counts[topic] = max(self._partitions(topic), max(partitions) + 1)
+            for partition in partitions:
+                self._topic_log(topic, partition)
 
-        new_cache = deque(maxlen=self.CACHE_LENGTH)
-        for cmd in self.caches[topic]:
-            if cmd['index'] <= last_seen:
-                new_cache.append(cmd)
-            else:
-                if cmd['delivery'] == 'all':
-                    new_cache.append(cmd)
-        self.caches[topic] = new_cache
+    def _load_offsets(self) -> None:
+        # committed offsets are a log of their own, the latest commit wins
+        for _, _, _, value in self.offsets_log.read():
+            commit = json.loads(bytes(value))
+            self.committed[(commit['group'], commit['topic'], commit['partition'])] = commit['offset']
+            self.offset_commits += 1
+        self._maybe_compact_offsets()
+
+    def _rebuild_pending(self) -> None:
+        # delivery='one' records from the last checkpoint on may not have been handled before
+        # the restart, they are pending again (at least once: a few may be delivered twice)
+        for (topic, partition), log in self.logs.items():
+            start = self.committed.get((self.CHECKPOINT_GROUP, topic, partition), log.start_offset)
+            pending = self.pending[(topic, partition)]
+            for offset, _, attributes, _ in log.read(start):
+                if attributes & self.DELIVERY_ONE:
+                    pending.add(offset)
+
+    def _undelivered(self) -> dict:
+        # (topic, partition) -> oldest delivery='one' offset plain subscribers still owe:
+        # pending, waiting in the backlog, or delivered and not acked yet
+        oldest = dict()
+        def see(key, offset):
+            if offset < oldest.get(key, offset + 1):
+                oldest[key] = offset
+        for key, offsets in self.pending.items():
+            if offsets:
+                see(key, min(offsets))
+        for topic, partition, offset in self.in_flight:
+            see((topic, partition), offset)
+        for topic, envelopes in self.backlog.items():
+            for envelope in envelopes:
+                see((topic, envelope.partition), envelope.index)
+        return oldest
+
+    def _checkpoint(self) -> None:
+        # Commits each partition's oldest undelivered offset for CHECKPOINT_GROUP, where
+        # _rebuild_pending starts after a restart. Unchanged partitions are not written again
+        undelivered = self._undelivered()
+        commits = list()
+        for key in self.logs:
+            offset = undelivered.get(key, self.indexs[key])
+            if self.committed.get((self.CHECKPOINT_GROUP, *key)) != offset:
+                commits.append((self.CHECKPOINT_GROUP, *key, offset))
+        self._append_commits(commits)
+
+    def _append_commits(self, commits:list) -> None:
+        # (group, topic, partition, next offset) tuples, the latest commit wins on load
+        records = list()
+        for group, topic, partition, offset in commits:
+            self.committed[(group, topic, partition)] = offset
+            commit = {'group': group, 'topic': topic, 'partition': partition, 'offset': offset}
+            records.append((json.dumps(commit).encode('utf-8'), 0))
+        if records:
+            self.offsets_log.append_batch(records)
+            self.offset_commits += len(records)
+            self._maybe_compact_offsets()
+
+    def _enforce_retention(self) -> None:
+        # Pending offsets whose records are gone are dropped, a subscriber would scan for them from the start
+        for key, log in self.logs.items():
+            log.enforce_retention()
+            pending = self.pending.get(key)
+            if pending and min(pending) < log.start_offset:
+                expired = [offset for offset in pending if offset < log.start_offset]
+                pending.difference_update(expired) # in place, a replay may be holding the set
+                self.metrics.deliveries['expired'] += len(expired)
 
-    async def _store(self, line) -> None:
+    def _maybe_compact_offsets(self) -> None:
+        if self.offset_commits >= max(self.OFFSETS_COMPACT, 2 * len(self.committed)):
+            self._compact_offsets()
+
+    def _compact_offsets(self) -> None:
+        # Snapshot the latest commit per (group, topic, partition) into a fresh segment,
+        # then drop the older ones. A crash in between replays old commits before the
+        # snapshot, so the latest commit still wins
+        log = self.offsets_log
+        log.roll()
+        records = [
+            (json.dumps({'group': group, 'topic': topic, 'partition': partition, 'offset': offset}).encode('utf-8'), 0)
+            for (group, topic, partition), offset in self.committed.items()
+        ]
+        if records:
+            log.append_batch(records)
+        log.flush()
+        log.delete_before(log.active.base_offset)
+        self.offset_commits = len(records)
+
+    def _partitions(self, topic:str) -> int:
+        return self.partition_counts.get(topic, self.default_partitions)
+
+    def _topic_log(self, topic:str, partition:int=0) -> SegmentLog:
+        key = (topic, partition)
+        if key not in self.logs:
+            # topic names come from clients, keep them inside the log folder
+            name = quote(topic, safe='').replace('.', '%2E')
+            log = SegmentLog(
+                os.path.join(self.log_folder, name, str(partition)),
+                segment_bytes=self.segment_bytes,
+                retention_bytes=self.retention_bytes,
+                retention_seconds=self.retention_seconds
+            )
+            self.logs[key] = log
+            self.indexs[key] = log.next_offset # resume numbering after a restart
+        return self.logs[key]
+
+    async def _flush_logs(self) -> None:
+        # Retention and the delivery checkpoint run every HOUSEKEEPING_INTERVAL, before a flush
+        loop = asyncio.get_running_loop()
+        housekeeping = loop.time() + self.HOUSEKEEPING_INTERVAL
+        while True:
+            await asyncio.sleep(self.FLUSH_INTERVAL)
+            if loop.time() >= housekeeping:
+                housekeeping = loop.time() + self.HOUSEKEEPING_INTERVAL
+                self._enforce_retention()
+                self._checkpoint()
+            for log in self.logs.values():
+                log.flush()
+            self.offsets_log.flush()
+
+    def stats(self) -> dict:
+        snapshot = self.metrics.snapshot()
+        snapshot['port'] = self.port
+        snapshot['uptime_s'] = time.time() - self.started
+        snapshot['connections'] = {
+            str(writer.get_extra_info('peername') or f'unix:{id(writer):x}'): outbound.snapshot()
+            for writer, outbound in self.connections.items()
+        }
+        snapshot['subscribers'] = {topic: len(writers) for topic, writers in self.topics.items()}
+        snapshot['in_flight'] = len(self.in_flight)
+        snapshot['backlog'] = {topic: len(envelopes) for topic, envelopes in self.backlog.items()}
+        snapshot['logs'] = {
+            f'{topic}/{partition}': {'next_offset': log.next_offset, 'bytes': log.size}
+            for (topic, partition), log in self.logs.items()
+        }
+        snapshot['bookkeeper'] = dict(self.bookkeeper.counters)
+        return snapshot
+
+    async def _dump_stats(self) -> None:
+        # written aside and renamed, readers never see a partial file
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            temporary = f'{self.stats_file}.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(self.stats(), f)
+            os.replace(temporary, self.stats_file)
+
+    def _replay(self, topic:str, start_offset:int, partition:int=None):
+        # Read straight from the segment logs, each record is a stored envelope.
+        # Read-only: a group member taking over a partition and fetch_batch get every
+        # record, pending 'one' records stay pending for the next plain subscriber
+        partitions = range(self._partitions(topic)) if partition is None else [partition]
+        replay = self.metrics.replay
+        replay['replays'] += 1
+        for p in partitions:
+            for offset, _, attributes, value in self._topic_log(topic, p).read(start_offset):
+                replay['scanned'] += 1
+                if attributes & (self.ROUTED | self.COALESCED):
+                    replay['skipped'] += 1
+                    continue
+                replay['delivered'] += 1
+                yield Envelope.from_record(topic, p, offset, value)
+
+    def _replay_pending(self, topic:str, last_seen:int=None):
+        # A plain subscriber gets every pending 'one' record (nobody received them yet)
+        # and the 'all' records after last_seen, None for none of them. Each partition is
+        # read from the oldest of those only, and no further than needed without last_seen
+        replay = self.metrics.replay
+        replay['replays'] += 1
+        for p in range(self._partitions(topic)):
+            pending = self.pending[(topic, p)]
+            starts = [min(pending)] if pending else []
+            if last_seen is not None:
+                starts.append(last_seen + 1)
+            if not starts:
+                continue
+            for offset, _, attributes, value in self._topic_log(topic, p).read(min(starts)):
+                replay['scanned'] += 1
+                if attributes & (self.ROUTED | self.COALESCED):
+                    replay['skipped'] += 1
+                    continue
+                if attributes & self.DELIVERY_ONE:
+                    if offset not in pending:
+                        replay['skipped'] += 1
+                        continue
+                    pending.discard(offset)
+                elif last_seen is None or offset <= last_seen:
+                    replay['skipped'] += 1
+                    continue
+                replay['delivered'] += 1
+                yield Envelope.from_record(topic, p, offset, value)
+                if last_seen is None and not pending:
+                    break
+
+    async def _send_cached(self, writer:asyncio.StreamWriter, topic:str, last_seen:int=None) -> None:
+        outbound = self.connections[writer]
+        for envelope in self._replay_pending(topic, last_seen):
+            if outbound.closed:
+                break
+            if envelope.delivery == 'one': # a pending message, waits for its ack like a live one
+                self._track(envelope, writer)
+            await outbound.put(envelope)
+
+    async def _store(self, line:Envelope) -> None:
+        # only enqueues, the bookkeeper writes in the background
         await self.bookkeeper.log_line(line)
 
+    async def _hand_over(self, group:ConsumerGroup, moved:dict) -> None:
+        # New owners continue each partition they received from the group's committed offset
+        for partition, writer in moved.items():
+            start = self.committed.get((group.name, group.topic, partition), group.start_offset)
+            outbound = self.connections.get(writer)
+            if outbound is None:
+                continue
+            for envelope in self._replay(group.topic, start, partition):
+                if outbound.closed:
+                    break
+                await outbound.put(envelope)
+
     async def _cleanup_client(self, writer:asyncio.StreamWriter) -> None:
-        if writer in self.topics_reverse:
-            for topic in self.topics_reverse[writer]:
-                self.topics[topic].remove(writer)
-                # print(f'Removing writer from topic {topic}')
-            del self.topics_reverse[writer]
+        for topic in self.topics_reverse.pop(writer, ()):
+            self._unsubscribe(topic, writer)
+        for key in self.in_flight_by_writer.pop(writer, ()):
+            self._redeliver(key) # no reason to wait for the timeout
+        outbound = self.connections.pop(writer, None)
+        if outbound is not None:
+            outbound.stop()
         writer.close()
+        for group in self.group_members.pop(writer, []):
+            await self._hand_over(group, group.leave(writer))
         # print('Client disconnected...')
 
     async def _close(self) -> None:
-        clients = self.topics_reverse.items()
-        if len(clients) >= 0:
-            async for client, topics in clients:
-                await self._cleanup_client(client)
+        for client in list(self.connections):
+            await self._cleanup_client(client)
+        for log in self.logs.values():
+            log.close()
+        self.offsets_log.close()
 
     async def _run(self):
-        server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        servers = [await asyncio.start_server(self.handle_client, self.host, self.port, limit=MAX_FRAME)]
         # self.bookkeeper = AsyncClient(self.host,self.port, protected_directory=self.cache_folder)
         print(f'Listening on {self.host}:{self.port}...')
-        async with server:
-            await server.serve_forever()
-
-    async def handle_send(self, cmd:dict) -> None:
-        cmd['index'] = self.indexs[cmd['topic']]
-        self.indexs[cmd['topic']] += 1
-        if cmd['delivery'] == 'all':
-            writers = self.topics[cmd['topic']]
-            self.caches[cmd['topic']].append(cmd)
+        if self.unix_path:
+            if os.path.exists(self.unix_path):
+                os.unlink(self.unix_path) # left behind by a broker that did not shut down
+            servers.append(await asyncio.start_unix_server(self.handle_client, path=self.unix_path, limit=MAX_FRAME))
+            print(f'Listening on {self.unix_path}...')
+        LOCAL_BROKERS[(self.host, self.port)] = self
+        await self.bookkeeper.start()
+        flusher = asyncio.create_task(self._flush_logs())
+        redeliverer = asyncio.create_task(self._redeliver_expired())
+        dumper = asyncio.create_task(self._dump_stats()) if self.stats_file else None
+        self.listening.set()
+        try:
+            await asyncio.gather(*(server.serve_forever() for server in servers))
+        finally:
+            for server in servers:
+                server.close()
+            if LOCAL_BROKERS.get((self.host, self.port)) is self:
+                del LOCAL_BROKERS[(self.host, self.port)]
+            if self.unix_path and os.path.exists(self.unix_path):
+                os.unlink(self.unix_path)
+            flusher.cancel()
+            redeliverer.cancel()
+            if dumper is not None:
+                dumper.cancel()
+            self.listening.clear()
+            self._checkpoint()
+            for log in self.logs.values():
+                log.flush()
+            self.offsets_log.flush()
+            await self.bookkeeper.close()
+
+    def _register_reply(self, query_id:str, writer:asyncio.StreamWriter) -> None:
+        deadline = asyncio.get_running_loop().time() + self.reply_timeout
+        route = self.query_subscribers.get(query_id)
+        if route is None or route[0] is not writer:
+            route = self.query_subscribers[query_id] = [writer, 0, deadline]
+        route[1] += 1 # one reply per request line
+        route[2] = deadline
+        self.query_expiry.append((deadline, query_id))
+
+    def _route_reply(self, query_id:str):
+        route = self.query_subscribers.get(query_id)
+        if route is None:
+            return None
+        route[1] -= 1
+        if route[1] <= 0: # query complete
+            del self.query_subscribers[query_id]
+        # routes of disconnected clients are not cleaned eagerly, they just expire
+        return [route[0]] if route[0] in self.connections else []
+
+    def _expire_replies(self) -> None:
+        now = asyncio.get_running_loop().time()
+        while self.query_expiry and self.query_expiry[0][0] <= now:
+            _, query_id = self.query_expiry.popleft()
+            route = self.query_subscribers.get(query_id)
+            if route is not None and route[2] <= now: # not refreshed since
+                del self.query_subscribers[query_id]
+        while self.flight_expiry and self.flight_expiry[0][0] <= now:
+            _, key = self.flight_expiry.popleft()
+            flight = self.flights.get(key)
+            if flight is not None and flight[2] <= now: # never answered, its followers time out too
+                self._land(key)
+                self.metrics.coalesced['expired'] += len(flight[1])
+
+    def _coalesce(self, envelope:Envelope, writer:asyncio.StreamWriter) -> bool:
+        # True if the line joined an identical one in flight, else it leads a new flight
+        if envelope.structured or envelope.delivery != 'one' or not envelope.id or writer is None:
+            return False
+        line = envelope.payload.decode('utf-8').rstrip('\n')
+        line_id, _, rest = line.partition('\t')
+        key = (envelope.topic, rest)
+        flight = self.flights.get(key)
+        if flight is None:
+            deadline = asyncio.get_running_loop().time() + self.reply_timeout
+            self.flights[key] = [envelope.id, [], deadline]
+            self.flight_keys[envelope.id].append(key)
+            self.flight_expiry.append((deadline, key))
+            return False
+        flight[1].append((envelope.id, line_id, line))
+        self.metrics.coalesced['followers'] += 1
+        return True
+
+    def _land(self, key:tuple):
+        flight = self.flights.pop(key)
+        keys = self.flight_keys[flight[0]]
+        keys.remove(key)
+        if not keys:
+            del self.flight_keys[flight[0]]
+        return flight
+
+    def _settle_flight(self, envelope:Envelope) -> list:
+        # The Solve of a leading line, copied for each follower with its id and line
+        if not self.flight_keys or envelope.topic not in self.reply_topics or not envelope.structured:
+            return []
+        keys = self.flight_keys.get(envelope.id)
+        if not keys:
+            return []
+        solve = envelope.body # decoded once, the bookkeeper reads the same dict
+        key = (solve.get('origin_topic',''), str(solve.get('origin_string','')).partition('\t')[2])
+        if key not in keys:
+            return []
+        _, followers, _ = self._land(key)
+        self.metrics.coalesced['answered'] += len(followers)
+        return [
+            Envelope(envelope.topic, envelope.delivery, id=correlation_id, datetime=envelope.datetime,
+                     body=dict(solve, id=line_id, origin_string=line))
+            for correlation_id, line_id, line in followers
+        ]
+
+    def _track(self, envelope:Envelope, writer:asyncio.StreamWriter, deliveries:int=1) -> None:
+        key = (envelope.topic, envelope.partition, envelope.index)
+        deadline = asyncio.get_running_loop().time() + self.visibility_timeout
+        self.in_flight[key] = [envelope, writer, deadline, deliveries]
+        self.in_flight_expiry.append((deadline, key))
+        self.in_flight_by_writer[writer].add(key)
+        self.outstanding[(envelope.topic, writer)] += 1
+        if self._free(envelope.topic, writer) <= 0:
+            ready = self.ready.get(envelope.topic)
+            if ready is not None:
+                ready.discard(writer)
+
+    def _untrack(self, key:tuple):
+        entry = self.in_flight.pop(key, None)
+        if entry is not None:
+            writer = entry[1]
+            keys = self.in_flight_by_writer.get(writer)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.in_flight_by_writer[writer]
+            topic = key[0]
+            self.outstanding[(topic, writer)] -= 1
+            if self.outstanding[(topic, writer)] <= 0:
+                del self.outstanding[(topic, writer)]
+            subscribers = self.topics.get(topic)
+            if subscribers is not None and writer in subscribers and self._free(topic, writer) > 0:
+                self.ready[topic].add(writer) # credit given back
+        return entry
+
+    def _free(self, topic:str, writer:asyncio.StreamWriter) -> int:
+        window = self.prefetch.get((topic, writer))
+        return (self.UNLIMITED if window is None else window) - self.outstanding.get((topic, writer), 0)
+
+    def _pick(self, topic:str, exclude:asyncio.StreamWriter=None):
+        # Power of two choices: the less loaded of two random subscribers with credits, O(1) per message.
+        # Load is the unacked count, not the free credits, so a subscriber without a window
+        # (unlimited credits) that stops acking is not preferred forever
+        ready = self.ready.get(topic)
+        if not ready:
+            return None
+        candidates = [writer for writer in ready.pair() if writer is not exclude] or ready.pair()
+        return min(candidates, key=lambda writer: self.outstanding.get((topic, writer), 0))
+
+    def _drain_backlog(self, topic:str) -> None:
+        # Hands waiting messages out while subscribers have credits
+        backlog = self.backlog.get(topic)
+        while backlog:
+            writer = self._pick(topic)
+            if writer is None:
+                break
+            outbound = self.connections.get(writer)
+            if backlog[0].trace is not None:
+                self._trace_out(backlog[0])
+            if outbound is None or not outbound.enqueue(backlog[0]):
+                break # closing, its cleanup hands the messages to the others
+            envelope = backlog.popleft()
+            self._track(envelope, writer)
+            self.metrics.sent(topic, len(envelope.payload), 1)
+            self.metrics.deliveries['from_backlog'] += 1
+        if not backlog:
+            self.backlog.pop(topic, None)
+
+    def _redeliver(self, key:tuple) -> None:
+        # To another subscriber if there is one, else pending for the next to subscribe
+        entry = self._untrack(key)
+        if entry is None:
+            return # acked meanwhile
+        envelope, previous, _, deliveries = entry
+        counters = self.metrics.deliveries
+        if deliveries >= self.max_deliveries:
+            counters['dropped'] += 1
+            return
+        if not self.topics.get(envelope.topic):
+            self.pending[(envelope.topic, envelope.partition)].add(envelope.index)
+            counters['pending'] += 1
+            return
+        writer = self._pick(envelope.topic, exclude=previous)
+        outbound = self.connections.get(writer) if writer is not None else None
+        if outbound is None or not outbound.enqueue(envelope):
+            self.backlog[envelope.topic].appendleft(envelope) # older than anything waiting
+            counters['backlogged'] += 1
+            return
+        self._track(envelope, writer, deliveries + 1)
+        counters['redelivered'] += 1
+
+    async def _redeliver_expired(self) -> None:
+        while True:
+            await asyncio.sleep(self.REDELIVERY_INTERVAL)
+            now = asyncio.get_running_loop().time()
+            expiry = self.in_flight_expiry
+            while expiry and expiry[0][0] <= now:
+                _, key = expiry.popleft()
+                entry = self.in_flight.get(key)
+                if entry is not None and entry[2] <= now: # not acked or redelivered since
+                    self._redeliver(key)
+
+    async def handle_ack(self, cmd:dict) -> None:
+        # acks: {topic: {partition: [offsets handled]}}
+        acked = 0
+        for topic, partitions in cmd.get('acks', {}).items():
+            for partition, offsets in partitions.items():
+                for offset in offsets:
+                    if self._untrack((topic, int(partition), int(offset))) is not None:
+                        acked += 1
+            if topic in self.backlog:
+                self._drain_backlog(topic)
+        self.metrics.deliveries['acked'] += acked
+
+    def _assign(self, envelope:Envelope, writer:asyncio.StreamWriter=None):
+        # Gives the envelope its offset and picks who receives it,
+        # returns the record attributes and the receiving writers
+        topic = envelope.topic
+        partitions = self._partitions(topic)
+        if envelope.partition is None or not 0 <= envelope.partition < partitions:
+            envelope.partition = partition_for(envelope.id, partitions, self.round_robin)
+        key = (topic, envelope.partition)
+        self._topic_log(topic, envelope.partition)
+        envelope.index = self.indexs[key]
+        self.indexs[key] += 1
+        query_id = envelope.id
+        is_reply = topic in self.reply_topics
+
+        if topic in self.coalesce_topics and self._coalesce(envelope, writer):
+            self._register_reply(query_id, writer) # answered by the broker, with the leader's Solve
+            return self.COALESCED, []
+
+        # every consumer group gets the message once, through the owner of its partition
+        groups = self.groups.get(topic)
+        owners = list()
+        if groups:
+            for group in groups.values():
+                owner = group.owner(envelope.partition)
+                if owner is not None:
+                    owners.append(owner)
+
+        writers = self._route_reply(query_id) if query_id and is_reply else None
+        if writers is not None:
+            attributes = self.ROUTED
+        elif envelope.delivery == 'all':
+            subscribers = self.topics.get(topic)
+            writers = [*subscribers, *owners] if subscribers else owners
+            attributes = 0
         else: # if delivery == 'one'
-            if len(self.topics[cmd['topic']]) == 0: # no writers subscribed to topic
+            attributes = self.DELIVERY_ONE
+            subscribers = self.topics.get(topic)
+            if owners:
+                writers = owners
+            elif groups: # members are all gone, they resume from the committed offset
                 writers = []
-                self.caches[cmd['topic']].append(cmd) # if no writers, cache the cmd
-            else: 
-                which = random.randint(0, len(self.topics[cmd['topic']])-1) 
-                writers = [self.topics[cmd['topic']][which]]
-        
-        line = self._sanitize_encode(cmd)
-        for w in writers:
-            try:
-                w.write(line)
-                await w.drain()  # Ensure write completes
-            except (ConnectionError, BrokenPipeError):
-                print(f"Connection lost while sending to {w.get_extra_info('peername')}")
-                await self._cleanup_client(w)
-            except Exception as e:
-                print(f"Unexpected error while sending: {e}")
-                await self._cleanup_client(w)
-        
-        await self._store(line)
+            elif not subscribers: # no writers subscribed to topic
+                writers = []
+                self.pending[key].add(envelope.index) # replayed to the next subscriber
+            else:
+                receiver = None if self.backlog.get(topic) else self._pick(topic) # FIFO behind the backlog
+                if receiver is None:
+                    writers = []
+                    self.backlog[topic].append(envelope)
+                    self.metrics.deliveries['backlogged'] += 1
+                else:
+                    writers = [receiver]
+                    self._track(envelope, receiver)
+
+        if query_id and not is_reply and writer is not None:
+            self._register_reply(query_id, writer)
+        return attributes, writers
+
+    def _trace_in(self, envelope:Envelope) -> None:
+        # A sampled message arriving, a Solve brings the marks of its query line along
+        if envelope.topic in self.reply_topics:
+            envelope.trace['reply_in'] = monotonic_ns()
+            self.metrics.traces.record(envelope.trace)
+        else:
+            envelope.trace['broker_in'] = monotonic_ns()
+
+    def _trace_out(self, envelope:Envelope) -> None:
+        # Before the first encoding, every receiver's copy carries it
+        envelope.trace['reply_out' if envelope.topic in self.reply_topics else 'broker_out'] = monotonic_ns()
+
+    def _fan_out(self, envelope:Envelope, writers) -> list:
+        # fan-out is an enqueue per subscriber, the writer tasks do the draining
+        outbounds = [self.connections[w] for w in writers if w in self.connections]
+        if outbounds and envelope.trace is not None:
+            self._trace_out(envelope)
+        for outbound in outbounds:
+            outbound.enqueue(envelope)
+        self.metrics.sent(envelope.topic, len(envelope.payload), len(outbounds))
+        return outbounds
+
+    async def _wait_writable(self, outbounds) -> None:
+        if self.slow_consumer == 'pause':
+            for outbound in outbounds:
+                await outbound.wait_writable()
+
+    async def handle_send(self, envelope:Envelope, writer:asyncio.StreamWriter=None) -> None:
+        # The payload is never decoded here, each subscriber gets it in its own framing
+        start = perf_counter_ns()
+        if envelope.trace is not None:
+            self._trace_in(envelope)
+        self._expire_replies()
+        self.metrics.received(envelope.topic, len(envelope.payload))
+        attributes, writers = self._assign(envelope, writer)
+        self._topic_log(envelope.topic, envelope.partition).append(envelope.to_record(), attributes)
+        outbounds = self._fan_out(envelope, writers)
+        await self._wait_writable(outbounds)
+        await self._store(envelope)
+        self.metrics.send_latency.record_since(start)
+        followers = self._settle_flight(envelope)
+        if followers:
+            await self.handle_send_batch(followers)
+
+    async def handle_send_batch(self, envelopes:list, writer:asyncio.StreamWriter=None) -> None:
+        # Contiguous offsets per topic, one segment log write per topic
+        start = perf_counter_ns()
+        self._expire_replies()
+        records = defaultdict(list)
+        outbounds = dict() # ordered set, each slow consumer is waited on once
+        for envelope in envelopes:
+            if envelope.trace is not None:
+                self._trace_in(envelope)
+            self.metrics.received(envelope.topic, len(envelope.payload))
+            attributes, writers = self._assign(envelope, writer)
+            records[(envelope.topic, envelope.partition)].append((envelope.to_record(), attributes))
+            outbounds.update(dict.fromkeys(self._fan_out(envelope, writers)))
+        for (topic, partition), items in records.items():
+            self._topic_log(topic, partition).append_batch(items)
+        await self._wait_writable(outbounds)
+        for envelope in envelopes:
+            await self._store(envelope)
+        self.metrics.send_batch_latency.record_since(start)
+        followers = [follower for envelope in envelopes for follower in self._settle_flight(envelope)]
+        if followers:
+            await self.handle_send_batch(followers)
+
+    async def handle_fetch(self, cmd:dict, writer:asyncio.StreamWriter) -> None:
+        # Pull read: up to max_messages in all, each partition from its own offset
+        # (offsets: {topic: {partition: first offset}}). Read-only, delivery='one'
+        # records are copies here, they stay pending for the next subscriber
+        max_messages = int(cmd.get('max_messages', 1000))
+        envelopes = list()
+        for topic, partitions in cmd.get('offsets', {}).items():
+            for partition, offset in partitions.items():
+                partition = int(partition)
+                if len(envelopes) >= max_messages:
+                    break
+                if not 0 <= partition < self._partitions(topic):
+                    continue
+                for envelope in self._replay(topic, int(offset), partition):
+                    envelopes.append(envelope)
+                    if len(envelopes) >= max_messages:
+                        break
+        # a reply per run of about BATCH_BYTES, the header fields counted roughly on top of the payload
+        outbound = self.connections[writer]
+        for run in list(split_by_size(envelopes, lambda envelope: len(envelope.payload) + 128)) or [[]]:
+            await outbound.put(outbound.batch(run))
         
     async def handle_subscribe(self, cmd: dict, writer:asyncio.StreamWriter) -> None:
-        self.topics[cmd['topic']].append(writer)
-        self.topics_reverse[writer].append(cmd['topic'])
-        last_seen = int(cmd['last_seen'])
-        self._send_cached(writer, cmd['topic'],last_seen)
+        # last_seen: offset of the last message seen, replayed after it, None subscribes from now
+        last_seen = None if cmd.get('last_seen') is None else int(cmd['last_seen'])
+        if cmd.get('group'):
+            await self.handle_join(cmd['topic'], cmd['group'], writer, None if last_seen is None else last_seen + 1)
+            return
+        topic = cmd['topic']
+        prefetch = int(cmd.get('prefetch') or 0)
+        if prefetch:
+            self.prefetch[(topic, writer)] = prefetch
+        else:
+            self.prefetch.pop((topic, writer), None)
+        subscribed = self.topics[topic].add(writer)
+        if self._free(topic, writer) > 0:
+            self.ready[topic].add(writer)
+        else:
+            self.ready[topic].discard(writer)
+        if subscribed: # else the live messages keep coming, no replay or duplicates
+            self.topics_reverse[writer].add(topic)
+            await self._send_cached(writer, topic, last_seen)
+        self._drain_backlog(topic)
+
+    def _unsubscribe(self, topic:str, writer:asyncio.StreamWriter) -> None:
+        subscribers = self.topics.get(topic)
+        if subscribers is not None and subscribers.discard(writer) and not subscribers:
+            del self.topics[topic] # topics come and go with their subscribers
+        self.prefetch.pop((topic, writer), None)
+        ready = self.ready.get(topic)
+        if ready is not None and ready.discard(writer) and not ready:
+            del self.ready[topic]
+
+    async def handle_unsubscribe(self, cmd:dict, writer:asyncio.StreamWriter) -> None:
+        # Without a group, stops plain deliveries of the topic,
+        # with one, leaves the group and its partitions move to the remaining members
+        topic = cmd['topic']
+        if cmd.get('group'):
+            group = self.groups.get(topic, {}).get(cmd['group'])
+            members = self.group_members.get(writer, [])
+            if group is not None and group in members:
+                members.remove(group)
+                await self._hand_over(group, group.leave(writer))
+            return
+        self._unsubscribe(topic, writer)
+        topics = self.topics_reverse.get(writer)
+        if topics is not None:
+            topics.discard(topic)
+            if not topics:
+                del self.topics_reverse[writer]
+
+    async def handle_join(self, topic:str, name:str, writer:asyncio.StreamWriter, start_offset:int=None) -> None:
+        groups = self.groups[topic]
+        if name not in groups:
+            partitions = self._partitions(topic)
+            groups[name] = ConsumerGroup(name, topic, partitions, start_offset or 0)
+            if start_offset is None: # from now: partitions without a committed offset begin at their end
+                for partition in range(partitions):
+                    self._topic_log(topic, partition)
+                    self.committed.setdefault((name, topic, partition), self.indexs[(topic, partition)])
+        group = groups[name]
+        if group not in self.group_members[writer]:
+            self.group_members[writer].append(group)
+        await self._hand_over(group, group.join(writer))
+
+    async def handle_commit(self, cmd:dict) -> None:
+        # offsets: {topic: {partition: next offset to read}}
+        self._append_commits([
+            (cmd['group'], topic, int(partition), int(offset))
+            for topic, partitions in cmd.get('offsets', {}).items()
+            for partition, offset in partitions.items()
+        ])
+
+    async def handle_command(self, cmd:dict, writer:asyncio.StreamWriter) -> None:
+        if cmd['command'] == 'subscribe':
+            await self.handle_subscribe(cmd, writer)
+        elif cmd['command'] == 'unsubscribe':
+            await self.handle_unsubscribe(cmd, writer)
+        elif cmd['command'] == 'send':
+            await self.handle_send(Envelope.from_command(cmd), writer)
+        elif cmd['command'] == 'send_batch':
+            envelopes = [Envelope.from_command(message) for message in cmd.get('messages', [])]
+            await self.handle_send_batch(envelopes, writer)
+        elif cmd['command'] == 'fetch_batch':
+            await self.handle_fetch(cmd, writer)
+        elif cmd['command'] == 'commit':
+            await self.handle_commit(cmd)
+        elif cmd['command'] == 'ack':
+            await self.handle_ack(cmd)
+        elif cmd['command'] == 'shards':
+            outbound = self.connections[writer]
+            outbound.enqueue(outbound.control({'command': 'shards', 'host': self.host, 'ports': self.shard_ports}))
+        elif cmd['command'] == 'stats':
+            outbound = self.connections[writer]
+            outbound.enqueue(outbound.control({'command': 'stats', 'stats': self.stats()}))
+
+    async def handle_frames(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        # Binary framing: SEND frames are routed without touching their payload,
+        # everything else arrives as a JSON command in a CONTROL frame
+        codec = self.connections[writer].codec
+        while True:
+            frame = await codec.read(reader)
+            if frame is None or frame.command == QUIT:
+                break
+            if frame.command == SEND:
+                envelope = Envelope(frame.topic, frame.delivery, frame.payload, id=frame.key, datetime=self.now(),
+                                    partition=frame.partition, structured=frame.structured, trace=frame.trace)
+                await self.handle_send(envelope, writer)
+            elif frame.command == BATCH:
+                dt = self.now()
+                envelopes = [
+                    Envelope(f.topic, f.delivery, f.payload, id=f.key, datetime=dt,
+                             partition=f.partition, structured=f.structured, trace=f.trace)
+                    for f in codec.decode(frame.payload) if f.command == SEND
+                ]
+                await self.handle_send_batch(envelopes, writer)
+            elif frame.command == CONTROL:
+                await self.handle_command(json.loads(frame.payload), writer)
+
+    async def handle_shm(self, cmd:dict, reader:asyncio.StreamReader, writer:asyncio.StreamWriter) -> bool:
+        # Moves the connection onto the client's shared-memory rings, see src/communicate/shm.py.
+        # The TCP connection stays open only to notice a client that is gone.
+        # False leaves the client on TCP, so does a peer on another host
+        outbound = self.connections[writer]
+        try:
+            if not is_local(writer.get_extra_info('peername')):
+                raise ValueError('the client is not on this host')
+            channel = accept_shm(cmd)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f'Declined shared memory: {e}')
+            outbound.enqueue(self._sanitize_encode({'command': 'shm', 'ok': False}))
+            return False
+        outbound.enqueue(self._sanitize_encode({'command': 'shm', 'ok': True}))
+        served = asyncio.create_task(self.handle_client(channel, channel))
+        gone = asyncio.create_task(reader.read())
+        await asyncio.wait((served, gone), return_when=asyncio.FIRST_COMPLETED)
+        gone.cancel()
+        channel.close() # ends handle_client if only the TCP connection was closed
+        await served
+        return True
+
+    def connect_local(self) -> LocalConnection:
+        # In-process client connection, see src/communicate/transport.py
+        connection = LocalConnection(self)
+        self.connections[connection] = LocalOutbound(
+            connection, self._cleanup_client,
+            policy=self.slow_consumer
+        )
+        return connection
 
     async def handle_client(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
         # print('New client connected...')
@@ -150,6 +962,12 @@ class MessageQueue:
         #   it subscribes to topics
         #   sends messages to topics
         line = str()
+        self.connections[writer] = Outbound(
+            writer, self._cleanup_client,
+            high_watermark=self.high_watermark,
+            low_watermark=self.low_watermark,
+            policy=self.slow_consumer
+        )
         try:
             while True:
                 line = await reader.readline()
@@ -161,10 +979,15 @@ class MessageQueue:
                     break
                 if cmd is None:
                     continue
-                if cmd['command'] == 'subscribe':
-                    await self.handle_subscribe(cmd, writer)
-                elif cmd['command'] == 'send':
-                    await self.handle_send(cmd)
+                if cmd['command'] == 'shm' and await self.handle_shm(cmd, reader, writer):
+                    break
+                if cmd['command'] == 'hello' and cmd.get('framing') == 'binary':
+                    outbound = self.connections[writer]
+                    outbound.enqueue(self._sanitize_encode(HELLO)) # last newline-JSON line
+                    outbound.use_codec(FrameCodec())
+                    await self.handle_frames(reader, writer)
+                    break
+                await self.handle_command(cmd, writer)
 
         except Exception as e:
             print(e)
@@ -172,15 +995,47 @@ class MessageQueue:
 
 
 class AsyncClient:
-    def __init__(self, host, port, protected_directory=None):
+    REQUEST_TIMEOUT = 30.0
+
+    def __init__(self, host, port, protected_directory=None, framing='json',
+                 linger=0.0, max_batch_size=1, transport='tcp', unix_path=None, trace_sample=0.0, traces=None):
         self.host = host
         self.port = port
         self.reader = None
         self.writer = None
+        self.framing = framing # 'json' (newline-JSON) or 'binary' (length-prefixed frames)
+        self.codec = None
+
+        # 'tcp', 'unix' (the broker's unix_path), 'local' (a broker in this process,
+        # framing does not apply: envelopes and dicts are handed over as they are)
+        # or 'shm' (shared-memory rings to a broker on this host, TCP if they fail)
+        self.transport = transport
+        self.unix_path = unix_path or default_unix_path(port)
+        self.local = None # LocalConnection with transport='local'
+        self.control = None # the TCP writer while reader / writer are a ShmChannel
+
+        # Sends are held back for up to linger seconds, or until max_batch_size of them
+        # are waiting, and then go out as a single send_batch. max_batch_size=1 disables it
+        self.linger = linger
+        self.max_batch_size = max_batch_size
+        self.batch = list()
+        self.linger_handle = None
+        self.commits = defaultdict(lambda: defaultdict(dict)) # group -> topic -> partition -> offset
+        self.acks = defaultdict(lambda: defaultdict(list)) # topic -> partition -> offsets handled
         self.protected_directory = protected_directory
         self.now  = lambda: datetime.now().strftime("%d/%m/%Y, %H:%M:%S")
-        self.subscribed_topics = defaultdict(lambda: 0) # (k,v) (topic name, (last_seen idx, query_id))
-        self.queries = defaultdict(list) # topic, list of query_id
+        self.subscribed_topics = dict() # topic -> last index seen, None before the first message
+        self.client_id = uuid4().hex[:8] # keeps query ids unique across clients
+        self.queries = dict() # correlation id -> solutions still expected
+        self.requests = dict() # correlation id -> [future, solutions still expected, solutions]
+        self.request_ids = count() # the same query may be in flight more than once
+        self.demux = None # reader task dispatching replies to request() futures
+
+        # Latency tracing: a trace_sample share of queries carry hop timestamps to the agents
+        # and back with their Solves, request() turns them into per-stage histograms.
+        # traces may be shared by several clients (ClientPool)
+        self.trace_sample = trace_sample
+        self.traces = traces or TraceCollector()
 
     async def __aenter__(self):
         await self.connect()
@@ -196,8 +1051,22 @@ class AsyncClient:
         
         for attempt in range(max_retries):
             try:
-                self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+                if self.transport == 'local':
+                    broker = LOCAL_BROKERS.get((self.host, self.port))
+                    if broker is None:
+                        raise ConnectionRefusedError(f'No broker on {self.host}:{self.port} in this process')
+                    self.local = broker.connect_local()
+                    self.reader = self.writer = self.local # marks the client as connected
+                    return
+                if self.transport == 'unix':
+                    self.reader, self.writer = await asyncio.open_unix_connection(self.unix_path, limit=MAX_FRAME)
+                else:
+                    self.reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=MAX_FRAME)
                 print(f"Successfully connected to {self.host}:{self.port}")
+                if self.transport == 'shm':
+                    await self._attach_shm()
+                if self.framing == 'binary':
+                    await self._negotiate()
                 return
             except ConnectionError as e:
                 wait_time = retry_delay * (backoff_factor ** attempt)
@@ -209,12 +1078,59 @@ class AsyncClient:
                     print("Max retries reached, giving up")
                     raise
 
+    async def _attach_shm(self):
+        # Offers the broker shared-memory rings, the connection stays on TCP if they cannot be used
+        if not is_local(self.writer.get_extra_info('peername')):
+            print(f'Broker {self.host}:{self.port} is on another host, staying on TCP')
+            return
+        try:
+            offer = ShmOffer()
+        except (OSError, AttributeError) as e: # AttributeError: no os.mkfifo on this platform
+            print(f'Shared memory unavailable, staying on TCP: {e}')
+            return
+        channel = None
+        try:
+            self.writer.write((json.dumps(offer.command()) + '\n').encode('utf-8'))
+            await self.writer.drain()
+            reply = await self.reader.readline()
+            if reply and json.loads(reply).get('ok'):
+                channel = offer.open()
+        finally:
+            offer.unlink() # both sides have them open, the names are not needed anymore
+            if channel is None:
+                offer.discard()
+        if channel is None:
+            print('Broker declined shared memory, staying on TCP')
+            return
+        self.control = self.writer
+        self.reader = self.writer = channel
+
+    async def _negotiate(self):
+        self.writer.write((json.dumps(HELLO) + '\n').encode('utf-8'))
+        await self.writer.drain()
+        reply = await self.reader.readline()
+        if reply and json.loads(reply) == HELLO:
+            self.codec = FrameCodec()
+        else:
+            print('Broker declined binary framing, staying on newline-JSON')
+
     async def _close(self):
-        if self.writer:
-            self.writer.write(b'quit\n')
+        if self.demux is not None:
+            self.demux.cancel()
+        if self.local is not None:
+            await self.flush()
+            await self.local.quit()
+            self.local = self.reader = self.writer = None
+        elif self.writer:
+            await self.flush()
+            self.writer.write(b'quit\n' if self.codec is None else self.codec.encode_quit())
             await self.writer.drain()
             self.writer.close()
             await self.writer.wait_closed()
+            if self.control is not None:
+                self.control.close()
+                await self.control.wait_closed()
+                self.control = None
             del self.writer
             del self.reader
 
@@ -224,6 +1140,73 @@ class AsyncClient:
         out = out.encode('utf8')
         out = out + b'\n'
         return out
+
+    def _encode_command(self, message_object):
+        if self.codec is None:
+            return self._sanitize_encode(message_object)
+        return self.codec.encode_control(message_object.model_dump())
+
+    async def _command(self, message_object):
+        # A command to the broker, written in the connection's framing or handed over in process
+        if self.local is not None:
+            await self.local.command(message_object.model_dump())
+            return
+        self.writer.write(self._encode_command(message_object))
+        await self.writer.drain()
+
+    def _envelope(self, topic, message, delivery, id, trace=None) -> Envelope:
+        # transport='local' sends these as they are, text still becomes bytes for the segment log
+        if isinstance(message, str):
+            return Envelope(topic, delivery, message.encode('utf-8'), id=id, datetime=self.now(), trace=trace)
+        return Envelope(topic, delivery, id=id, datetime=self.now(), body=message, trace=trace)
+
+    def _local_messages(self, item) -> list:
+        # Deliveries of transport='local': envelopes, lists of them (fetch replies) or command dicts
+        if isinstance(item, dict):
+            return [item]
+        envelopes = item if isinstance(item, list) else [item]
+        return [self._received({
+            'datetime': envelope.datetime,
+            'topic': envelope.topic,
+            'command': 'send',
+            'id': envelope.id,
+            'message': envelope.body,
+            'delivery': envelope.delivery,
+            'partition': envelope.partition,
+            'index': envelope.index,
+            'trace': None if envelope.trace is None else dict(envelope.trace) # stamped by the receiver
+        }) for envelope in envelopes]
+
+    def _received(self, message:dict) -> dict:
+        # The broker routes replies by id, so no filtering is needed here,
+        # only the count of outstanding solutions is kept up to date
+        topic = message.get('topic','')
+        if topic in self.subscribed_topics and 'index' in message:
+            # resubscribing continues after the last message seen
+            seen = self.subscribed_topics[topic]
+            self.subscribed_topics[topic] = message['index'] if seen is None else max(seen, message['index'])
+        message_id = message.get('id','')
+        if message_id in self.queries:
+            self.queries[message_id] -= 1
+            if self.queries[message_id] <= 0:
+                del self.queries[message_id]
+        return message
+
+    def _decode_frame(self, frame) -> list:
+        if frame.command == CONTROL:
+            return [json.loads(frame.payload)]
+        if frame.command == BATCH:
+            return [m for f in self.codec.decode(frame.payload) for m in self._decode_frame(f)]
+        return [self._received({
+            'topic': frame.topic,
+            'command': 'send',
+            'id': frame.key,
+            'message': json.loads(frame.payload) if frame.structured else frame.payload.decode('utf-8'),
+            'delivery': frame.delivery,
+            'partition': frame.partition,
+            'index': frame.offset,
+            'trace': frame.trace
+        })]
     
     def _sanitize_decode(self, data_recv):
         """Not static because references self.queries"""
@@ -235,12 +1218,9 @@ class AsyncClient:
 
                     
             message = json.loads(decoded)
-            message_topic, message_id = message.get('topic',''), message.get('id','')
-            if message_id != '' and message_topic != '':
-                if message_id not in self.queries[message_topic]:
-                    return
-            
-            return message
+            if message.get('command') == 'batch':
+                return [self._received(m) for m in message.get('messages', [])]
+            return [self._received(message)]
         except json.JSONDecodeError as e:
             print(f"Invalid JSON received: {decoded}")  # Now decoded is defined
             print(f"JSON Error: {e}")
@@ -264,76 +1244,269 @@ class AsyncClient:
         line = self.serialize_list(in_dict.values()) # Fixed method name and made instance method
         return line
 
-    async def subscribe(self, topic:str):
+    async def subscribe(self, topic:str, group:str='', prefetch:int=0, last_seen:int=None):
+        # with a group, the topic's partitions are shared with the group's other members.
+        # prefetch caps the delivery='one' messages held unacked, 0 for no cap.
+        # last_seen=None starts from now (plus pending delivery='one' messages), or from
+        # the last message seen by an earlier subscription; last_seen=-1 replays the whole log
         if self.writer is None:
             await self.connect()
+        await self.flush() # keep commands in order with batched sends
         
-        last_seen = self.subscribed_topics.get(topic, 1)
+        if last_seen is None:
+            last_seen = self.subscribed_topics.get(topic)
         subscribe = Subscribe(
             datetime=self.now(),
             topic=topic,
-            last_seen=last_seen
+            last_seen=last_seen,
+            group=group,
+            prefetch=prefetch
         )
-        subscribe_bytes = self._sanitize_encode(subscribe)
-        self.writer.write(subscribe_bytes)
-        await self.writer.drain()
+        await self._command(subscribe)
         self.subscribed_topics[topic]=last_seen
 
-    async def send(self, topic, message, delivery):
+    async def unsubscribe(self, topic:str, group:str=''):
+        if self.writer is None:
+            return
+        await self.flush() # commits made so far still reach the group
+        await self._command(Unsubscribe(datetime=self.now(), topic=topic, group=group))
+        self.subscribed_topics.pop(topic, None)
+
+    async def send(self, topic, message, delivery, id='', trace=None):
         if self.writer is None:
             await self.connect()
 
-        send = Send(
-            datetime=self.now(),
-            topic=topic,
-            message=message,
-            delivery=delivery
-        )
+        if self.max_batch_size > 1:
+            self.batch.append((topic, message, delivery, id, trace))
+            if len(self.batch) >= self.max_batch_size:
+                await self.flush()
+            elif self.linger_handle is None:
+                loop = asyncio.get_running_loop()
+                self.linger_handle = loop.call_later(self.linger, self._linger_expired)
+            return
 
-        send_bytes = self._sanitize_encode(send)
+        if self.local is not None:
+            await self.local.send([self._envelope(topic, message, delivery, id, trace)])
+            return
+        if self.codec is not None:
+            # no model round trip, the message goes out as the frame payload
+            send_bytes = self._send_frame(topic, message, delivery, id, trace)
+        else:
+            send_dict = self._send_dict(self.now(), topic, message, delivery, id, trace)
+            send_bytes = (json.dumps(send_dict) + '\n').encode('utf-8')
         self.writer.write(send_bytes)
         await self.writer.drain()
 
+    def _send_frame(self, topic, message, delivery, id, trace=None) -> bytes:
+        # text goes out as it is, a dict as its JSON document flagged for the receiver
+        if isinstance(message, str):
+            return self.codec.encode_send(topic, message.encode('utf-8'), delivery, id, trace=trace)
+        return self.codec.encode_send(topic, json.dumps(message).encode('utf-8'), delivery, id,
+                                      structured=True, trace=trace)
+
+    @staticmethod
+    def _send_dict(dt, topic, message, delivery, id, trace=None) -> dict:
+        # Same fields as stub.Send, built directly: the message was validated where it was
+        # made, a model here would only validate it again and a nested dict is encoded once
+        send = {'datetime': dt, 'topic': topic, 'command': 'send', 'id': id,
+                'message': message, 'delivery': delivery}
+        if trace is not None:
+            send['trace'] = trace
+        return send
+
+    def _linger_expired(self):
+        self.linger_handle = None
+        asyncio.ensure_future(self.flush())
+
+    async def commit(self, message:dict, group:str):
+        # Marks a received message as done for the group, sent along with the next flush
+        partition = message.get('partition') or 0
+        self.commits[group][message['topic']][partition] = message['index'] + 1
+        await self._flush_soon()
+
+    async def ack(self, message:dict):
+        # Marks a delivery='one' message received without a group as handled,
+        # unacked ones are redelivered to another subscriber after the broker's timeout
+        partition = message.get('partition') or 0
+        self.acks[message['topic']][partition].append(message['index'])
+        await self._flush_soon()
+
+    async def _flush_soon(self):
+        if self.max_batch_size > 1:
+            if self.linger_handle is None:
+                loop = asyncio.get_running_loop()
+                self.linger_handle = loop.call_later(self.linger, self._linger_expired)
+        else:
+            await self.flush()
+
+    async def flush(self):
+        # Sends everything batched so far as one send_batch line / frame,
+        # then the offsets committed and acked since the last flush
+        if self.linger_handle is not None:
+            self.linger_handle.cancel()
+            self.linger_handle = None
+        if self.batch:
+            await self._flush_batch()
+        if self.commits:
+            commits, self.commits = self.commits, defaultdict(lambda: defaultdict(dict))
+            for group, offsets in commits.items():
+                await self._command(Commit(datetime=self.now(), group=group, offsets=offsets))
+        if self.acks:
+            acks, self.acks = self.acks, defaultdict(lambda: defaultdict(list))
+            await self._command(Ack(datetime=self.now(), acks=acks))
+
+    async def _flush_batch(self):
+        batch, self.batch = self.batch, list()
+
+        if self.local is not None:
+            await self.local.send([self._envelope(*item) for item in batch])
+            return
+        # one send_batch line / frame per run of about BATCH_BYTES, a reader takes MAX_FRAME at most
+        if self.codec is not None:
+            frames = [self._send_frame(*item) for item in batch]
+            batch_bytes = b''.join(self.codec.encode_batch(run) for run in split_by_size(frames, len))
+        else:
+            # {"datetime", "topic": "", "command": "send_batch", "messages": [send, ...]}, each
+            # send encoded once and the runs joined around them, as Outbound.encode does for batches
+            dt = self.now()
+            messages = [json.dumps(self._send_dict(dt, *item)).encode('utf-8') for item in batch]
+            header = json.dumps({'datetime': dt, 'topic': '', 'command': 'send_batch'}).encode('utf-8')
+            batch_bytes = b''.join(
+                b''.join((header[:-1], b', "messages": [', b', '.join(run), b']}\n'))
+                for run in split_by_size(messages, len)
+            )
+        self.writer.write(batch_bytes)
+        await self.writer.drain()
+
+    async def fetch_batch(self, offsets:dict, max_messages:int=1000):
+        # offsets: {topic: {partition: first offset}}, the reply arrives through receive(), one message at a time
+        if self.writer is None:
+            await self.connect()
+        await self.flush()
+        await self._command(FetchBatch(datetime=self.now(), offsets=offsets, max_messages=max_messages))
+
     async def receive(self):
         if self.reader is None:
             await self.connect()
         
         while True:
             try:
-                data = await self.reader.readline()
-                message = self._sanitize_decode(data)
-                if message is not None:
+                if self.local is not None:
+                    item = await self.local.receive()
+                    if item is None:
+                        break
+                    messages = self._local_messages(item)
+                elif self.codec is not None:
+                    frame = await self.codec.read(self.reader)
+                    if frame is None:
+                        break
+                    messages = self._decode_frame(frame)
+                else:
+                    data = await self.reader.readline()
+                    if not data:
+                        break
+                    messages = self._sanitize_decode(data)
+                for message in messages or []:
                     yield message
             except Exception as e:
                 print(f"Unexpected error: {e}")
                 break
     
-    async def query(self, query:Query):
+    def correlation_id(self, query:Query) -> str:
+        return f'{query.id}@{self.client_id}'
+
+    async def query(self, query:Query, correlation_id=None, delivery='one'):
+        # delivery='one' has a single agent solve each line, 'all' asks every agent
+        correlation_id = correlation_id or self.correlation_id(query)
+        self.queries[correlation_id] = query.count()
+        traced = self.trace_sample and random.random() < self.trace_sample
         for message in query.encode():
             message = self.write_line(message)
             await self.send(
                 topic    = query.topic,
                 message  = message,
-                delivery = 'one'
+                delivery = delivery,
+                id       = correlation_id,
+                trace    = {'sent': monotonic_ns()} if traced else None # one per line, each has its Solve
             )
             # print(message)
-        
-        self.queries[query.topic].append(query.id)
     
-    async def solve(self, solution:Solve):
+    async def stats(self) -> dict:
+        # Broker counters and histograms, read on a connection not also used for receive()
+        if self.writer is None:
+            await self.connect()
+        await self.flush()
+        await self._command(Stats(datetime=self.now()))
+        async for message in self.receive():
+            if message.get('command') == 'stats':
+                return message['stats']
+        raise ConnectionError(f'No stats from {self.host}:{self.port}')
+
+    async def request(self, query:Query, timeout=None, delivery='one', correlation_id=None) -> list:
+        # Sends the query and returns its Solves once all have arrived.
+        # The broker routes replies by correlation id, no subscription needed,
+        # and the dispatcher hands them to the waiting request, so any number
+        # of requests share this connection; receive() is taken over by it.
+        # A given correlation_id must not be in flight twice on this client
+        if self.writer is None:
+            await self.connect()
+        if self.demux is None:
+            self.demux = asyncio.create_task(self._demultiplex())
+
+        correlation_id = correlation_id or f'{self.correlation_id(query)}.{next(self.request_ids)}'
+        future = asyncio.get_running_loop().create_future()
+        self.requests[correlation_id] = [future, query.count(), list()]
+        try:
+            await self.query(query, correlation_id, delivery)
+            return await asyncio.wait_for(future, timeout or self.REQUEST_TIMEOUT)
+        finally:
+            self.requests.pop(correlation_id, None)
+            self.queries.pop(correlation_id, None)
+
+    async def _demultiplex(self):
+        try:
+            async for message in self.receive():
+                request = self.requests.get(message.get('id',''))
+                if request is None:
+                    continue # timed out already, or not a reply
+                future, _, solutions = request
+                trace = message.get('trace')
+                if trace is not None:
+                    trace['received'] = monotonic_ns()
+                    self.traces.record(trace)
+                payload = message['message']
+                solution = (Solve.model_validate(payload) if isinstance(payload, dict)
+                            else Solve.model_validate_json(payload))
+                if any(s.origin_string == solution.origin_string for s in solutions):
+                    continue # a line solved twice after a redelivery
+                solutions.append(solution)
+                request[1] -= 1
+                if request[1] <= 0 and not future.done():
+                    future.set_result(solutions)
+        finally:
+            self.demux = None
+            for future, _, _ in self.requests.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f'Connection to {self.host}:{self.port} closed'))
+
+    async def solve(self, solution:Solve, correlation_id=None, trace=None):
         # id -> query being solved
+        # correlation_id -> id of the query message, so the broker can route the reply
+        # trace -> the query line's trace, carried back to the requester
         # print(solution)
         await self.send(
             topic    = solution.topic, 
-            message  = solution.model_dump_json(round_trip=True),
-            delivery = 'all'
+            message  = solution.model_dump(), # nested, encoded once with the send
+            delivery = 'all',
+            id       = correlation_id or solution.id,
+            trace    = trace
         )
 
     async def observe(self, observation:Observe):
         # id -> query being solved
         await self.send(
             topic    = observation.topic, 
-            message  = observation.model_dump_json(round_trip=True),
+            message  = observation.model_dump(),
             delivery = 'one'
         )
 
@@ -342,3 +1515,130 @@ class AsyncClient:
             return
         
         
+
+
+class ShardedClient(AsyncClient):
+    # Client for a broker split over several processes (see server.py --shards)
+    # - the shard map is asked from the broker it is pointed at
+    # - messages with an id go to the shard owning that id, so a query and its
+    #   solutions meet on the same shard; messages without one go by topic
+    # - subscriptions are made on every shard and received through one stream
+    # Against a single broker the map has one port and this behaves like AsyncClient
+
+    def __init__(self, host, port, protected_directory=None, **kwargs):
+        super().__init__(host, port, protected_directory, **kwargs)
+        kwargs.pop('framing', None) # may change after construction, read from self.framing
+        self.kwargs = kwargs
+        self.clients = list()
+        self.inbox = None
+        self.pumps = list()
+
+    async def connect(self):
+        seed = AsyncClient(self.host, self.port, framing=self.framing, **self.kwargs)
+        await seed.connect()
+        await seed._command(Shards(datetime=self.now()))
+        shards = None
+        async for message in seed.receive():
+            if message.get('command') == 'shards':
+                shards = message
+                break
+        if shards is None:
+            raise ConnectionError(f'No shard map from {self.host}:{self.port}')
+        self.clients = list()
+        for port in shards['ports']:
+            if port == self.port:
+                self.clients.append(seed)
+                continue
+            client = AsyncClient(shards['host'], port, framing=self.framing, **self.kwargs)
+            await client.connect()
+            self.clients.append(client)
+        self.writer, self.reader = seed.writer, seed.reader # marks the client as connected
+
+    async def _close(self):
+        if self.demux is not None:
+            self.demux.cancel()
+        for pump in self.pumps:
+            pump.cancel()
+        for client in self.clients:
+            await client._close()
+        self.clients = list()
+
+    def shard_for(self, topic:str, id:str='') -> AsyncClient:
+        key = id or topic
+        return self.clients[crc32(key.encode('utf-8')) % len(self.clients)]
+
+    async def subscribe(self, topic:str, group:str='', prefetch:int=0, last_seen:int=None):
+        if not self.clients:
+            await self.connect()
+        for client in self.clients:
+            await client.subscribe(topic, group, prefetch, last_seen)
+
+    async def unsubscribe(self, topic:str, group:str=''):
+        for client in self.clients:
+            await client.unsubscribe(topic, group)
+
+    async def send(self, topic, message, delivery, id='', trace=None):
+        if not self.clients:
+            await self.connect()
+        await self.shard_for(topic, id).send(topic, message, delivery, id, trace)
+
+    async def commit(self, message:dict, group:str):
+        await self.clients[message.get('shard', 0)].commit(message, group)
+
+    async def ack(self, message:dict):
+        await self.clients[message.get('shard', 0)].ack(message)
+
+    async def flush(self):
+        for client in self.clients:
+            await client.flush()
+
+    async def fetch_batch(self, offsets:dict, max_messages:int=1000):
+        for client in self.clients:
+            await client.fetch_batch(offsets, max_messages)
+
+    async def stats(self) -> list:
+        # one snapshot per shard
+        if not self.clients:
+            await self.connect()
+        return [await client.stats() for client in self.clients]
+
+    async def _pump(self, shard:int, client:AsyncClient):
+        async for message in client.receive():
+            message['shard'] = shard # commits go back to the shard the message came from
+            await self.inbox.put(message)
+
+    async def receive(self):
+        if not self.clients:
+            await self.connect()
+        if self.inbox is None:
+            self.inbox = asyncio.Queue()
+            self.pumps = [
+                asyncio.create_task(self._pump(shard, client))
+                for shard, client in enumerate(self.clients)
+            ]
+        while True:
+            yield self._received(await self.inbox.get())
+
+
+class ClientPool:
+    # A few shared connections driving many concurrent request() calls,
+    # each request goes to the connection with the fewest in flight
+    SIZE = 4
+
+    def __init__(self, host, port, size=None, client=None, **kwargs):
+        client = client or ShardedClient
+        self.traces = kwargs.setdefault('traces', TraceCollector()) # one for all connections
+        self.clients = [client(host, port, **kwargs) for _ in range(size or self.SIZE)]
+
+    async def __aenter__(self):
+        for client in self.clients:
+            await client.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        for client in self.clients:
+            await client._close()
+
+    async def request(self, query:Query, timeout=None, delivery='one', correlation_id=None) -> list:
+        client = min(self.clients, key=lambda client: len(client.requests))
+        return await client.request(query, timeout, delivery, correlation_id)
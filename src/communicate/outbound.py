@@ -0,0 +1,170 @@
+# Outbound queue for a single broker connection
+# - Fan-out only enqueues messages, a writer task drains them to the socket
+# - Messages are encoded for the connection's framing (newline-JSON or binary frames)
+#   by the writer task as they are written, so a dropped message never takes the
+#   topic DECLARE (or TRACE) another frame relies on with it
+# - Everything queued at once is coalesced into one write and one drain
+# - Bytes queued (and not yet drained) above high_watermark make the consumer slow
+#
+# Slow consumer policies:
+#   'disconnect'   close the connection
+#   'drop_oldest'  discard the oldest queued lines until back under high_watermark,
+#                  routed Solves and control replies included: request() then times out
+#   'pause'        producers wait in wait_writable() until back under low_watermark (default)
+
+import asyncio, json
+from time import perf_counter_ns
+from collections import deque
+from src.communicate.frame import Envelope, FrameCodec, HEADER
+from src.communicate.metrics import Histogram
+
+
+class Outbound:
+    HIGH_WATERMARK = 1024 * 1024
+    LOW_WATERMARK = 256 * 1024
+    POLICIES = ('disconnect', 'drop_oldest', 'pause')
+
+    def __init__(self, writer:asyncio.StreamWriter, on_close,
+                 high_watermark=None, low_watermark=None, policy='pause'):
+        if policy not in self.POLICIES:
+            raise ValueError(f'Unknown slow consumer policy: {policy}')
+        self.writer = writer
+        self.on_close = on_close # coroutine called with the writer once the connection is done
+        self.high_watermark = high_watermark or self.HIGH_WATERMARK
+        self.low_watermark = low_watermark or self.LOW_WATERMARK
+        self.policy = policy
+        self.codec = None # FrameCodec once the connection negotiated binary framing
+
+        self.queue = deque() # (item, size) with size counted against the watermarks
+        self.queued_bytes = 0 # queued plus currently draining
+        self.dropped = 0
+        self.written_bytes = 0
+        self.drain_time = Histogram() # per coalesced write, high values mean a slow reader
+        self.closed = False
+        self.ready = asyncio.Event() # something to write, or closing
+        self.writable = asyncio.Event() # below the watermarks, producers may continue
+        self.writable.set()
+        self.task = asyncio.create_task(self._run())
+
+    def encode(self, item) -> bytes:
+        # Envelopes are encoded per framing, lists of them as one batch, raw bytes go out as they are
+        if isinstance(item, Envelope):
+            return item.json_line() if self.codec is None else self.codec.encode_envelope(item)
+        if isinstance(item, list):
+            if self.codec is None:
+                # the envelopes' own lines, so payloads are not encoded again
+                messages = b', '.join(e.json_line()[:-1] for e in item)
+                return b''.join((b'{"command": "batch", "messages": [', messages, b']}\n'))
+            return self.codec.encode_batch([self.codec.encode_envelope(e) for e in item])
+        return item
+
+    def _size(self, item) -> int:
+        # Encoded size, estimated for binary frames (inline DECLARE / TRACE not counted)
+        if isinstance(item, Envelope):
+            if self.codec is None:
+                return len(item.json_line()) # cached, shared by every subscriber
+            return HEADER.size + len(item.id) + len(item.payload)
+        if isinstance(item, list):
+            return sum(self._size(envelope) for envelope in item)
+        return len(item)
+
+    def batch(self, envelopes:list) -> list:
+        # Many messages in a single line / frame, e.g. a fetch_batch reply
+        return list(envelopes)
+
+    def control(self, cmd:dict) -> bytes:
+        # No topic, so no DECLARE: safe to encode now
+        if self.codec is None:
+            return (json.dumps(cmd) + '\n').encode('utf-8')
+        return self.codec.encode_control(cmd)
+
+    def use_codec(self, codec:FrameCodec) -> None:
+        # Binary framing from now on, what is queued already goes out as newline-JSON
+        self.queue = deque((self.encode(item), size) for item, size in self.queue)
+        self.codec = codec
+
+    def _append(self, item) -> None:
+        size = self._size(item)
+        self.queue.append((item, size))
+        self.queued_bytes += size
+        self.ready.set()
+
+    def enqueue(self, item) -> bool:
+        if self.closed:
+            return False
+        self._append(item)
+        if self.queued_bytes <= self.high_watermark:
+            return True
+
+        if self.policy == 'disconnect':
+            print(f"Disconnecting slow consumer {self.writer.get_extra_info('peername')}")
+            self.close()
+            self.writer.transport.abort() # a stalled drain() would never return otherwise
+            return False
+        if self.policy == 'drop_oldest':
+            while self.queued_bytes > self.high_watermark and len(self.queue) > 1:
+                self.queued_bytes -= self.queue.popleft()[1]
+                self.dropped += 1
+        else: # if policy == 'pause'
+            self.writable.clear()
+        return True
+
+    async def put(self, item) -> None:
+        # Lossless enqueue used for replay, waits for the consumer instead of applying the policy
+        if self.closed:
+            return
+        self._append(item)
+        if self.queued_bytes > self.high_watermark:
+            self.writable.clear()
+            await self.wait_writable()
+
+    def snapshot(self) -> dict:
+        return {
+            'queued_lines': len(self.queue),
+            'queued_bytes': self.queued_bytes,
+            'written_bytes': self.written_bytes,
+            'dropped': self.dropped,
+            'paused': not self.writable.is_set(),
+            'drain_time': self.drain_time.snapshot()
+        }
+
+    async def wait_writable(self) -> None:
+        if not self.writable.is_set():
+            await self.writable.wait()
+
+    def close(self) -> None:
+        self.closed = True
+        self.writable.set() # never leave a producer waiting on a dead connection
+        self.ready.set()
+
+    def stop(self) -> None:
+        self.close()
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+
+    async def _run(self) -> None:
+        try:
+            while not self.closed:
+                if not self.queue:
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                items, self.queue = self.queue, deque()
+                size = sum(item_size for _, item_size in items)
+                data = b''.join([self.encode(item) for item, _ in items])
+                start = perf_counter_ns()
+                self.writer.write(data)
+                await self.writer.drain()
+                self.drain_time.record_since(start)
+                self.written_bytes += len(data)
+                self.queued_bytes -= size
+                if self.queued_bytes <= self.low_watermark:
+                    self.writable.set()
+        except (ConnectionError, BrokenPipeError):
+            print(f"Connection lost while sending to {self.writer.get_extra_info('peername')}")
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            print(f"Unexpected error while sending: {e}")
+        self.close()
+        await self.on_close(self.writer)
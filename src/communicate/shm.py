@@ -0,0 +1,394 @@
+# Shared-memory transport for actors on the broker's host (transport='shm')
+# - The client still opens a TCP connection. It carries the handshake and, once the
+#   rings are in use, only tells either side that the other one is gone
+# - Everything else goes through two single-producer / single-consumer byte rings in
+#   multiprocessing.shared_memory, one per direction. They carry the connection's usual
+#   framing (newline-JSON or length-prefixed binary frames), no syscall per message
+# - Ring header: head (read position, written by the consumer only) and tail (write
+#   position, written by the producer only). Both only grow, so there are no locks
+# - A tail published after the bytes is seen after them only because x86 keeps stores
+#   in order (TSO). Python has no memory fences, so elsewhere (ARM64, e.g. Apple M1)
+#   ShmOffer raises and the connection stays on TCP
+# - A side about to sleep on an empty ring, or on a full one, sets a waiting flag and the
+#   other side writes a byte to its named pipe (FIFO) doorbell. A busy connection rings
+#   none, a short poll covers a wakeup lost to the flag race
+# - Anything failing on the way (no shared memory or FIFOs, a broker on another host)
+#   leaves the connection on TCP. The broker attaches only for loopback peers, and only
+#   mq_ segments and mq_ FIFOs of its own user in the temp folder
+#
+#   client -> {"command": "shm", "rings": [up, down], "doorbells": [broker, client]}
+#   broker <- {"command": "shm", "ok": true}    # then both sides switch to the rings
+
+import os, re, stat, struct, asyncio, platform, tempfile, ipaddress
+from uuid import uuid4
+from collections import deque
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+RING_BYTES = 1024 * 1024 # per direction
+HEADER = 64 # bytes before the ring's data
+HEAD, TAIL, READER_WAITING, WRITER_WAITING, CLOSED, CAPACITY = 0, 8, 16, 17, 18, 24
+U64 = struct.Struct('=Q')
+ORDERED_CPUS = ('x86_64', 'amd64', 'i386', 'i686') # stores become visible in program order
+RING_NAME = re.compile(r'^mq_[0-9a-f]{16}$')
+DOORBELL_NAME = re.compile(r'^mq_([0-9a-f]{16})\.(broker|client)$')
+
+_created = set() # segments created by this process, registered with its resource tracker once
+
+
+class Ring:
+    # One direction of a channel. Each side keeps its own position locally
+    # and reads the other one's from the header
+    __slots__ = ('shm', 'buf', 'capacity', 'head', 'tail')
+
+    def __init__(self, shm:SharedMemory, capacity:int=None):
+        self.shm = shm
+        self.buf = shm.buf
+        if capacity is not None:
+            U64.pack_into(self.buf, CAPACITY, capacity)
+        self.capacity = U64.unpack_from(self.buf, CAPACITY)[0]
+        if not 0 < self.capacity <= shm.size - HEADER:
+            raise ValueError(f'Ring {shm.name} has a bad capacity {self.capacity}')
+        self.head = U64.unpack_from(self.buf, HEAD)[0]
+        self.tail = U64.unpack_from(self.buf, TAIL)[0]
+
+    @classmethod
+    def create(cls, capacity:int=RING_BYTES):
+        shm = SharedMemory(name=f'mq_{uuid4().hex[:16]}', create=True, size=HEADER + capacity)
+        _created.add(shm.name)
+        return cls(shm, capacity)
+
+    @classmethod
+    def attach(cls, name:str):
+        shm = SharedMemory(name=name)
+        if shm.name not in _created:
+            # before 3.13 attaching registers the segment too, and this process's
+            # tracker would unlink it (again) at exit
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        try:
+            return cls(shm)
+        except ValueError:
+            shm.close()
+            raise
+
+    def write(self, data) -> int:
+        # Producer: copies as much of data as fits, returns the byte count
+        head = U64.unpack_from(self.buf, HEAD)[0]
+        n = min(len(data), self.capacity - (self.tail - head))
+        if n <= 0:
+            return 0
+        start = self.tail % self.capacity
+        first = min(n, self.capacity - start)
+        data = memoryview(data)
+        self.buf[HEADER + start:HEADER + start + first] = data[:first]
+        if n > first:
+            self.buf[HEADER:HEADER + n - first] = data[first:n]
+        self.tail += n
+        U64.pack_into(self.buf, TAIL, self.tail) # published after the bytes, on x86 only, see supported()
+        return n
+
+    def read(self) -> bytes:
+        # Consumer: everything written so far
+        tail = U64.unpack_from(self.buf, TAIL)[0]
+        n = tail - self.head
+        if not n:
+            return b''
+        start = self.head % self.capacity
+        first = min(n, self.capacity - start)
+        data = bytes(self.buf[HEADER + start:HEADER + start + first])
+        if n > first:
+            data += bytes(self.buf[HEADER:HEADER + n - first])
+        self.head = tail
+        U64.pack_into(self.buf, HEAD, self.head)
+        return data
+
+    def readable(self) -> bool:
+        return U64.unpack_from(self.buf, TAIL)[0] != self.head
+
+    def close(self) -> None:
+        self.buf = None
+        self.shm.close()
+
+
+def supported() -> bool:
+    return platform.machine().lower() in ORDERED_CPUS
+
+
+def is_local(peername) -> bool:
+    # Loopback TCP peers, and Unix socket peers (no address tuple)
+    if not isinstance(peername, tuple):
+        return True
+    address = ipaddress.ip_address(peername[0].split('%')[0])
+    mapped = getattr(address, 'ipv4_mapped', None) # ::ffff:127.0.0.1
+    return address.is_loopback or (mapped is not None and mapped.is_loopback)
+
+
+def _open_fifo(path:str, flags:int) -> int:
+    status = os.lstat(path)
+    if not stat.S_ISFIFO(status.st_mode):
+        raise ValueError(f'{path} is not a FIFO')
+    if status.st_uid != os.getuid():
+        raise ValueError(f'{path} belongs to another user')
+    return os.open(path, flags | os.O_NONBLOCK | os.O_NOFOLLOW)
+
+
+class ShmChannel:
+    # One side of a connection over the rings. It stands in for both the
+    # StreamReader (readline, readexactly) and the StreamWriter (write, drain, close)
+    POLL = 0.02 # seconds, the longest a lost wakeup can delay a waiting side
+
+    def __init__(self, inbound:Ring, outbound:Ring, doorbell:int, peer_doorbell:int, name:str):
+        self.inbound = inbound
+        self.outbound = outbound
+        self.doorbell = doorbell # read end, rung by the peer
+        self.peer_doorbell = peer_doorbell
+        self.name = name
+        self.transport = self # Outbound aborts slow consumers through writer.transport
+        self.buffer = bytearray() # read from the ring, not yet consumed
+        self.pending = deque() # written, waiting for room in the ring
+        self.data = asyncio.Event()
+        self.space = asyncio.Event()
+        self.peer_gone = False
+        self.closed = False
+        self.ringing = False # a doorbell is scheduled for this pass of the event loop
+        self.loop = asyncio.get_running_loop()
+        self.loop.add_reader(doorbell, self._wake)
+        self.watching = True # doorbell registered with the loop, removed before its fd is closed
+
+    def _wake(self) -> None:
+        try:
+            if not os.read(self.doorbell, 4096): # every pending wakeup at once
+                # every writer of the FIFO is closed, the peer process is gone
+                self.peer_gone = True
+                self.loop.remove_reader(self.doorbell)
+                self.watching = False
+        except BlockingIOError:
+            pass
+        self.data.set()
+        self.space.set()
+
+    def _ring_soon(self) -> None:
+        self.ringing = False
+        if not self.closed:
+            self._ring_peer()
+
+    def _ring_peer(self) -> None:
+        try:
+            os.write(self.peer_doorbell, b'\0')
+        except BlockingIOError:
+            pass # the FIFO is full of wakeups already
+        except OSError:
+            self.peer_gone = True
+
+    async def _sleep(self, event:asyncio.Event) -> None:
+        event.clear()
+        timer = self.loop.call_later(self.POLL, event.set)
+        try:
+            await event.wait()
+        finally:
+            timer.cancel()
+
+    async def _fill(self) -> bool:
+        # Moves the inbound bytes to the buffer, waiting for some. False at end of stream
+        ring = self.inbound
+        while not self.closed:
+            data = ring.read()
+            if data:
+                self.buffer += data
+                if ring.buf[WRITER_WAITING]:
+                    self._ring_peer()
+                return True
+            if ring.buf[CLOSED] or self.peer_gone:
+                return False
+            ring.buf[READER_WAITING] = 1
+            if not ring.readable() and not ring.buf[CLOSED]:
+                await self._sleep(self.data)
+            if not self.closed:
+                ring.buf[READER_WAITING] = 0
+        return False
+
+    async def readexactly(self, n:int) -> bytes:
+        while len(self.buffer) < n:
+            if not await self._fill():
+                partial, self.buffer = bytes(self.buffer), bytearray()
+                raise asyncio.IncompleteReadError(partial, n)
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    async def readline(self) -> bytes:
+        start = 0
+        while (end := self.buffer.find(b'\n', start)) < 0:
+            start = len(self.buffer)
+            if not await self._fill():
+                line, self.buffer = bytes(self.buffer), bytearray()
+                return line
+        line = bytes(self.buffer[:end + 1])
+        del self.buffer[:end + 1]
+        return line
+
+    async def read(self, n:int=-1) -> bytes:
+        if not self.buffer and not await self._fill():
+            return b''
+        n = len(self.buffer) if n < 0 else min(n, len(self.buffer))
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    def _push(self) -> None:
+        # Pending writes into the ring, in order, as far as they fit
+        ring = self.outbound
+        written = 0
+        while self.pending:
+            data = self.pending[0]
+            n = ring.write(data)
+            written += n
+            if n < len(data):
+                self.pending[0] = memoryview(data)[n:]
+                break
+            self.pending.popleft()
+        if written and not self.ringing and ring.buf[READER_WAITING]:
+            # once per pass of the event loop, the writes of a burst share the wakeup
+            self.ringing = True
+            self.loop.call_soon(self._ring_soon)
+
+    def write(self, data:bytes) -> None:
+        if self.closed or not data:
+            return
+        self.pending.append(data)
+        self._push()
+
+    async def drain(self) -> None:
+        ring = self.outbound
+        while True:
+            if not self.closed:
+                self._push()
+            if not self.pending:
+                return # in the ring, the peer may have read it and closed already
+            if self.closed or ring.buf[CLOSED] or self.peer_gone:
+                raise ConnectionResetError(f'Shared memory channel {self.name} is closed')
+            ring.buf[WRITER_WAITING] = 1
+            self._push() # the reader may have made room before it saw the flag
+            if self.pending:
+                await self._sleep(self.space)
+            if not self.closed:
+                ring.buf[WRITER_WAITING] = 0
+
+    def get_extra_info(self, name:str, default=None):
+        return f'shm:{self.name}' if name == 'peername' else default
+
+    def is_closing(self) -> bool:
+        return self.closed
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        # the peer reads what is left in its ring before it sees the flag
+        self.inbound.buf[CLOSED] = 1
+        self.outbound.buf[CLOSED] = 1
+        self._ring_peer()
+        if self.watching:
+            self.loop.remove_reader(self.doorbell)
+            self.watching = False
+        os.close(self.doorbell)
+        os.close(self.peer_doorbell)
+        self.inbound.close()
+        self.outbound.close()
+        self.data.set()
+        self.space.set()
+
+    def abort(self) -> None:
+        self.close()
+
+    async def wait_closed(self) -> None:
+        return
+
+
+class ShmOffer:
+    # Client half of the handshake: creates the rings and doorbells, open() once the
+    # broker accepted, unlink() either way, the names are not needed after the handshake
+    def __init__(self, capacity:int=RING_BYTES):
+        if not supported():
+            raise OSError(f'Shared-memory rings need x86 store ordering, this is {platform.machine()}')
+        self.rings = list() # client -> broker, broker -> client
+        self.paths = list() # broker's doorbell, client's doorbell
+        self.doorbell = None
+        try:
+            self.rings = [Ring.create(capacity), Ring.create(capacity)]
+            token = uuid4().hex[:16]
+            for side in ('broker', 'client'):
+                path = os.path.join(tempfile.gettempdir(), f'mq_{token}.{side}')
+                os.mkfifo(path, 0o600)
+                self.paths.append(path)
+            self.doorbell = os.open(self.paths[1], os.O_RDONLY | os.O_NONBLOCK)
+        except BaseException:
+            self.unlink()
+            self.discard()
+            raise
+
+    def command(self) -> dict:
+        return {'command': 'shm', 'rings': [ring.shm.name for ring in self.rings], 'doorbells': self.paths}
+
+    def open(self) -> ShmChannel:
+        up, down = self.rings
+        peer_doorbell = os.open(self.paths[0], os.O_WRONLY | os.O_NONBLOCK)
+        return ShmChannel(down, up, self.doorbell, peer_doorbell, up.shm.name)
+
+    def unlink(self) -> None:
+        for ring in self.rings:
+            try:
+                ring.shm.unlink()
+            except FileNotFoundError:
+                pass
+        for path in self.paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def discard(self) -> None:
+        # The broker declined, nothing was opened on the rings
+        if self.doorbell is not None:
+            os.close(self.doorbell)
+            self.doorbell = None
+        for ring in self.rings:
+            ring.close()
+        self.rings = list()
+
+
+def _check(cmd:dict) -> None:
+    # Only what ShmOffer creates: two mq_ segments and a pair of mq_ FIFOs in the temp folder
+    names, paths = cmd['rings'], cmd['doorbells']
+    if len(names) != 2 or not all(isinstance(name, str) and RING_NAME.match(name) for name in names):
+        raise ValueError(f'Not shared-memory rings of this transport: {names}')
+    if len(paths) != 2 or not all(isinstance(path, str) for path in paths):
+        raise ValueError(f'Not doorbells of this transport: {paths}')
+    matches = [DOORBELL_NAME.match(os.path.basename(path)) for path in paths]
+    if not (all(matches) and [match.group(2) for match in matches] == ['broker', 'client']
+            and matches[0].group(1) == matches[1].group(1)
+            and all(os.path.dirname(path) == tempfile.gettempdir() for path in paths)):
+        raise ValueError(f'Not doorbells of this transport: {paths}')
+
+
+def accept(cmd:dict) -> ShmChannel:
+    # Broker half: raises OSError or ValueError when the client's rings are not reachable
+    # from here or were not named by ShmOffer
+    if not supported():
+        raise OSError(f'Shared-memory rings need x86 store ordering, this is {platform.machine()}')
+    _check(cmd)
+    rings, fds = list(), list()
+    try:
+        for name in cmd['rings']:
+            rings.append(Ring.attach(name))
+        broker_path, client_path = cmd['doorbells']
+        fds.append(_open_fifo(broker_path, os.O_RDONLY))
+        fds.append(_open_fifo(client_path, os.O_WRONLY)) # the client holds the read end open
+        up, down = rings
+        return ShmChannel(up, down, fds[0], fds[1], up.shm.name)
+    except BaseException:
+        for fd in fds:
+            os.close(fd)
+        for ring in rings:
+            ring.close()
+        raise
@@ -43,12 +43,45 @@ class Respond(Internal):
 
 class Subscribe(Internal):
     command:str='subscribe'
-    last_seen:int
+    last_seen:int|None=None # offset of the last message seen, replayed after it, None subscribes from now
+    group:str='' # consumer group sharing the topic's partitions
+    prefetch:int=0 # delivery='one' messages held unacked at most, 0 for no limit
+
+class Unsubscribe(Internal):
+    command:str='unsubscribe'
+    group:str='' # leaves the group instead, its partitions move to the other members
 
 class Send(Internal):
     command:str='send'
-    message:str
+    id:str='' # correlation id, replies carrying it are routed back to the sender
+    message:str|dict # text, or a structured message (Solve, Observe) nested as an object
     delivery:str
+    trace:dict[str,int]|None=None # sampled messages only: mark -> monotonic ns, see metrics.STAGES
+
+class FetchBatch(Internal):
+    topic:str=''
+    command:str='fetch_batch'
+    offsets:dict[str,dict[int,int]] # topic -> partition -> first offset to read
+    max_messages:int=1000
+
+class Commit(Internal):
+    topic:str=''
+    command:str='commit'
+    group:str
+    offsets:dict[str,dict[int,int]] # topic -> partition -> next offset to read
+
+class Ack(Internal):
+    topic:str=''
+    command:str='ack'
+    acks:dict[str,dict[int,list[int]]] # topic -> partition -> offsets handled
+
+class Shards(Internal):
+    topic:str=''
+    command:str='shards'
+
+class Stats(Internal):
+    topic:str=''
+    command:str='stats'
 
 class Query(Request):
     topic:str='query'
@@ -0,0 +1,51 @@
+# Subscribers of one topic
+# - A list for random picks plus a dict of each writer's position in it,
+#   so add, discard, membership and a random pair are all O(1)
+# - discard moves the last writer into the freed slot, order is not kept
+# - Adding a writer twice is a no-op, a re-subscribe never doubles deliveries
+
+import random
+
+
+class Subscribers:
+    __slots__ = ('writers', 'positions')
+
+    def __init__(self):
+        self.writers = list()
+        self.positions = dict() # writer -> index in writers
+
+    def add(self, writer) -> bool:
+        # False if the writer was subscribed already
+        if writer in self.positions:
+            return False
+        self.positions[writer] = len(self.writers)
+        self.writers.append(writer)
+        return True
+
+    def discard(self, writer) -> bool:
+        position = self.positions.pop(writer, None)
+        if position is None:
+            return False
+        last = self.writers.pop()
+        if last is not writer:
+            self.writers[position] = last
+            self.positions[last] = position
+        return True
+
+    def pair(self) -> tuple:
+        # Two distinct writers at random, or the only one twice
+        n = len(self.writers)
+        if n < 2:
+            return self.writers[0], self.writers[0]
+        i = random.randrange(n)
+        j = random.randrange(n - 1)
+        return self.writers[i], self.writers[j + (j >= i)]
+
+    def __contains__(self, writer) -> bool:
+        return writer in self.positions
+
+    def __len__(self) -> int:
+        return len(self.writers)
+
+    def __iter__(self):
+        return iter(self.writers)
@@ -0,0 +1,148 @@
+# Transports besides TCP, for actors on the same host or in the same process
+# - unix: the same byte streams as TCP over a Unix domain socket,
+#   MessageQueue(unix_path=...) listens on it next to its TCP port
+# - local: broker and client in one event loop, no socket and no wire encoding.
+#   The client calls the broker's handlers with envelopes and command dicts, the
+#   broker hands envelopes to the client's inbox, structured bodies are passed
+#   by reference (receivers must not modify them)
+#
+#   AsyncClient(host, port, transport='unix')   # unix_path defaults to default_unix_path(port)
+#   AsyncClient(host, port, transport='local')  # the MessageQueue running on host:port in this process
+#   AsyncClient(host, port, transport='shm')    # shared-memory rings, see src/communicate/shm.py
+
+import os, asyncio, tempfile
+from itertools import count
+
+TRANSPORTS = ('tcp', 'unix', 'local', 'shm')
+LOCAL_BROKERS = dict() # (host, port) -> MessageQueue running in this process
+
+_connection_ids = count()
+
+
+def default_unix_path(port:int) -> str:
+    return os.path.join(tempfile.gettempdir(), f'mq_{port}.sock')
+
+
+class LocalConnection:
+    # Both ends of an in-process connection. The broker keys its state by it as it would
+    # by a StreamWriter, the client sends through it and reads deliveries from inbox
+    def __init__(self, broker):
+        self.broker = broker
+        self.inbox = asyncio.Queue() # envelopes, command dicts and lists of envelopes, None once closed
+        self.outbound = None # the broker's LocalOutbound for this connection
+        self.name = f'local:{next(_connection_ids)}'
+        self.closed = False
+
+    def get_extra_info(self, name:str, default=None):
+        return self.name if name == 'peername' else default
+
+    def close(self) -> None:
+        # Broker side: ends the client's receive()
+        if not self.closed:
+            self.closed = True
+            self.inbox.put_nowait(None)
+
+    async def command(self, cmd:dict) -> None:
+        if not self.closed:
+            await self.broker.handle_command(cmd, self)
+
+    async def send(self, envelopes:list) -> None:
+        if self.closed:
+            return
+        if len(envelopes) == 1:
+            await self.broker.handle_send(envelopes[0], self)
+        else:
+            await self.broker.handle_send_batch(envelopes, self)
+
+    async def receive(self):
+        item = await self.inbox.get()
+        outbound = self.outbound
+        if outbound is not None and not outbound.writable.is_set() and self.inbox.qsize() <= outbound.low_watermark:
+            outbound.writable.set()
+        return item
+
+    async def quit(self) -> None:
+        await self.broker._cleanup_client(self)
+
+
+class LocalOutbound:
+    # Outbound for a LocalConnection, same interface as Outbound. Items go to the
+    # client's inbox as they are, watermarks count items rather than bytes
+    HIGH_WATERMARK = 16384
+    LOW_WATERMARK = 4096
+
+    def __init__(self, connection:LocalConnection, on_close,
+                 high_watermark=None, low_watermark=None, policy='pause'):
+        self.connection = connection
+        self.writer = connection
+        self.on_close = on_close
+        self.high_watermark = high_watermark or self.HIGH_WATERMARK
+        self.low_watermark = low_watermark or self.LOW_WATERMARK
+        self.policy = policy
+        self.codec = None
+        self.delivered = 0
+        self.dropped = 0
+        self.closed = False
+        self.writable = asyncio.Event()
+        self.writable.set()
+        connection.outbound = self
+
+    def encode(self, item):
+        return item
+
+    def batch(self, envelopes:list) -> list:
+        return list(envelopes)
+
+    def control(self, cmd:dict) -> dict:
+        return cmd
+
+    def enqueue(self, item) -> bool:
+        if self.closed:
+            return False
+        inbox = self.connection.inbox
+        inbox.put_nowait(item)
+        self.delivered += 1
+        if inbox.qsize() <= self.high_watermark:
+            return True
+
+        if self.policy == 'disconnect':
+            print(f'Disconnecting slow consumer {self.connection.name}')
+            self.close()
+            asyncio.ensure_future(self.on_close(self.connection))
+            return False
+        if self.policy == 'drop_oldest':
+            while inbox.qsize() > self.high_watermark:
+                inbox.get_nowait()
+                self.dropped += 1
+        else: # if policy == 'pause'
+            self.writable.clear()
+        return True
+
+    async def put(self, item) -> None:
+        # Lossless, waits for the consumer instead of applying the policy
+        if self.closed:
+            return
+        self.connection.inbox.put_nowait(item)
+        self.delivered += 1
+        if self.connection.inbox.qsize() > self.high_watermark:
+            self.writable.clear()
+            await self.wait_writable()
+
+    def snapshot(self) -> dict:
+        return {
+            'queued_lines': self.connection.inbox.qsize(),
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'paused': not self.writable.is_set()
+        }
+
+    async def wait_writable(self) -> None:
+        if not self.writable.is_set():
+            await self.writable.wait()
+
+    def close(self) -> None:
+        self.closed = True
+        self.writable.set()
+
+    def stop(self) -> None:
+        self.close()
@@ -0,0 +1,247 @@
+# Columnar form of the bookkeeping logs, for analytics without re-parsing text
+# - Closed text logs (query.<ms>.txt, ...) are compacted into one folder per segment:
+#     columns/<kind>/<ms>/meta.json              rows and column types
+#     columns/<kind>/<ms>/<column>.npy           numbers: datetime (epoch seconds), uncertainty,
+#                                                received_ns (from the log's index, if it had one)
+#     columns/<kind>/<ms>/<column>.codes.npy     strings: int32 codes into ..., correlation_id
+#                                                also from the index
+#     columns/<kind>/<ms>/<column>.values.json   ... the column's distinct values
+#     columns/<kind>/<ms>/id.rows.npy            rows in id order, id values are kept sorted by id_key
+#     columns/<kind>/<ms>/id.starts.npy          first position in id.rows of each id code, and the end
+# - .npy files are memory-mapped on read, only the requested columns are touched
+# - String columns stay dictionary-encoded, filters compare codes, not strings
+
+import os, re, json, shutil
+import numpy as np
+from datetime import datetime
+
+DATETIME_FORMAT = '%d/%m/%Y, %H:%M:%S'
+CLOSED_LOG = re.compile(r'^([a-z_]+)\.(\d+)\.txt$') # <kind>.<ms>.txt, waiting for compaction
+
+# Column layout of each text log, in the order Bookkeeper writes them
+SCHEMAS = {
+    'query':   ['datetime', 'topic', 'id', 'target', 'choice_type', 'choices'],
+    'solve':   ['datetime', 'id', 'target', 'choice_type', 'choices', 'choice', 'uncertainty'],
+    'observe': ['datetime', 'message', 'target', 'result']
+}
+SCHEMAS['replay_solve'] = SCHEMAS['solve'] # solves of replayed queries, see src/actors/replay.py
+NUMERIC = {'datetime': np.int64, 'uncertainty': np.float64, 'received_ns': np.int64}
+INDEX_COLUMNS = ('correlation_id', 'received_ns') # taken from the log's index, missing without one
+DIGITS = re.compile(r'(\d+)')
+
+
+def id_key(value:str) -> tuple:
+    # Orders ids by their numbers, 'q9' < 'q10': text and int parts alternate, so keys always compare
+    parts = DIGITS.split(value)
+    parts[1::2] = [int(part) for part in parts[1::2]]
+    return tuple(parts)
+
+
+def parse_field(name:str, value:str):
+    # A text log field as its column holds it: datetime in epoch seconds, uncertainty a float
+    if name == 'datetime':
+        return int(datetime.strptime(value, DATETIME_FORMAT).timestamp()) if value else 0
+    if name in NUMERIC:
+        return float(value) if value else float('nan')
+    return value
+
+
+def _encode_strings(values:list):
+    # Dictionary encoding: distinct values in first-seen order and an int32 code per row
+    lookup = dict()
+    codes = np.fromiter((lookup.setdefault(v, len(lookup)) for v in values), dtype=np.int32, count=len(values))
+    return codes, list(lookup)
+
+
+def _encode_ids(values:list):
+    # Dictionary encoding with the distinct ids sorted by id_key, so a range of ids is a range
+    # of codes, plus the rows grouped by code: rows[starts[c]:starts[c + 1]] hold id code c
+    distinct = sorted(set(values), key=id_key)
+    lookup = {value: code for code, value in enumerate(distinct)}
+    codes = np.fromiter((lookup[v] for v in values), dtype=np.int32, count=len(values))
+    rows = np.argsort(codes, kind='stable').astype(np.int32)
+    starts = np.concatenate(([0], np.cumsum(np.bincount(codes, minlength=len(distinct))))).astype(np.int64)
+    return codes, distinct, rows, starts
+
+
+def _parse_datetimes(values:list) -> np.ndarray:
+    # Timestamps repeat a lot at second resolution, parse each distinct one once
+    codes, distinct = _encode_strings(values)
+    seconds = np.array([
+        int(datetime.strptime(v, DATETIME_FORMAT).timestamp()) if v else 0 for v in distinct
+    ], dtype=np.int64)
+    return seconds[codes] if len(codes) else np.zeros(0, dtype=np.int64)
+
+
+def compact(text_path:str, directory:str, kind:str) -> int:
+    # Converts one closed text log into a column folder, returns the row count.
+    # Written under a temporary name and renamed, a crash never leaves half a segment
+    names = SCHEMAS[kind]
+    columns = [list() for _ in names]
+    offsets = list() # byte offset of every row, matched against the index
+    position = 0
+    with open(text_path, 'rb') as f:
+        for raw in f:
+            line_offset, position = position, position + len(raw)
+            items = raw.decode('utf-8').rstrip('\n').split('\t')
+            if len(items) != len(names):
+                continue # torn or foreign line
+            offsets.append(line_offset)
+            for column, item in zip(columns, items):
+                column.append(item)
+
+    received = None
+    if os.path.exists(text_path + '.idx'):
+        arrival = dict() # byte offset -> (received_ns, correlation id)
+        with open(text_path + '.idx', 'r', encoding='utf-8') as f:
+            for entry in f:
+                fields = entry.rstrip('\n').split('\t')
+                if len(fields) == 5:
+                    arrival[int(fields[4])] = (int(fields[3]), fields[0])
+        entries = [arrival.get(offset, (0, '')) for offset in offsets]
+        received = np.array([ns for ns, _ in entries], dtype=np.int64)
+        correlation_ids = [correlation_id for _, correlation_id in entries]
+
+    temporary = directory + '.tmp'
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+    for name, values in zip(names, columns):
+        if name == 'datetime':
+            np.save(os.path.join(temporary, f'{name}.npy'), _parse_datetimes(values))
+        elif name in NUMERIC:
+            array = np.array([float(v) if v else np.nan for v in values], dtype=NUMERIC[name])
+            np.save(os.path.join(temporary, f'{name}.npy'), array)
+        else:
+            if name == 'id':
+                codes, distinct, rows, starts = _encode_ids(values)
+                np.save(os.path.join(temporary, 'id.rows.npy'), rows)
+                np.save(os.path.join(temporary, 'id.starts.npy'), starts)
+            else:
+                codes, distinct = _encode_strings(values)
+            np.save(os.path.join(temporary, f'{name}.codes.npy'), codes)
+            with open(os.path.join(temporary, f'{name}.values.json'), 'w') as f:
+                json.dump(distinct, f)
+    if received is not None:
+        np.save(os.path.join(temporary, 'received_ns.npy'), received)
+        codes, distinct = _encode_strings(correlation_ids)
+        np.save(os.path.join(temporary, 'correlation_id.codes.npy'), codes)
+        with open(os.path.join(temporary, 'correlation_id.values.json'), 'w') as f:
+            json.dump(distinct, f)
+        names = names + list(INDEX_COLUMNS)
+    rows = len(columns[0])
+    with open(os.path.join(temporary, 'meta.json'), 'w') as f:
+        json.dump({'kind': kind, 'rows': rows, 'columns': names, 'source': os.path.basename(text_path)}, f)
+    os.replace(temporary, directory)
+    return rows
+
+
+class StringColumn:
+    # Dictionary-encoded strings: codes index into values
+    def __init__(self, codes:np.ndarray, values:list):
+        self.codes = codes
+        self.values = values
+
+    def __len__(self):
+        return len(self.codes)
+
+    def code(self, value:str) -> int:
+        # -1 for values that never occur, so comparisons simply match nothing
+        try:
+            return self.values.index(value)
+        except ValueError:
+            return -1
+
+    def __eq__(self, value:str) -> np.ndarray:
+        return self.codes == self.code(value)
+
+    def decode(self) -> np.ndarray:
+        return np.array(self.values, dtype=object)[self.codes]
+
+    def counts(self) -> dict:
+        # value -> occurrences, a bincount over the codes
+        counts = np.bincount(self.codes, minlength=len(self.values))
+        return {value: int(n) for value, n in zip(self.values, counts)}
+
+
+class ColumnarLog:
+    # Reader over every compacted segment of one kind ('query', 'solve', 'observe')
+    def __init__(self, directory:str, kind:str):
+        self.directory = os.path.join(directory, kind)
+        self.kind = kind
+        self.segments = sorted(
+            name for name in os.listdir(self.directory)
+            if os.path.exists(os.path.join(self.directory, name, 'meta.json'))
+        ) if os.path.isdir(self.directory) else []
+
+    def _meta(self, segment:str) -> dict:
+        with open(os.path.join(self.directory, segment, 'meta.json')) as f:
+            return json.load(f)
+
+    def _has(self, segment:str, name:str) -> bool:
+        suffix = '.npy' if name in NUMERIC else '.codes.npy'
+        return os.path.exists(os.path.join(self.directory, segment, name + suffix))
+
+    def count(self) -> int:
+        return sum(self._meta(segment)['rows'] for segment in self.segments)
+
+    def column(self, name:str):
+        # Index columns a segment does not have read as 0 / '', like unindexed lines,
+        # so every column keeps one entry per row
+        if name not in SCHEMAS[self.kind] and name not in INDEX_COLUMNS:
+            raise KeyError(f'{self.kind} logs have no column {name}')
+        missing = {
+            segment for segment in self.segments if name in INDEX_COLUMNS and not self._has(segment, name)
+        }
+        if name in NUMERIC:
+            arrays = [
+                np.zeros(self._meta(segment)['rows'], dtype=NUMERIC[name]) if segment in missing else
+                np.load(os.path.join(self.directory, segment, f'{name}.npy'), mmap_mode='r')
+                for segment in self.segments
+            ]
+            if len(arrays) == 1:
+                return arrays[0]
+            return np.concatenate(arrays) if arrays else np.zeros(0, dtype=NUMERIC[name])
+
+        # Merge the segment dictionaries, each segment's codes are remapped with one take
+        lookup = dict()
+        parts = list()
+        for segment in self.segments:
+            folder = os.path.join(self.directory, segment)
+            if segment in missing:
+                parts.append(np.full(self._meta(segment)['rows'], lookup.setdefault('', len(lookup)), dtype=np.int32))
+                continue
+            with open(os.path.join(folder, f'{name}.values.json')) as f:
+                values = json.load(f)
+            remap = np.array([lookup.setdefault(v, len(lookup)) for v in values], dtype=np.int32)
+            codes = np.load(os.path.join(folder, f'{name}.codes.npy'), mmap_mode='r')
+            parts.append(remap[codes] if len(remap) else np.zeros(0, dtype=np.int32))
+        codes = np.concatenate(parts) if parts else np.zeros(0, dtype=np.int32)
+        return StringColumn(codes, list(lookup))
+
+    def rows(self, *names):
+        # Row tuples segment by segment, strings decoded as they are yielded,
+        # index columns a segment does not have come back as None
+        for segment in self.segments:
+            folder = os.path.join(self.directory, segment)
+            columns = list()
+            for name in names:
+                if name in INDEX_COLUMNS and not self._has(segment, name):
+                    columns.append(None)
+                elif name in NUMERIC:
+                    columns.append(np.load(os.path.join(folder, f'{name}.npy'), mmap_mode='r'))
+                else:
+                    with open(os.path.join(folder, f'{name}.values.json')) as f:
+                        values = json.load(f)
+                    columns.append((np.load(os.path.join(folder, f'{name}.codes.npy'), mmap_mode='r'), values))
+            rows = self._meta(segment)['rows']
+            for i in range(rows):
+                yield tuple(
+                    None if column is None else
+                    column[i].item() if isinstance(column, np.ndarray) else
+                    column[1][column[0][i]]
+                    for column in columns
+                )
+
+    def load(self, *names) -> dict:
+        # Only the named columns are read
+        return {name: self.column(name) for name in names}
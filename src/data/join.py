@@ -0,0 +1,237 @@
+# Join between the query and solve logs through their indexes
+# - Every query / solve line is indexed by the bookkeeper as it is appended:
+#   <log>.idx holds 'correlation id \t id \t choice_type \t received_ns \t byte offset'
+#   per line, compacted segments keep the same as their correlation_id / id / choice_type /
+#   received_ns columns
+# - Lookups do not scan: received_ns grows in append order, so a time window is a bisect,
+#   and ids are compared by id_key ('q9' < 'q10') through an id-sorted order, persisted
+#   for compacted segments (id.rows / id.starts) and built in memory for a text .idx,
+#   which is read once and then only from where it grew
+# - join() streams both indexes in arrival order and pairs each solve with the oldest
+#   pending query line of the same (correlation id, choice_type). Query ids repeat across
+#   clients and runs, the correlation id of the query message does not. Only queries
+#   younger than window are held, so memory stays bounded however long the history is
+# - Full lines are read only for matched pairs, by offset or row
+#
+#   for query, solve, latency_ns in LogJoin('src/data/').join(since_ns=...):
+
+import os, json, heapq
+import numpy as np
+from bisect import bisect_left, bisect_right
+from collections import deque
+from src.data.columnar import SCHEMAS, NUMERIC, CLOSED_LOG, id_key, parse_field
+
+
+class TextIndex:
+    # One text log's .idx in memory, columns in append order
+    def __init__(self, path):
+        self.path = path + '.idx'
+        self.inode = None
+        self.position = 0 # bytes of the .idx read so far
+        self.received = list()
+        self.correlation_ids = list()
+        self.ids = list()
+        self.choice_types = list()
+        self.offsets = list()
+        self.by_id = None # (id_key, row) sorted, built by the first id lookup after a change
+
+    def update(self) -> bool:
+        # Reads the lines appended since the last update, False once the .idx is gone.
+        # A truncated or replaced .idx (rolled, reset) is read again from the start
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return False
+        with f:
+            stat = os.fstat(f.fileno())
+            if stat.st_ino != self.inode or stat.st_size < self.position:
+                self.__init__(self.path[:-len('.idx')])
+                self.inode = stat.st_ino
+            f.seek(self.position)
+            data = f.read()
+        complete = data.rfind(b'\n') + 1 # a line still being written waits for the next update
+        self.position += complete
+        for entry in data[:complete].decode('utf-8').splitlines():
+            fields = entry.split('\t')
+            if len(fields) != 5:
+                continue # torn index line
+            self.correlation_ids.append(fields[0])
+            self.ids.append(fields[1])
+            self.choice_types.append(fields[2])
+            self.received.append(int(fields[3]))
+            self.offsets.append(int(fields[4]))
+        if complete:
+            self.by_id = None
+        return True
+
+    def rows(self, ids, since_ns, until_ns):
+        # Row numbers in append order
+        start = 0 if since_ns is None else bisect_left(self.received, since_ns)
+        stop = len(self.received) if until_ns is None else bisect_left(self.received, until_ns)
+        if ids is None:
+            return range(start, stop)
+        if self.by_id is None:
+            self.by_id = sorted((id_key(query_id), row) for row, query_id in enumerate(self.ids))
+        low = bisect_left(self.by_id, (id_key(ids[0]), -1))
+        high = bisect_right(self.by_id, (id_key(ids[1]), len(self.ids)))
+        return sorted(row for _, row in self.by_id[low:high] if start <= row < stop)
+
+
+class LogJoin:
+    WINDOW = 60.0 # seconds a query waits for its solve, twice the broker's reply timeout
+
+    def __init__(self, protected_directory, window=None, solve_kind='solve'):
+        # solve_kind='replay_solve' joins the queries with their replayed solves instead
+        self.solve_kind = solve_kind
+        self.log_directory = os.path.join(protected_directory, 'logs')
+        self.column_directory = os.path.join(self.log_directory, 'columns')
+        self.window_ns = int((window or self.WINDOW) * 1e9)
+        self.files = dict() # text log path -> open handle, for reading matched lines
+        self.segments = dict() # column folder -> loaded columns, memory-mapped
+        self.indexes = dict() # text log path -> TextIndex, kept while the log exists
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+        self.segments.clear()
+        self.indexes.clear()
+
+    def _column_entries(self, kind, ids, since_ns, until_ns):
+        folder = os.path.join(self.column_directory, kind)
+        if not os.path.isdir(folder):
+            return
+        for stamp in sorted(os.listdir(folder)):
+            segment = os.path.join(folder, stamp)
+            if not os.path.exists(os.path.join(segment, 'received_ns.npy')):
+                continue # compacted without an index
+            columns = self._segment(segment)
+            received = columns['received_ns']
+            if not len(received):
+                continue
+            if (since_ns is not None and received[-1] < since_ns) or \
+               (until_ns is not None and received[0] >= until_ns):
+                continue # whole segment outside the window
+            id_codes, id_values = columns['id']
+            type_codes, type_values = columns['choice_type']
+            key_codes, key_values = columns.get('correlation_id', columns['id']) # older segments had none
+
+            start = 0 if since_ns is None else int(np.searchsorted(received, since_ns, 'left'))
+            stop = len(received) if until_ns is None else int(np.searchsorted(received, until_ns, 'left'))
+            if ids is None:
+                rows = range(start, stop)
+            elif 'id.rows' in columns:
+                # id values are sorted, the codes of the range are contiguous
+                low = bisect_left(id_values, id_key(ids[0]), key=id_key)
+                high = bisect_right(id_values, id_key(ids[1]), key=id_key)
+                starts = columns['id.starts']
+                rows = np.sort(columns['id.rows'][starts[low]:starts[high]])
+                rows = rows[(rows >= start) & (rows < stop)].tolist()
+            else: # compacted before ids were sorted
+                low, high = id_key(ids[0]), id_key(ids[1])
+                in_range = np.array([low <= id_key(v) <= high for v in id_values], dtype=bool)
+                rows = (np.flatnonzero(in_range[id_codes[start:stop]]) + start).tolist()
+            for row in rows:
+                yield (int(received[row]), key_values[key_codes[row]], id_values[id_codes[row]],
+                       type_values[type_codes[row]], (segment, row))
+
+    def _text_entries(self, path, ids, since_ns, until_ns):
+        index = self.indexes.get(path) or TextIndex(path)
+        if not index.update():
+            self.indexes.pop(path, None)
+            return # compacted meanwhile, or written before logs were indexed
+        self.indexes[path] = index
+        for row in index.rows(ids, since_ns, until_ns):
+            yield (index.received[row], index.correlation_ids[row], index.ids[row], index.choice_types[row],
+                   (path, index.offsets[row]))
+
+    def entries(self, kind, ids=None, since_ns=None, until_ns=None):
+        # (received_ns, correlation id, id, choice_type, location) in append order:
+        # compacted segments, then closed text logs, then the active log
+        yield from self._column_entries(kind, ids, since_ns, until_ns)
+        if not os.path.isdir(self.log_directory):
+            return
+        closed = sorted(
+            name for name in os.listdir(self.log_directory)
+            if (match := CLOSED_LOG.match(name)) and match.group(1) == kind
+        )
+        for name in closed + [f'{kind}.txt']:
+            yield from self._text_entries(os.path.join(self.log_directory, name), ids, since_ns, until_ns)
+
+    def _segment(self, folder):
+        if folder not in self.segments:
+            columns = dict()
+            for name in os.listdir(folder):
+                path = os.path.join(folder, name)
+                if name.endswith('.codes.npy'):
+                    column = name[:-len('.codes.npy')]
+                    with open(os.path.join(folder, f'{column}.values.json')) as f:
+                        values = json.load(f)
+                    columns[column] = (np.load(path, mmap_mode='r'), values)
+                elif name.endswith('.npy'):
+                    columns[name[:-len('.npy')]] = np.load(path, mmap_mode='r')
+            self.segments[folder] = columns
+        return self.segments[folder]
+
+    def row(self, kind, location) -> dict:
+        source, position = location
+        if source in self.segments or os.path.isdir(source):
+            columns = self._segment(source)
+            row = dict()
+            for name in SCHEMAS[kind]:
+                if name in NUMERIC:
+                    row[name] = columns[name][position].item()
+                else:
+                    codes, values = columns[name]
+                    row[name] = values[codes[position]]
+            return row
+        f = self.files.get(source)
+        if f is None:
+            f = self.files[source] = open(source, 'rb')
+        f.seek(position)
+        items = f.readline().decode('utf-8').rstrip('\n').split('\t')
+        return {name: parse_field(name, item) for name, item in zip(SCHEMAS[kind], items)}
+
+    def _pairs(self, ids, since_ns, until_ns):
+        # (query location, solve location, latency_ns) from the indexes alone
+        solve_until = None if until_ns is None else until_ns + self.window_ns
+        queries = ((ns, 0, (correlation_id, choice_type), location)
+                   for ns, correlation_id, _, choice_type, location in self.entries('query', ids, since_ns, until_ns))
+        solves = ((ns, 1, (correlation_id, choice_type), location)
+                  for ns, correlation_id, _, choice_type, location in self.entries(self.solve_kind, ids, since_ns, solve_until))
+
+        pending = dict() # (correlation id, choice_type) -> deque of (received_ns, location) of queries
+        order = deque() # (received_ns, key) of pending queries, oldest first
+        for ns, side, key, location in heapq.merge(queries, solves, key=lambda entry: entry[0]):
+            while order and order[0][0] < ns - self.window_ns:
+                expired_ns, expired_key = order.popleft()
+                waiting = pending.get(expired_key)
+                if waiting and waiting[0][0] == expired_ns:
+                    waiting.popleft()
+                    if not waiting:
+                        del pending[expired_key]
+
+            if side == 0:
+                pending.setdefault(key, deque()).append((ns, location))
+                order.append((ns, key))
+                continue
+            waiting = pending.get(key)
+            if not waiting:
+                continue # solve for a query outside the range, or already answered
+            query_ns, query_location = waiting.popleft()
+            if not waiting:
+                del pending[key]
+            yield query_location, location, ns - query_ns
+
+    def join(self, ids=None, since_ns=None, until_ns=None):
+        # Yields (query line, solve line, latency_ns) for queries received in
+        # [since_ns, until_ns) whose id lies in ids=(first, last), both inclusive and
+        # compared by id_key. Lines are dicts, typed the same from text and column segments
+        for query_location, solve_location, latency_ns in self._pairs(ids, since_ns, until_ns):
+            yield self.row('query', query_location), self.row(self.solve_kind, solve_location), latency_ns
+
+    def latencies(self, ids=None, since_ns=None, until_ns=None) -> np.ndarray:
+        # Latency distribution in ns, no log line is read
+        return np.fromiter(
+            (latency_ns for _, _, latency_ns in self._pairs(ids, since_ns, until_ns)), dtype=np.int64
+        )
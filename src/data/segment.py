@@ -0,0 +1,261 @@
+# Append-only segment log, one per topic (modeled after a Kafka partition)
+# - Records are appended to the active segment file, never rewritten
+# - The active segment rolls over once it grows past segment_bytes
+# - A sparse index maps offsets to file positions every index_interval bytes
+# - Reads memory-map a segment, bisect the index, then scan forward sequentially
+# - Retention drops whole closed segments by total size and by age, an idle
+#   active segment past the age limit is rolled so it can go as well
+#
+# Segment files are named after the first offset they hold:
+#   00000000000000000000.log    records
+#   00000000000000000000.index  (relative offset, position) pairs
+
+import os, time, mmap, struct
+from bisect import bisect_right
+
+# offset, timestamp (ms), attributes, value length
+RECORD = struct.Struct('>QQBI')
+# offset relative to the segment base, byte position in the .log file
+INDEX = struct.Struct('>II')
+
+
+class Segment:
+    def __init__(self, directory, base_offset, index_interval):
+        self.base_offset = base_offset
+        self.index_interval = index_interval
+        self.log_path = os.path.join(directory, f'{base_offset:020d}.log')
+        self.index_path = os.path.join(directory, f'{base_offset:020d}.index')
+
+        self.index_offsets = list() # relative offsets, sorted
+        self.index_positions = list()
+        self._load_index()
+
+        self.next_offset = base_offset
+        self.max_timestamp = 0
+        self.size = 0
+        self._recover()
+
+        self.log_file = open(self.log_path, 'ab')
+        self.index_file = open(self.index_path, 'ab')
+        self.bytes_since_index = self.index_interval # index the first append
+        self._map = None
+        self._map_size = 0
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'rb') as f:
+            data = f.read()
+        usable = len(data) - len(data) % INDEX.size
+        for relative, position in INDEX.iter_unpack(data[:usable]):
+            self.index_offsets.append(relative)
+            self.index_positions.append(position)
+
+    def _recover(self):
+        # Scan forward from the last indexed record to find the end of the log
+        # and cut off a partially written record left by a crash
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            file_size = f.tell()
+            while self.index_positions and self.index_positions[-1] > file_size:
+                self.index_offsets.pop()
+                self.index_positions.pop()
+            position = self.index_positions[-1] if self.index_positions else 0
+            f.seek(position)
+            data = f.read()
+
+        cursor = 0
+        while cursor + RECORD.size <= len(data):
+            offset, timestamp, _, length = RECORD.unpack_from(data, cursor)
+            if cursor + RECORD.size + length > len(data):
+                break
+            cursor += RECORD.size + length
+            self.next_offset = offset + 1
+            self.max_timestamp = max(self.max_timestamp, timestamp)
+
+        self.size = position + cursor
+        if self.size < file_size:
+            print(f'Truncating torn write in {self.log_path}')
+            with open(self.log_path, 'r+b') as f:
+                f.truncate(self.size)
+            with open(self.index_path, 'wb') as f:
+                for relative, position in zip(self.index_offsets, self.index_positions):
+                    f.write(INDEX.pack(relative, position))
+
+    def append(self, offset, value:bytes, attributes:int, timestamp:int) -> None:
+        self.append_batch(offset, [(value, attributes)], timestamp)
+
+    def append_batch(self, offset, items:list, timestamp:int) -> None:
+        # items are (value, attributes) pairs getting contiguous offsets, written at once
+        parts = list()
+        index_entries = list()
+        for value, attributes in items:
+            if self.bytes_since_index >= self.index_interval:
+                relative = offset - self.base_offset
+                self.index_offsets.append(relative)
+                self.index_positions.append(self.size)
+                index_entries.append(INDEX.pack(relative, self.size))
+                self.bytes_since_index = 0
+
+            parts.append(RECORD.pack(offset, timestamp, attributes, len(value)))
+            parts.append(value)
+
+            written = RECORD.size + len(value)
+            self.size += written
+            self.bytes_since_index += written
+            offset += 1
+
+        self.log_file.write(b''.join(parts))
+        if index_entries:
+            self.index_file.write(b''.join(index_entries))
+        self.next_offset = offset
+        self.max_timestamp = max(self.max_timestamp, timestamp)
+
+    def flush(self) -> None:
+        self.log_file.flush()
+        self.index_file.flush()
+
+    def _mapped(self):
+        # Remap only when the segment has grown since the last read, an older
+        # map stays alive for as long as a reader still iterates over it
+        if self._map is None or self._map_size != self.size:
+            self.flush()
+            with open(self.log_path, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+            self._map_size = self.size
+        return self._map
+
+    def read(self, start_offset):
+        if self.size == 0 or start_offset >= self.next_offset:
+            return
+        # Nearest indexed record at or before start_offset
+        which = bisect_right(self.index_offsets, start_offset - self.base_offset) - 1
+        position = self.index_positions[which] if which >= 0 else 0
+
+        data = self._mapped()
+        end = self._map_size
+        while position + RECORD.size <= end:
+            offset, timestamp, attributes, length = RECORD.unpack_from(data, position)
+            position += RECORD.size
+            if offset >= start_offset:
+                yield offset, timestamp, attributes, data[position:position+length]
+            position += length
+
+    def close(self) -> None:
+        self._map = None # unmapped once the last reader lets go
+        self.log_file.close()
+        self.index_file.close()
+
+    def delete(self) -> None:
+        self.close()
+        os.remove(self.log_path)
+        os.remove(self.index_path)
+
+
+class SegmentLog:
+    SEGMENT_BYTES = 16 * 1024 * 1024
+    INDEX_INTERVAL = 4096
+
+    def __init__(self, directory, segment_bytes=None, index_interval=None,
+                 retention_bytes=None, retention_seconds=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes or self.SEGMENT_BYTES
+        self.index_interval = index_interval or self.INDEX_INTERVAL
+        self.retention_bytes = retention_bytes # None keeps everything
+        self.retention_seconds = retention_seconds
+
+        os.makedirs(directory, exist_ok=True)
+        base_offsets = sorted(
+            int(name[:-4]) for name in os.listdir(directory) if name.endswith('.log')
+        )
+        self.segments = [Segment(directory, base, self.index_interval) for base in base_offsets]
+        if not self.segments:
+            self.segments.append(Segment(directory, 0, self.index_interval))
+        self.base_offsets = [segment.base_offset for segment in self.segments]
+
+    @property
+    def active(self) -> Segment:
+        return self.segments[-1]
+
+    @property
+    def start_offset(self) -> int:
+        return self.segments[0].base_offset
+
+    @property
+    def next_offset(self) -> int:
+        return self.active.next_offset
+
+    @property
+    def size(self) -> int:
+        return sum(segment.size for segment in self.segments)
+
+    def append(self, value:bytes, attributes:int=0, timestamp:int=None) -> int:
+        if self.active.size >= self.segment_bytes:
+            self.roll()
+        offset = self.next_offset
+        if timestamp is None:
+            timestamp = int(time.time() * 1000)
+        self.active.append(offset, value, attributes, timestamp)
+        return offset
+
+    def append_batch(self, items:list, timestamp:int=None) -> int:
+        # Returns the offset of the first record, the rest follow contiguously
+        if self.active.size >= self.segment_bytes:
+            self.roll()
+        offset = self.next_offset
+        if timestamp is None:
+            timestamp = int(time.time() * 1000)
+        self.active.append_batch(offset, items, timestamp)
+        return offset
+
+    def read(self, start_offset:int=0):
+        # Yields (offset, timestamp, attributes, value) from start_offset onward
+        start_offset = max(start_offset, self.start_offset)
+        which = max(bisect_right(self.base_offsets, start_offset) - 1, 0)
+        for segment in self.segments[which:]:
+            yield from segment.read(start_offset)
+
+    def roll(self) -> None:
+        if self.active.size == 0:
+            return # an empty active segment already starts at next_offset
+        self.active.flush()
+        segment = Segment(self.directory, self.next_offset, self.index_interval)
+        self.segments.append(segment)
+        self.base_offsets.append(segment.base_offset)
+        self.enforce_retention()
+
+    def enforce_retention(self) -> None:
+        # Only closed segments are eligible, an active segment older than retention_seconds
+        # is rolled first (which comes back here), so a log nobody appends to ages out too
+        now = int(time.time() * 1000)
+        if (self.retention_seconds is not None and self.active.size and
+                now - self.active.max_timestamp > self.retention_seconds * 1000):
+            self.roll()
+            return
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            too_big = self.retention_bytes is not None and self.size > self.retention_bytes
+            too_old = (self.retention_seconds is not None and
+                       now - oldest.max_timestamp > self.retention_seconds * 1000)
+            if not (too_big or too_old):
+                break
+            oldest.delete()
+            del self.segments[0]
+            del self.base_offsets[0]
+
+    def delete_before(self, offset:int) -> None:
+        # Drops closed segments that end before offset, used to compact a log
+        # after its live records were rewritten into a newer segment
+        while len(self.segments) > 1 and self.segments[1].base_offset <= offset:
+            self.segments[0].delete()
+            del self.segments[0]
+            del self.base_offsets[0]
+
+    def flush(self) -> None:
+        self.active.flush()
+
+    def close(self) -> None:
+        for segment in self.segments:
+            segment.close()
@@ -1,13 +1,59 @@
 import os
 import json
+import asyncio
+import time
+from collections import defaultdict
 from src.communicate.stub import *
+from src.communicate.frame import Envelope
+from src.data.columnar import compact, SCHEMAS, CLOSED_LOG
 
 # Log data (requests / responses) received by the server
 # Log data (requests / responses) sent by the server
+#
+# Logging runs as its own stage, off the broker's hot path:
+# - log_line only enqueues the encoded line on a bounded queue
+# - a background task collects lines for flush_interval (group commit)
+# - a worker thread formats the batch and writes it through long-lived handles
+# - when the queue is full, overflow='block' waits for room, 'drop' discards
+# - a log growing past roll_bytes is closed as logs/<kind>.<ms>.txt and compacted
+#   in the background into logs/columns/<kind>/<ms>/ (see src/data/columnar.py)
+# - query and solve lines are indexed as they are appended, <log>.idx holds
+#   'correlation id \t id \t choice_type \t received_ns \t byte offset' per line,
+#   the correlation id of the query message is what joins a solve to its query (see src/data/join.py)
+# - log sizes are re-read once per commit, a log truncated or removed meanwhile restarts at 0
+# - sampled (traced) lines record their time to disk in the broker's TraceCollector
 
 class Bookkeeper:
-    def __init__(self, protected_directory):
+    FLUSH_INTERVAL = 0.05 # seconds a group commit waits for more lines
+    FSYNC_INTERVAL = 1.0  # seconds between fsyncs with fsync='interval'
+    MAX_PENDING = 10000   # lines queued before backpressure kicks in
+    MAX_BATCH = 5000      # lines per group commit
+    ROLL_BYTES = 64 * 1024 * 1024 # text log size that closes it for compaction
+    CLOSED_LOG = CLOSED_LOG
+
+    def __init__(self, protected_directory, flush_interval=None, fsync='never',
+                 max_pending=None, overflow='block', roll_bytes=None, traces=None):
         self.protected_directory = protected_directory
+        self.flush_interval = self.FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self.fsync = fsync # 'never', 'commit' or 'interval'
+        self.max_pending = max_pending or self.MAX_PENDING
+        self.overflow = overflow # 'block' or 'drop'
+        self.roll_bytes = roll_bytes or self.ROLL_BYTES
+        self.log_directory = os.path.join(protected_directory, 'logs')
+        self.column_directory = os.path.join(self.log_directory, 'columns')
+        self.traces = traces # TraceCollector, or None to ignore traces
+
+        self.queue = None
+        self.task = None
+        self.holding = list() # taken off the queue by the writer, not committed yet
+        self.committing = None # commit running in the worker thread
+        self.handles = dict() # log path -> buffered file handle, open for the server's lifetime
+        self.buffers = defaultdict(list) # log path -> encoded lines of the current batch
+        self.sizes = dict() # log path -> bytes written and buffered, the next line's offset, per commit
+        self.last_fsync = time.monotonic()
+        self.counters = defaultdict(int) # logged, batches, blocked, dropped, errors, compacted, only touched on the loop
+        self.closed = list() # closed text logs waiting for compaction
+        self.compactor = None
 
     def _encode_dict(self, in_dict:dict):
         line = in_dict.values()
@@ -24,22 +70,34 @@ class Bookkeeper:
         line = ';'.join(in_list)
         return line
     
-    @staticmethod
-    def _write_line(filepath, line_items):
+    def _write_line(self, filepath, line_items, key=None, received_ns=None):
+        # key = (correlation id, id, choice_type) also adds the line to the log's index
         log = '\t'.join(line_items) + '\n'
         log = log.encode('utf-8')
-        with open(filepath, 'ab') as f:
-            f.write(log)
+        if filepath not in self.sizes:
+            self.sizes[filepath] = os.path.getsize(filepath) if os.path.exists(filepath) else 0
+        if key is not None:
+            entry = '\t'.join(key) + f'\t{received_ns or time.time_ns()}\t{self.sizes[filepath]}\n'
+            self.buffers[filepath + '.idx'].append(entry.encode('utf-8'))
+        self.sizes[filepath] += len(log)
+        self.buffers[filepath].append(log)
+
+    def _handle(self, filepath):
+        if filepath not in self.handles:
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            self.handles[filepath] = open(filepath, 'ab')
+        return self.handles[filepath]
   
 
-    def _log_query(self, query_message):
+    def _log_query(self, query_message, received_ns=None, correlation_id=''):
         log_path = self.protected_directory + 'logs/query.txt'
         server_dt = query_message.get('datetime','')
         origin_topic = query_message.get('topic','')
         line = query_message.get('message')  
         origin_id, target_line, choice_type, choice_line = self._decode_line(line)
         self._write_line(log_path,
-            [server_dt,origin_topic,origin_id,target_line,choice_type,choice_line]
+            [server_dt,origin_topic,origin_id,target_line,choice_type,choice_line],
+            key=(correlation_id or origin_id, origin_id, choice_type), received_ns=received_ns
         )
     
 
@@ -50,16 +108,15 @@ class Bookkeeper:
         result       = observe_message.get('result','')
         target       = observe_message.get('target',{})
         
-        target_line = self._serialize_dict(target)
+        target_line = self._encode_dict(target)
         self._write_line(log_path,
             [server_dt,message,target_line,result]
         )
 
 
-    def _log_solve(self, solve_message):
-        log_path = self.protected_directory + 'logs/solve.txt'
-        line     = solve_message.get('message')
-        line     = json.loads(line)
+    def _log_solve(self, solve_message, received_ns=None, kind='solve', correlation_id=''):
+        log_path = self.protected_directory + f'logs/{kind}.txt'
+        line     = self._decode_message(solve_message.get('message'))
 
         server_dt = solve_message.get('datetime','')
         choice = line.get('choice','')
@@ -68,23 +125,191 @@ class Bookkeeper:
         origin_id,target_line,choice_type,choice_line = self._decode_line(origin_string)
 
         self._write_line(log_path,
-            [server_dt,origin_id,target_line,choice_type,choice_line,choice,uncertainty]
+            [server_dt,origin_id,target_line,choice_type,choice_line,choice,uncertainty],
+            key=(correlation_id or origin_id, origin_id, choice_type), received_ns=received_ns
         )
 
 
-    async def log_line(self, line:str):
-        # append log line in bytes to file
-        line = line.decode('utf-8')
-        line = json.loads(line)
+    @staticmethod
+    def _decode_message(message) -> dict:
+        # Structured messages arrive nested (or decoded from the frame already),
+        # a JSON string only from older clients
+        return json.loads(message) if isinstance(message, str) else message
+
+    def _log(self, line):
+        # append log line in bytes to file, envelopes come from the broker as they are
+        received_ns = None
+        if isinstance(line, Envelope):
+            received_ns = line.received_ns
+            line = line.as_dict()
+        else:
+            line = line.decode('utf-8')
+            line = json.loads(line)
 
 
         topic = line.get('topic','')
+        correlation_id = line.get('id','') # of the query message, solves carry it back
 
         if topic == 'query':
-            self._log_query(line)
+            self._log_query(line, received_ns, correlation_id)
 
         if topic == 'solve':
-            self._log_solve(line)
+            self._log_solve(line, received_ns, correlation_id=correlation_id)
+
+        if topic == 'replay_solve': # kept apart, to compare with the original solves
+            self._log_solve(line, received_ns, kind='replay_solve', correlation_id=correlation_id)
+
+        if topic == 'observe':
+            self._log_observe(line.get('datetime',''), self._decode_message(line.get('message')))
         # Remaining
         # 'logs/subscribe.txt'
 
+    def _commit(self, batch) -> dict:
+        # Runs in the worker thread: format the batch, one write per log file.
+        # Returns its counts, _committed adds them to counters on the event loop
+        counts = defaultdict(int)
+        self.sizes.clear() # re-read below, the logs may have been truncated since the last commit
+        for filepath in [path for path in self.handles if not os.path.exists(path)]:
+            self.handles.pop(filepath).close() # removed, the next line reopens it
+        for line in batch:
+            try:
+                self._log(line)
+            except Exception as e:
+                counts['errors'] += 1
+                print(f'Error logging line: {e}')
+
+        for filepath, lines in self.buffers.items():
+            f = self._handle(filepath)
+            f.write(b''.join(lines))
+            f.flush()
+        self.buffers.clear()
+        # rolled once the whole batch, index included, is written
+        for filepath in [path for path, size in self.sizes.items() if size >= self.roll_bytes]:
+            self._roll(filepath)
+
+        now = time.monotonic()
+        if self.fsync == 'commit' or (self.fsync == 'interval' and now - self.last_fsync >= self.FSYNC_INTERVAL):
+            for f in self.handles.values():
+                os.fsync(f.fileno())
+            self.last_fsync = now
+        counts['logged'] = len(batch)
+        counts['batches'] = 1
+        return counts
+
+    def _merge(self, counts:dict) -> None:
+        for name, value in counts.items():
+            self.counters[name] += value
+
+    async def _committed(self, batch):
+        # The commit in the worker thread, then its counts and traces recorded on the loop
+        self._merge(await asyncio.to_thread(self._commit, batch))
+        if self.traces is not None:
+            for line in batch:
+                if isinstance(line, Envelope) and line.trace is not None:
+                    self.traces.record_logged(line.trace)
+
+    def _roll(self, filepath):
+        # The next line reopens a fresh file, the closed one keeps its lines for compaction
+        base, extension = os.path.splitext(filepath)
+        closed = f'{base}.{int(time.time() * 1000):013d}{extension}'
+        for source, target in ((filepath, closed), (filepath + '.idx', closed + '.idx')):
+            f = self.handles.pop(source, None)
+            if f is None:
+                continue
+            if self.fsync != 'never':
+                os.fsync(f.fileno())
+            f.close()
+            os.replace(source, target)
+        del self.sizes[filepath]
+        self.closed.append(closed)
+
+    def _compact(self, paths) -> dict:
+        # Runs in its own thread, each closed log becomes a column folder and is removed
+        counts = defaultdict(int)
+        for path in paths:
+            match = self.CLOSED_LOG.match(os.path.basename(path))
+            if match is None or match.group(1) not in SCHEMAS:
+                continue
+            kind, stamp = match.groups()
+            try:
+                rows = compact(path, os.path.join(self.column_directory, kind, stamp), kind)
+                os.remove(path)
+                if os.path.exists(path + '.idx'):
+                    os.remove(path + '.idx')
+                counts['compacted'] += rows
+            except Exception as e:
+                counts['errors'] += 1
+                print(f'Error compacting {path}: {e}')
+        return counts
+
+    async def _compacted(self, paths):
+        self._merge(await asyncio.to_thread(self._compact, paths))
+
+    def _start_compaction(self):
+        if self.closed and (self.compactor is None or self.compactor.done()):
+            paths, self.closed = self.closed, list()
+            self.compactor = asyncio.create_task(self._compacted(paths))
+
+    def _drain(self, limit):
+        batch = list()
+        while len(batch) < limit and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    async def _writer(self):
+        while True:
+            self.holding = [await self.queue.get()]
+            await asyncio.sleep(self.flush_interval) # let the group fill up
+            batch = self.holding + self._drain(self.MAX_BATCH - 1)
+            self.holding = list()
+            # shielded, cancelling the writer must not start a second commit next to this one
+            self.committing = asyncio.ensure_future(self._committed(batch))
+            await asyncio.shield(self.committing)
+            self._start_compaction()
+
+    async def start(self):
+        if self.task is None:
+            self.queue = asyncio.Queue(maxsize=self.max_pending)
+            self.task = asyncio.create_task(self._writer())
+            # logs closed before a restart but never compacted
+            if os.path.isdir(self.log_directory):
+                self.closed.extend(
+                    os.path.join(self.log_directory, name) for name in sorted(os.listdir(self.log_directory))
+                    if self.CLOSED_LOG.match(name)
+                )
+            self._start_compaction()
+
+    async def close(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        if self.committing is not None:
+            await self.committing
+
+        batch = self.holding + self._drain(self.queue.qsize())
+        self.holding = list()
+        if batch:
+            await self._committed(batch)
+        for f in self.handles.values():
+            f.close()
+        self.handles.clear()
+        if self.compactor is not None:
+            await self.compactor # closed logs not started yet are picked up on the next start
+
+    async def log_line(self, line):
+        # Enqueue only, the background writer does the formatting and the I/O
+        if self.task is None:
+            await self.start()
+        try:
+            self.queue.put_nowait(line)
+        except asyncio.QueueFull:
+            if self.overflow == 'drop':
+                self.counters['dropped'] += 1
+                return
+            self.counters['blocked'] += 1
+            await self.queue.put(line)
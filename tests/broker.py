@@ -0,0 +1,77 @@
+# In-process broker for the behaviour tests, clients reach it with transport='local'
+#
+#   async with running(tmp_path) as broker:
+#       async with connected() as client:
+#           ...
+
+import asyncio
+from contextlib import asynccontextmanager
+from src.communicate.mq import MessageQueue, AsyncClient
+from src.communicate.stub import Query, Solve
+
+HOST, PORT = 'localhost', 0 # the TCP listener takes any free port, local clients find the broker by (HOST, 0)
+
+
+@asynccontextmanager
+async def running(folder, **options):
+    broker = MessageQueue(HOST, PORT, f'{folder}/', **options)
+    task = asyncio.create_task(broker._run())
+    await broker.listening.wait()
+    try:
+        yield broker
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await broker._close()
+
+
+@asynccontextmanager
+async def connected(**kwargs):
+    client = AsyncClient(HOST, PORT, transport='local', **kwargs)
+    await client.connect()
+    try:
+        yield client
+    finally:
+        await client._close()
+
+
+async def take(client, count, timeout=2.0) -> list:
+    # The next count messages the client receives
+    messages = list()
+    async def read():
+        async for message in client.receive():
+            messages.append(message)
+            if len(messages) == count:
+                return
+    await asyncio.wait_for(read(), timeout)
+    return messages
+
+
+async def nothing(client, wait=0.2) -> bool:
+    # True if the client receives nothing within wait seconds
+    try:
+        await take(client, 1, wait)
+    except asyncio.TimeoutError:
+        return True
+    return False
+
+
+def make_query(query_id, choice_types=('color', 'size'), target='x') -> Query:
+    # One line, and one Solve, per choice type
+    return Query(id=query_id, target={'name': target}, choices={t: ['a', 'b'] for t in choice_types})
+
+
+async def solve(client, message, choice='a'):
+    # Answers a query line the way agent.py does, routed back by the message's correlation id
+    line = message['message'].strip('\n')
+    await client.solve(Solve(id=line.split('\t', 1)[0], origin_topic=message['topic'], origin_string=line,
+                             choice=choice, uncertainty=0.5), correlation_id=message['id'])
+
+
+async def agent(client, topic='query', ack=True, choice='a'):
+    # Solves every line it receives until cancelled
+    await client.subscribe(topic)
+    async for message in client.receive():
+        await solve(client, message, choice)
+        if ack:
+            await client.ack(message)
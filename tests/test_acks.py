@@ -0,0 +1,74 @@
+import asyncio
+from tests.broker import running, connected, take, nothing
+
+
+def test_acked_messages_are_not_redelivered(tmp_path):
+    async def run():
+        async with running(tmp_path, visibility_timeout=0.2) as broker:
+            async with connected() as sender, connected() as worker:
+                await worker.subscribe('jobs')
+                for i in range(5):
+                    await sender.send('jobs', f'j{i}', 'one')
+                for message in await take(worker, 5):
+                    await worker.ack(message)
+                assert await nothing(worker, 0.5)
+                return broker.in_flight, dict(broker.metrics.deliveries)
+
+    in_flight, deliveries = asyncio.run(run())
+    assert not in_flight
+    assert deliveries['acked'] == 5 and 'redelivered' not in deliveries
+
+
+def test_unacked_messages_go_to_another_subscriber(tmp_path):
+    async def run():
+        async with running(tmp_path, visibility_timeout=0.2) as broker:
+            async with connected() as sender, connected() as stalled:
+                await stalled.subscribe('jobs')
+                await sender.send('jobs', 'j0', 'one')
+                assert [m['message'] for m in await take(stalled, 1)] == ['j0'] # never acked
+                async with connected() as worker:
+                    await worker.subscribe('jobs')
+                    redelivered = await take(worker, 1, timeout=1.0)
+                    await worker.ack(redelivered[0])
+                    assert await nothing(stalled, 0.4)
+                return redelivered, dict(broker.metrics.deliveries)
+
+    redelivered, deliveries = asyncio.run(run())
+    assert [(m['message'], m['index']) for m in redelivered] == [('j0', 0)]
+    assert deliveries['redelivered'] == 1 and deliveries['acked'] == 1
+
+
+def test_a_disconnecting_subscriber_hands_its_messages_over(tmp_path):
+    async def run():
+        async with running(tmp_path) as broker: # default visibility timeout, far away
+            async with connected() as sender, connected() as worker:
+                await worker.subscribe('jobs')
+                async with connected() as leaving:
+                    await leaving.subscribe('jobs')
+                    for i in range(10):
+                        await sender.send('jobs', f'j{i}', 'one')
+                    assert broker.in_flight_by_writer.get(leaving.local) # some went to leaving, never acked
+                received = await take(worker, 10, timeout=1.0)
+                for message in received:
+                    await worker.ack(message)
+                await asyncio.sleep(0.05)
+                return received, broker.in_flight
+
+    received, in_flight = asyncio.run(run())
+    assert sorted(m['message'] for m in received) == sorted(f'j{i}' for i in range(10))
+    assert not in_flight
+
+
+def test_messages_are_dropped_after_max_deliveries(tmp_path):
+    async def run():
+        async with running(tmp_path, visibility_timeout=0.1, max_deliveries=3) as broker:
+            async with connected() as sender, connected() as stalled:
+                await stalled.subscribe('jobs')
+                await sender.send('jobs', 'j0', 'one')
+                deliveries = await take(stalled, 3, timeout=2.0)
+                assert await nothing(stalled, 0.4)
+                return deliveries, dict(broker.metrics.deliveries), broker.in_flight
+
+    deliveries, counters, in_flight = asyncio.run(run())
+    assert [m['message'] for m in deliveries] == ['j0'] * 3
+    assert counters['dropped'] == 1 and not in_flight
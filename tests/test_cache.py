@@ -0,0 +1,54 @@
+import time
+from src.actors.cache import PredictionCache
+
+
+def test_key_ignores_the_query_id():
+    assert PredictionCache.key('q1\tt\tcolor\tred;blue\n') == PredictionCache.key('q2\tt\tcolor\tred;blue')
+    assert PredictionCache.key('q1\tt\tcolor\tred') != PredictionCache.key('q1\tt\tsize\tred')
+
+
+def test_hits_and_misses():
+    cache = PredictionCache()
+    key = PredictionCache.key('q1\tt\tcolor\tred;blue')
+    assert cache.get(key) is None
+    cache.put(key, 'red', 0.5)
+    assert cache.get(key) == ('red', 0.5)
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 1)
+    assert stats['hit_rate'] == 0.5
+
+
+def test_least_recently_used_goes_first():
+    cache = PredictionCache(max_entries=2)
+    cache.put('a', 'x', 0.0)
+    cache.put('b', 'y', 0.0)
+    cache.get('a') # b is now the oldest
+    cache.put('c', 'z', 0.0)
+    assert cache.get('b') is None
+    assert cache.get('a') == ('x', 0.0)
+    assert cache.stats()['evictions'] == 1
+
+
+def test_entries_expire():
+    cache = PredictionCache(ttl=0.01)
+    cache.put('a', 'x', 0.0)
+    time.sleep(0.02)
+    assert cache.get('a') is None
+    assert cache.stats()['expirations'] == 1
+    assert cache.stats()['entries'] == 0
+
+
+def test_another_model_clears_the_cache():
+    cache = PredictionCache()
+    cache.use_model('random:1')
+    cache.put('a', 'x', 0.0)
+    cache.use_model('random:1')
+    assert cache.get('a') == ('x', 0.0)
+    cache.use_model('random:2')
+    assert cache.get('a') is None
+
+
+def test_caches_are_independent():
+    first, second = PredictionCache(), PredictionCache()
+    first.put('a', 'x', 0.0)
+    assert second.get('a') is None
@@ -0,0 +1,71 @@
+import asyncio
+from tests.broker import running, connected, make_query, solve
+
+
+async def slow_agent(client, seen:list, delay=0.1):
+    # Holds every line for delay seconds, so identical ones arrive while it is in flight
+    await client.subscribe('query')
+    async for message in client.receive():
+        seen.append(message['message'])
+        await asyncio.sleep(delay)
+        await solve(client, message)
+        await client.ack(message)
+
+
+def test_identical_queries_in_flight_are_solved_once(tmp_path):
+    async def run():
+        async with running(tmp_path, coalesce_topics=('query',)) as broker:
+            async with connected() as solver, connected() as first, connected() as second:
+                seen = list()
+                solving = asyncio.create_task(slow_agent(solver, seen))
+                try:
+                    replies = await asyncio.gather(*(
+                        client.request(make_query(f'q{i}'), timeout=2)
+                        for i, client in enumerate([first, second, first, second, first])
+                    ))
+                finally:
+                    solving.cancel()
+                return seen, replies, dict(broker.metrics.coalesced), broker.flights
+
+    seen, replies, coalesced, flights = asyncio.run(run())
+    assert len(seen) == 2 # one line per choice type, from the first query
+    assert coalesced == {'followers': 8, 'answered': 8}
+    assert not flights
+    for i, solves in enumerate(replies):
+        assert sorted(s.origin_string.split('\t')[2] for s in solves) == ['color', 'size']
+        assert {s.id for s in solves} == {f'q{i}'} # each requester sees its own id and line
+        assert all(s.origin_string.startswith(f'q{i}\t') for s in solves)
+
+
+def test_different_queries_are_not_coalesced(tmp_path):
+    async def run():
+        async with running(tmp_path, coalesce_topics=('query',)) as broker:
+            async with connected() as solver, connected() as client:
+                seen = list()
+                solving = asyncio.create_task(slow_agent(solver, seen, delay=0.01))
+                try:
+                    await asyncio.gather(*(
+                        client.request(make_query(f'q{i}', target=f't{i}'), timeout=2) for i in range(3)
+                    ))
+                finally:
+                    solving.cancel()
+                return seen, dict(broker.metrics.coalesced)
+
+    seen, coalesced = asyncio.run(run())
+    assert len(seen) == 6
+    assert not coalesced.get('followers')
+
+
+def test_topics_are_only_coalesced_when_asked(tmp_path):
+    async def run():
+        async with running(tmp_path):
+            async with connected() as solver, connected() as client:
+                seen = list()
+                solving = asyncio.create_task(slow_agent(solver, seen, delay=0.01))
+                try:
+                    await asyncio.gather(*(client.request(make_query(f'q{i}'), timeout=2) for i in range(3)))
+                finally:
+                    solving.cancel()
+                return seen
+
+    assert len(asyncio.run(run())) == 6
@@ -0,0 +1,70 @@
+import os
+import numpy as np
+from src.data.columnar import compact, ColumnarLog, SCHEMAS
+
+DATETIME = '01/01/2024, 00:00:00'
+
+
+def write_log(path, count, indexed=True):
+    # count query lines and a torn one, indexed the way the bookkeeper does
+    lines = ['\t'.join([DATETIME, 'query', f'q{i}', 'a;b', ('color', 'size')[i % 2], 'red;blue']) + '\n'
+             for i in range(count)]
+    lines.insert(3, 'torn line\n') # skipped, and not in the index
+    index, offset, i = list(), 0, 0
+    for line in lines:
+        if line != 'torn line\n':
+            index.append(f'c{i}\tq{i}\tcolor\t{1000 + i}\t{offset}\n')
+            i += 1
+        offset += len(line.encode('utf-8'))
+    with open(path, 'w') as f:
+        f.writelines(lines)
+    if indexed:
+        with open(path + '.idx', 'w') as f:
+            f.writelines(index)
+
+
+def test_compact_writes_typed_columns(tmp_path):
+    write_log(str(tmp_path / 'query.1.txt'), 10)
+    rows = compact(str(tmp_path / 'query.1.txt'), str(tmp_path / 'columns' / 'query' / '1'), 'query')
+    assert rows == 10
+    log = ColumnarLog(str(tmp_path / 'columns'), 'query')
+    assert log.count() == 10
+
+    datetimes = log.column('datetime')
+    assert datetimes.dtype == np.int64 and len(set(datetimes.tolist())) == 1 and datetimes[0] > 0
+    assert log.column('received_ns').tolist() == list(range(1000, 1010))
+
+    choice_type = log.column('choice_type')
+    assert int((choice_type == 'color').sum()) == 5
+    assert choice_type.counts() == {'color': 5, 'size': 5}
+    assert int((choice_type == 'weight').sum()) == 0
+    assert log.column('correlation_id').decode().tolist() == [f'c{i}' for i in range(10)]
+
+
+def test_segments_without_an_index_read_as_empty(tmp_path):
+    write_log(str(tmp_path / 'query.1.txt'), 4, indexed=False)
+    write_log(str(tmp_path / 'query.2.txt'), 4)
+    for stamp in ('1', '2'):
+        compact(str(tmp_path / f'query.{stamp}.txt'), str(tmp_path / 'columns' / 'query' / stamp), 'query')
+    log = ColumnarLog(str(tmp_path / 'columns'), 'query')
+    assert log.column('received_ns').tolist() == [0] * 4 + list(range(1000, 1004))
+    assert log.column('correlation_id').decode().tolist() == [''] * 4 + [f'c{i}' for i in range(4)]
+    assert list(log.rows('id', 'received_ns'))[3:5] == [('q3', None), ('q0', 1000)]
+    assert len(log.column('id')) == 8
+
+
+def test_dictionaries_merge_across_segments(tmp_path):
+    for stamp, count in (('1', 3), ('2', 5)):
+        write_log(str(tmp_path / f'query.{stamp}.txt'), count)
+        compact(str(tmp_path / f'query.{stamp}.txt'), str(tmp_path / 'columns' / 'query' / stamp), 'query')
+    ids = ColumnarLog(str(tmp_path / 'columns'), 'query').column('id')
+    assert ids.decode().tolist() == [f'q{i}' for i in range(3)] + [f'q{i}' for i in range(5)]
+    assert ids.counts()['q1'] == 2
+
+
+def test_compaction_leaves_no_partial_segment(tmp_path):
+    write_log(str(tmp_path / 'query.1.txt'), 2)
+    target = str(tmp_path / 'columns' / 'query' / '1')
+    compact(str(tmp_path / 'query.1.txt'), target, 'query')
+    assert not os.path.exists(target + '.tmp')
+    assert set(SCHEMAS['query']) <= {name.split('.')[0] for name in os.listdir(target)}
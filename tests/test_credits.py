@@ -0,0 +1,73 @@
+import asyncio
+from tests.broker import running, connected, take, nothing
+
+
+def test_prefetch_caps_unacked_messages(tmp_path):
+    async def run():
+        async with running(tmp_path) as broker:
+            async with connected() as sender, connected() as worker:
+                await worker.subscribe('jobs', prefetch=2)
+                for i in range(5):
+                    await sender.send('jobs', f'j{i}', 'one')
+                first = await take(worker, 2)
+                assert await nothing(worker) # out of credits
+                assert len(broker.backlog['jobs']) == 3
+                received = list(first)
+                while len(received) < 5: # every ack gives one credit back, oldest waiting first
+                    await worker.ack(received[len(received) - 2])
+                    received += await take(worker, 1)
+                return received, dict(broker.backlog), dict(broker.metrics.deliveries)
+
+    received, backlog, deliveries = asyncio.run(run())
+    assert [m['message'] for m in received] == [f'j{i}' for i in range(5)]
+    assert not backlog
+    assert deliveries['backlogged'] == 3 and deliveries['from_backlog'] == 3
+
+
+def test_backlog_goes_to_subscribers_with_credits(tmp_path):
+    async def run():
+        async with running(tmp_path) as broker:
+            async with connected() as sender, connected() as slow, connected() as fast:
+                await slow.subscribe('jobs', prefetch=1) # takes one and never acks
+                await fast.subscribe('jobs', prefetch=4)
+                received = list()
+                async def work():
+                    async for message in fast.receive():
+                        received.append(message)
+                        await fast.ack(message)
+                working = asyncio.create_task(work())
+                for i in range(40):
+                    await sender.send('jobs', f'j{i}', 'one')
+                await asyncio.sleep(0.2)
+                working.cancel()
+                held = await take(slow, 1)
+                assert await nothing(slow)
+                return held, received, dict(broker.outstanding)
+
+    held, received, outstanding = asyncio.run(run())
+    assert len(held) == 1 and len(received) == 39
+    assert {m['message'] for m in held + received} == {f'j{i}' for i in range(40)}
+    assert sorted(outstanding.values()) == [1] # only the slow subscriber's message is unacked
+
+
+def test_unsubscribing_returns_credits_to_the_others(tmp_path):
+    async def run():
+        async with running(tmp_path) as broker:
+            async with connected() as sender, connected() as worker:
+                await worker.subscribe('jobs', prefetch=1)
+                async with connected() as leaving:
+                    await leaving.subscribe('jobs', prefetch=1)
+                    for i in range(4):
+                        await sender.send('jobs', f'j{i}', 'one')
+                    await asyncio.sleep(0.05)
+                # what leaving held is handed on, worker gets all four one ack at a time
+                received = list()
+                while len(received) < 4:
+                    message = (await take(worker, 1, timeout=1.0))[0]
+                    received.append(message)
+                    await worker.ack(message)
+                return received, dict(broker.backlog)
+
+    received, backlog = asyncio.run(run())
+    assert sorted(m['message'] for m in received) == [f'j{i}' for i in range(4)]
+    assert not backlog
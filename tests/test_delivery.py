@@ -0,0 +1,97 @@
+import asyncio
+from src.communicate.mq import MessageQueue
+from tests.broker import running, connected, take, nothing
+
+
+def bodies(messages):
+    return sorted((m['topic'], m['index'], m['message']) for m in messages)
+
+
+def test_subscribe_replays_pending_and_after_last_seen(tmp_path):
+    async def run():
+        async with running(tmp_path):
+            async with connected() as sender:
+                for i in range(3):
+                    await sender.send('jobs', f'j{i}', 'one')
+                await sender.send('news', 'n0', 'all')
+            async with connected() as now, connected() as everything:
+                await now.subscribe('news') # from now: nothing old
+                assert await nothing(now)
+                await everything.subscribe('jobs', last_seen=-1)
+                await everything.subscribe('news', last_seen=-1)
+                received = await take(everything, 4)
+                assert await nothing(everything) # pending jobs are gone once delivered
+                return received
+
+    assert bodies(asyncio.run(run())) == [('jobs', 0, 'j0'), ('jobs', 1, 'j1'), ('jobs', 2, 'j2'), ('news', 0, 'n0')]
+
+
+def test_pending_survives_a_restart(tmp_path):
+    async def send():
+        async with running(tmp_path):
+            async with connected() as sender:
+                for i in range(3):
+                    await sender.send('jobs', f'j{i}', 'one')
+                await sender.send('news', 'n0', 'all')
+
+    async def receive(count):
+        async with running(tmp_path):
+            async with connected() as client:
+                await client.subscribe('jobs', last_seen=-1)
+                await client.subscribe('news', last_seen=-1)
+                received = await take(client, count) if count else []
+                assert await nothing(client)
+                for message in received:
+                    if message['topic'] == 'jobs':
+                        await client.ack(message)
+                await client.flush()
+                return received
+
+    asyncio.run(send())
+    assert bodies(asyncio.run(receive(4))) == [('jobs', 0, 'j0'), ('jobs', 1, 'j1'), ('jobs', 2, 'j2'), ('news', 0, 'n0')]
+    # acked and checkpointed at shutdown, only the 'all' message comes back
+    assert bodies(asyncio.run(receive(1))) == [('news', 0, 'n0')]
+
+
+def test_unacked_jobs_are_pending_after_a_restart(tmp_path):
+    async def run(ack):
+        async with running(tmp_path):
+            async with connected() as client:
+                await client.subscribe('jobs', last_seen=-1)
+                if not ack:
+                    async with connected() as sender:
+                        await sender.send('jobs', 'j0', 'one')
+                received = await take(client, 1)
+                if ack:
+                    await client.ack(received[0])
+                    await client.flush()
+                    await asyncio.sleep(0.05)
+                return received
+
+    assert bodies(asyncio.run(run(ack=False))) == [('jobs', 0, 'j0')] # never acked
+    assert bodies(asyncio.run(run(ack=True))) == [('jobs', 0, 'j0')]
+    async def after():
+        async with running(tmp_path):
+            async with connected() as client:
+                await client.subscribe('jobs', last_seen=-1)
+                return await nothing(client)
+    assert asyncio.run(after())
+
+
+def test_retention_drops_pending_records_that_are_gone(tmp_path, monkeypatch):
+    monkeypatch.setattr(MessageQueue, 'HOUSEKEEPING_INTERVAL', 0.1)
+    async def run():
+        async with running(tmp_path, retention_seconds=0.2) as broker:
+            async with connected() as sender:
+                await sender.send('jobs', 'j0', 'one')
+            assert broker.pending[('jobs', 0)] == {0}
+            await asyncio.sleep(0.5) # an idle topic ages out too
+            log = broker.logs[('jobs', 0)]
+            assert log.start_offset == 1
+            assert not broker.pending[('jobs', 0)]
+            assert broker.metrics.deliveries['expired'] == 1
+            async with connected() as client:
+                await client.subscribe('jobs', last_seen=-1)
+                return await nothing(client)
+
+    assert asyncio.run(run())
@@ -0,0 +1,95 @@
+import asyncio, json
+import pytest
+from src.communicate.frame import (
+    FrameCodec, Envelope, HEADER, MAX_FRAME, NO_TOPIC, SEND, DELIVER, DECLARE, CONTROL, QUIT, BATCH, split_by_size
+)
+
+
+def decode_one(data):
+    frames = FrameCodec().decode(data)
+    assert len(frames) == 1
+    return frames[0]
+
+
+def test_send_round_trip():
+    codec = FrameCodec()
+    frame = decode_one(codec.encode_send('query', b'q1\tx\tc0\t1;2', 'one', key='q1@a', partition=3))
+    assert (frame.command, frame.topic, frame.delivery, frame.partition) == (SEND, 'query', 'one', 3)
+    assert (frame.key, frame.payload, frame.structured, frame.trace) == ('q1@a', b'q1\tx\tc0\t1;2', False, None)
+
+
+def test_topic_declared_once_per_connection():
+    sender, receiver = FrameCodec(), FrameCodec()
+    first = sender.encode_send('query', b'a', 'all')
+    second = sender.encode_send('query', b'b', 'all')
+    assert HEADER.unpack_from(first)[0] == DECLARE
+    assert HEADER.unpack_from(second)[0] == SEND
+    assert [frame.topic for frame in receiver.decode(first + second)] == ['query', 'query']
+
+
+def test_envelope_round_trip_with_trace():
+    envelope = Envelope('solve', 'all', body={'choice': '2'}, id='q1@a', partition=1, index=42,
+                        trace={'sent': 1, 'broker_in': 2})
+    frame = decode_one(FrameCodec().encode_envelope(envelope))
+    assert (frame.command, frame.topic, frame.partition, frame.offset) == (DELIVER, 'solve', 1, 42)
+    assert frame.structured and json.loads(frame.payload) == {'choice': '2'}
+    assert frame.trace == {'sent': 1, 'broker_in': 2}
+
+
+def test_control_and_quit_carry_no_topic():
+    codec = FrameCodec()
+    control = codec.encode_control({'command': 'subscribe', 'topic': 'query'})
+    quit = codec.encode_quit()
+    assert HEADER.unpack_from(control)[2] == NO_TOPIC
+    assert codec.out_topics == {} # nothing declared
+    frames = FrameCodec().decode(control + quit)
+    assert [frame.command for frame in frames] == [CONTROL, QUIT]
+    assert json.loads(frames[0].payload) == {'command': 'subscribe', 'topic': 'query'}
+
+
+def test_batch_round_trip():
+    sender, receiver = FrameCodec(), FrameCodec()
+    frames = [sender.encode_send(topic, f'm{i}'.encode(), 'all') for i, topic in enumerate(['a', 'b', 'a'])]
+    batch, = receiver.decode(sender.encode_batch(frames))
+    assert batch.command == BATCH
+    inner = receiver.decode(batch.payload)
+    assert [(frame.topic, frame.payload) for frame in inner] == [('a', b'm0'), ('b', b'm1'), ('a', b'm2')]
+
+
+def test_record_round_trip():
+    envelope = Envelope('query', 'one', b'line', id='q1@a', datetime='18/10/2026, 12:00:00')
+    copy = Envelope.from_record('query', 2, 7, envelope.to_record())
+    assert (copy.topic, copy.delivery, copy.payload, copy.id, copy.datetime) == \
+           ('query', 'one', b'line', 'q1@a', '18/10/2026, 12:00:00')
+    assert (copy.partition, copy.index, copy.structured) == (2, 7, False)
+
+
+def read_all(data):
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        codec = FrameCodec()
+        frames = list()
+        while (frame := await codec.read(reader)) is not None:
+            frames.append(frame)
+        return frames
+    return asyncio.run(run())
+
+
+def test_read_from_stream():
+    codec = FrameCodec()
+    data = codec.encode_send('query', b'a', 'one', trace={'sent': 1}) + codec.encode_send('query', b'b', 'all')
+    frames = read_all(data + data[:5]) # a torn header at the end reads as end of stream
+    assert [(frame.payload, frame.trace) for frame in frames] == [(b'a', {'sent': 1}), (b'b', None)]
+
+
+def test_read_rejects_oversized_frame():
+    with pytest.raises(ValueError):
+        read_all(HEADER.pack(SEND, 0, NO_TOPIC, 0, 0, 0, MAX_FRAME + 1))
+
+
+def test_split_by_size():
+    runs = list(split_by_size([3, 3, 3, 10, 1], size=lambda n: n, limit=6))
+    assert runs == [[3, 3], [3], [10], [1]]
+    assert list(split_by_size([], size=len)) == []
@@ -0,0 +1,87 @@
+import asyncio
+from itertools import count
+from src.communicate.group import ConsumerGroup, partition_for
+from tests.broker import running, connected, take, nothing
+
+
+def owned(group, member):
+    return sorted(p for p, owner in group.assignment.items() if owner == member)
+
+
+def test_partition_for_keys_and_round_robin():
+    counter = count()
+    assert partition_for('q1', 1, counter) == 0
+    assert partition_for('q1', 8, counter) == partition_for('q1', 8, counter)
+    assert [partition_for('', 3, counter) for _ in range(4)] == [0, 1, 2, 0]
+
+
+def test_rebalance_is_even_and_sticky():
+    group = ConsumerGroup('agents', 'query', 8, 0)
+    assert group.join('a') == {p: 'a' for p in range(8)}
+
+    moved = group.join('b')
+    assert set(moved.values()) == {'b'} and len(moved) == 4 # only what b takes moves
+    before = dict(group.assignment)
+
+    moved = group.join('c')
+    assert set(moved.values()) == {'c'} and len(moved) == 2
+    assert sorted(len(owned(group, m)) for m in 'abc') == [2, 3, 3]
+    assert all(before[p] == owner for p, owner in group.assignment.items() if owner != 'c')
+
+    kept = {m: owned(group, m) for m in 'abc'}
+    moved = group.leave('b') # b's partitions move, nobody else's
+    assert sorted(moved) == kept['b']
+    assert all(set(kept[m]) <= set(owned(group, m)) for m in 'ac')
+    assert sorted(len(owned(group, m)) for m in 'ac') == [4, 4]
+    assert group.leave('a') and owned(group, 'c') == list(range(8))
+    assert group.leave('c') == {} and group.assignment == {}
+
+
+def test_rebalance_more_members_than_partitions():
+    group = ConsumerGroup('agents', 'query', 2, 0)
+    for member in 'abc':
+        group.join(member)
+    assert owned(group, 'a') == [0] and owned(group, 'b') == [1] and owned(group, 'c') == []
+    assert group.leave('a') == {0: 'c'}
+
+
+def test_members_share_partitions_and_resume_from_commits(tmp_path):
+    async def run():
+        async with running(tmp_path, partitions={'jobs': 4}):
+            async with connected() as sender, connected() as first, connected() as second:
+                await first.subscribe('jobs', group='workers')
+                await second.subscribe('jobs', group='workers')
+                for i in range(40):
+                    await sender.send('jobs', f'j{i}', 'one', id=f'q{i}')
+                received = await take(first, 20) + await take(second, 20)
+                first_partitions = {m['partition'] for m in received[:20]}
+                second_partitions = {m['partition'] for m in received[20:]}
+                assert first_partitions.isdisjoint(second_partitions)
+                assert sorted(m['message'] for m in received) == sorted(f'j{i}' for i in range(40))
+                for message in received[:20]:
+                    await first.commit(message, 'workers')
+                await first.flush()
+                await asyncio.sleep(0.05)
+            # second never committed: its partitions start over for the next member
+            async with connected() as member:
+                await member.subscribe('jobs', group='workers')
+                replayed = await take(member, 20)
+                assert await nothing(member)
+                return sorted(m['message'] for m in replayed), sorted(m['message'] for m in received[20:])
+
+    replayed, uncommitted = asyncio.run(run())
+    assert replayed == uncommitted
+
+
+def test_fetch_batch_reads_each_partition_from_its_offset(tmp_path):
+    async def run():
+        async with running(tmp_path, partitions={'jobs': 2}) as broker:
+            async with connected() as client:
+                for i in range(20):
+                    await client.send('jobs', f'j{i}', 'all')
+                counts = {p: broker.indexs[('jobs', p)] for p in range(2)}
+                await client.fetch_batch({'jobs': {0: counts[0] - 2, 1: counts[1] - 1, 7: 0}})
+                return await take(client, 3)
+
+    fetched = asyncio.run(run())
+    assert sorted(m['partition'] for m in fetched) == [0, 0, 1]
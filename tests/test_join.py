@@ -0,0 +1,93 @@
+import asyncio, os
+import pytest
+from src.data.store import Bookkeeper
+from src.data.join import LogJoin
+from src.data.columnar import id_key
+from tests.test_store import query_line, solve_line
+
+COUNT = 40
+
+
+@pytest.fixture(scope='module')
+def logs(tmp_path_factory):
+    # Rolled often, so the join sees compacted segments and text logs
+    folder = tmp_path_factory.mktemp('logs')
+    async def run():
+        bookkeeper = Bookkeeper(f'{folder}/', flush_interval=0.001, roll_bytes=1500)
+        for i in range(COUNT):
+            await bookkeeper.log_line(query_line(i, f'c{i}'))
+            await bookkeeper.log_line(solve_line(i, f'c{i}'))
+            await asyncio.sleep(0.002)
+        await bookkeeper.close()
+        await bookkeeper.start() # compacts the closed logs left behind
+        await bookkeeper.close()
+    asyncio.run(run())
+    assert os.listdir(folder / 'logs' / 'columns' / 'query')
+    assert os.path.exists(folder / 'logs' / 'query.txt')
+    return folder
+
+
+def test_id_key_orders_numbers():
+    assert sorted(['q10', 'q9', 'q1', 'bench_2', 'bench_10'], key=id_key) == ['bench_2', 'bench_10', 'q1', 'q9', 'q10']
+
+
+def test_join_pairs_every_query(logs):
+    join = LogJoin(f'{logs}/')
+    pairs = list(join.join())
+    assert sorted((query['id'] for query, _, _ in pairs), key=id_key) == [f'q{i}' for i in range(COUNT)]
+    assert all(query['id'] == solve['id'] and latency >= 0 for query, solve, latency in pairs)
+    join.close()
+
+
+def test_id_ranges_compare_numbers(logs):
+    join = LogJoin(f'{logs}/')
+    assert sorted(query['id'] for query, _, _ in join.join(ids=('q9', 'q10'))) == ['q10', 'q9']
+    assert sorted((query['id'] for query, _, _ in join.join(ids=('q2', 'q12'))), key=id_key) == \
+        [f'q{i}' for i in range(2, 13)]
+    assert list(join.join(ids=('r0', 'r9'))) == []
+    join.close()
+
+
+def test_time_window_matches_a_scan(logs):
+    join = LogJoin(f'{logs}/')
+    received = [entry[0] for entry in join.entries('query')]
+    assert received == sorted(received)
+    since, until = received[10], received[30]
+    expected = {entry[2] for entry in join.entries('query') if since <= entry[0] < until}
+    got = {query['id'] for query, _, _ in join.join(since_ns=since, until_ns=until)}
+    assert got == expected and len(got) == 20
+    join.close()
+
+
+def test_rows_have_the_same_types_from_text_and_columns(logs):
+    join = LogJoin(f'{logs}/')
+    locations = [entry[4] for entry in join.entries('solve')]
+    compacted = [join.row('solve', location) for location in locations if os.path.isdir(location[0])]
+    text = [join.row('solve', location) for location in locations if not os.path.isdir(location[0])]
+    assert compacted and text
+    for row in (compacted[0], text[-1]):
+        assert isinstance(row['datetime'], int) and row['datetime'] > 0
+        assert row['uncertainty'] == 0.25
+        assert row['choice'] == 'red' and row['choice_type'] == 'color'
+    assert compacted[0]['datetime'] == text[-1]['datetime']
+    join.close()
+
+
+def test_text_index_follows_the_active_log(tmp_path):
+    async def write(start, stop):
+        bookkeeper = Bookkeeper(f'{tmp_path}/', flush_interval=0.001)
+        for i in range(start, stop):
+            await bookkeeper.log_line(query_line(i, f'c{i}'))
+            await bookkeeper.log_line(solve_line(i, f'c{i}'))
+        await bookkeeper.close()
+
+    asyncio.run(write(0, 5))
+    join = LogJoin(f'{tmp_path}/')
+    assert len(list(join.join())) == 5
+    asyncio.run(write(5, 8)) # appended after the index was read
+    assert len(list(join.join())) == 8
+    for path in ('query.txt', 'query.txt.idx'): # reset
+        open(tmp_path / 'logs' / path, 'w').close()
+    asyncio.run(write(8, 9))
+    assert [query['id'] for query, _, _ in join.join()] == ['q8']
+    join.close()
@@ -0,0 +1,61 @@
+import asyncio
+from tests.broker import running, connected, take, nothing, make_query, agent
+
+
+def test_replies_go_to_the_requester_only(tmp_path):
+    async def run():
+        async with running(tmp_path) as broker:
+            async with connected() as solver, connected() as first, connected() as second, \
+                       connected() as listener:
+                await listener.subscribe('solve')
+                solving = asyncio.create_task(agent(solver))
+                try:
+                    replies = await asyncio.gather(
+                        first.request(make_query('q1'), timeout=2),
+                        second.request(make_query('q2', choice_types=('color', 'size', 'weight')), timeout=2)
+                    )
+                    assert await nothing(listener) # routed replies are not broadcast
+                finally:
+                    solving.cancel()
+                assert not broker.query_subscribers # every route completed
+                return replies
+
+    first, second = asyncio.run(run())
+    assert sorted(solve.id for solve in first) == ['q1', 'q1']
+    assert sorted(solve.origin_string.split('\t')[2] for solve in second) == ['color', 'size', 'weight']
+
+
+def test_same_query_id_from_two_clients(tmp_path):
+    # Query ids repeat across clients, the correlation id keeps their replies apart
+    async def run():
+        async with running(tmp_path):
+            async with connected() as solver, connected() as first, connected() as second:
+                solving = asyncio.create_task(agent(solver))
+                try:
+                    return await asyncio.gather(
+                        first.request(make_query('q1', target='first'), timeout=2),
+                        second.request(make_query('q1', target='second'), timeout=2)
+                    )
+                finally:
+                    solving.cancel()
+
+    first, second = asyncio.run(run())
+    assert {solve.origin_string.split('\t')[1] for solve in first} == {'first'}
+    assert {solve.origin_string.split('\t')[1] for solve in second} == {'second'}
+
+
+def test_unrouted_solves_reach_subscribers(tmp_path):
+    async def run():
+        async with running(tmp_path):
+            async with connected() as solver, connected() as sender, connected() as listener:
+                await listener.subscribe('solve')
+                solving = asyncio.create_task(agent(solver))
+                try:
+                    for line in make_query('q1').encode(): # no correlation id, so no route back
+                        await sender.send('query', sender.write_line(line), 'one')
+                    return await take(listener, 2)
+                finally:
+                    solving.cancel()
+
+    solves = asyncio.run(run())
+    assert [message['message']['id'] for message in solves] == ['q1', 'q1']
@@ -0,0 +1,62 @@
+import pytest
+import os, tempfile
+from src.communicate.shm import Ring, _check, is_local
+
+
+@pytest.fixture
+def rings():
+    producer = Ring.create(capacity=64)
+    consumer = Ring.attach(producer.shm.name)
+    yield producer, consumer
+    consumer.close()
+    producer.shm.unlink()
+    producer.close()
+
+
+def test_wraparound(rings):
+    producer, consumer = rings
+    sent, received = bytearray(), bytearray()
+    for i in range(200):
+        chunk = bytes((i + j) % 256 for j in range(1 + i % 50))
+        assert producer.write(chunk) == len(chunk)
+        sent += chunk
+        received += consumer.read()
+    assert received == sent
+    assert producer.tail > 64 * 10 # wrapped around many times
+    assert consumer.head == producer.tail
+
+
+def test_full_ring_takes_what_fits(rings):
+    producer, consumer = rings
+    assert producer.write(b'x' * 50) == 50
+    assert producer.write(b'y' * 50) == 14
+    assert producer.write(b'z') == 0
+    assert consumer.read() == b'x' * 50 + b'y' * 14
+    assert not consumer.readable()
+    assert producer.write(b'y' * 36) == 36 # room again, across the end of the ring
+    assert consumer.read() == b'y' * 36
+
+
+def test_capacity_read_from_header(rings):
+    producer, consumer = rings
+    assert consumer.capacity == producer.capacity == 64
+
+
+def test_accept_checks_names(tmp_path):
+    token = '0123456789abcdef'
+    doorbells = [os.path.join(tempfile.gettempdir(), f'mq_{token}.{side}') for side in ('broker', 'client')]
+    _check({'rings': [f'mq_{token}'] * 2, 'doorbells': doorbells})
+    with pytest.raises(ValueError):
+        _check({'rings': [f'mq_{token}'] * 2, 'doorbells': doorbells[::-1]})
+    with pytest.raises(ValueError):
+        _check({'rings': ['psm_1234', f'mq_{token}'], 'doorbells': []})
+    with pytest.raises(ValueError):
+        _check({'rings': [f'mq_{token}'] * 2, 'doorbells': [str(tmp_path / f'mq_{token}.broker'),
+                                                           str(tmp_path / f'mq_{token}.client')]})
+
+
+def test_is_local():
+    assert is_local(('127.0.0.1', 7777))
+    assert is_local(('::1', 7777, 0, 0))
+    assert is_local('') # Unix socket
+    assert not is_local(('192.0.2.1', 7777))
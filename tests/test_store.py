@@ -0,0 +1,92 @@
+import asyncio, json, os
+from src.data.store import Bookkeeper
+
+
+def query_line(i, correlation_id=''):
+    return json.dumps({
+        'datetime': '01/01/2024, 00:00:00', 'topic': 'query', 'command': 'send', 'id': correlation_id,
+        'message': f'q{i}\ttarget_{i}\tcolor\tred;blue', 'delivery': 'one'
+    }).encode('utf-8')
+
+
+def solve_line(i, correlation_id=''):
+    return json.dumps({
+        'datetime': '01/01/2024, 00:00:01', 'topic': 'solve', 'command': 'send', 'id': correlation_id,
+        'message': {'topic': 'solve', 'id': f'q{i}', 'origin_topic': 'query',
+                    'origin_string': f'q{i}\ttarget_{i}\tcolor\tred;blue', 'choice': 'red', 'uncertainty': 0.25},
+        'delivery': 'all'
+    }).encode('utf-8')
+
+
+def read(path):
+    with open(path) as f:
+        return [line.rstrip('\n').split('\t') for line in f]
+
+
+def test_group_commit_writes_logs_and_index(tmp_path):
+    async def run():
+        bookkeeper = Bookkeeper(f'{tmp_path}/', flush_interval=0.01)
+        for i in range(50):
+            await bookkeeper.log_line(query_line(i, f'c{i}'))
+            await bookkeeper.log_line(solve_line(i, f'c{i}'))
+        await bookkeeper.close()
+        return bookkeeper
+
+    bookkeeper = asyncio.run(run())
+    queries = read(tmp_path / 'logs' / 'query.txt')
+    solves = read(tmp_path / 'logs' / 'solve.txt')
+    assert [line[2] for line in queries] == [f'q{i}' for i in range(50)]
+    assert solves[7][1:] == ['q7', 'target_7', 'color', 'red;blue', 'red', '0.25']
+
+    index = read(tmp_path / 'logs' / 'query.txt.idx')
+    assert [entry[:3] for entry in index] == [[f'c{i}', f'q{i}', 'color'] for i in range(50)]
+    with open(tmp_path / 'logs' / 'query.txt', 'rb') as f:
+        data = f.read()
+    offset = int(index[20][4])
+    assert data[offset:].split(b'\t')[2] == b'q20'
+
+    assert bookkeeper.counters['logged'] == 100
+    assert 1 <= bookkeeper.counters['batches'] <= 100
+    assert bookkeeper.counters['errors'] == 0
+
+
+def test_bad_lines_are_counted_not_fatal(tmp_path):
+    async def run():
+        bookkeeper = Bookkeeper(f'{tmp_path}/', flush_interval=0.01)
+        await bookkeeper.log_line(b'{"topic": "query", "message": "not enough fields"}')
+        await bookkeeper.log_line(query_line(1))
+        await bookkeeper.close()
+        return bookkeeper
+
+    bookkeeper = asyncio.run(run())
+    assert bookkeeper.counters['errors'] == 1
+    assert bookkeeper.counters['logged'] == 2
+    assert len(read(tmp_path / 'logs' / 'query.txt')) == 1
+
+
+def test_overflow_drop(tmp_path):
+    async def run():
+        bookkeeper = Bookkeeper(f'{tmp_path}/', flush_interval=0.5, max_pending=10, overflow='drop')
+        await bookkeeper.start()
+        for i in range(30): # the writer holds one line and waits, the queue takes 10
+            await bookkeeper.log_line(query_line(i))
+        await bookkeeper.close()
+        return bookkeeper
+
+    bookkeeper = asyncio.run(run())
+    assert bookkeeper.counters['dropped'] > 0
+    assert bookkeeper.counters['logged'] + bookkeeper.counters['dropped'] == 30
+
+
+def test_truncated_log_restarts_offsets(tmp_path):
+    async def run():
+        bookkeeper = Bookkeeper(f'{tmp_path}/', flush_interval=0.01)
+        await bookkeeper.log_line(query_line(1))
+        await asyncio.sleep(0.1)
+        for path in ('query.txt', 'query.txt.idx'):
+            open(tmp_path / 'logs' / path, 'w').close()
+        await bookkeeper.log_line(query_line(2))
+        await bookkeeper.close()
+
+    asyncio.run(run())
+    assert read(tmp_path / 'logs' / 'query.txt.idx')[0][4] == '0'